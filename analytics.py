@@ -0,0 +1,350 @@
+import os
+import time
+import threading
+import numpy as np
+from db.db_handler import get_connection
+from db.invoice_record import parse_amounts
+from db.tenants import DEFAULT_TENANT, TenantCache, tenant_path
+
+ANALYTICS_SNAPSHOT_PATH = os.getenv("ANALYTICS_SNAPSHOT_PATH", "analytics_snapshot.npz")
+ANALYTICS_REFRESH_SECONDS = float(os.getenv("ANALYTICS_REFRESH_SECONDS", "5"))
+ANALYTICS_FETCH_BATCH = int(os.getenv("ANALYTICS_FETCH_BATCH", "20000"))
+ANALYTICS_MAX_TENANTS = int(os.getenv("ANALYTICS_MAX_TENANTS", "32"))  # snapshots kept in memory
+
+EPOCH_ORDINAL = 719163  # date(1970, 1, 1).toordinal()
+NAT = np.iinfo(np.int64).min
+
+GROUP_KEYS = ("customer", "supplier", "month")
+AGGREGATES = ("sum", "mean", "count", "max", "min")
+
+
+class SnapshotColumns:
+    """
+    One immutable version of a snapshot's columns: customer_id (int64),
+    invoice_date (datetime64[D], NaT when missing), amount in paise (int64,
+    so sums are exact), customer/supplier as int32 codes into label lists,
+    and invoice_number. Filters are boolean masks and group-bys are
+    bincounts, so nothing is materialised per row.
+
+    Never modified once built; appended() returns a new version. A mask from
+    mask() is only valid for the version that made it.
+    """
+
+    def __init__(self, customer_id=None, invoice_date=None, amount_paise=None, customer_code=None,
+                 supplier_code=None, invoice_number=None, labels=None):
+        self.customer_id = np.empty(0, dtype=np.int64) if customer_id is None else customer_id
+        self.invoice_date = np.empty(0, dtype="datetime64[D]") if invoice_date is None else invoice_date
+        self.amount_paise = np.empty(0, dtype=np.int64) if amount_paise is None else amount_paise
+        self.customer_code = np.empty(0, dtype=np.int32) if customer_code is None else customer_code
+        self.supplier_code = np.empty(0, dtype=np.int32) if supplier_code is None else supplier_code
+        self.invoice_number = np.empty(0, dtype=object) if invoice_number is None else invoice_number
+        self.labels = labels or {"customer": [], "supplier": []}
+        self._codes = {key: {label: i for i, label in enumerate(values)} for key, values in self.labels.items()}
+
+    def __len__(self):
+        return len(self.customer_id)
+
+    @property
+    def high_water_mark(self) -> int:
+        return int(self.customer_id[-1]) if len(self) else 0
+
+    # --- Building ---
+    @staticmethod
+    def _encode(values, labels: list, codes: dict) -> np.ndarray:
+        out = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            value = value or "N/A"
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(labels)
+                labels.append(value)
+            out[i] = code
+        return out
+
+    @staticmethod
+    def _paise(amounts) -> np.ndarray:
+        return np.round(np.nan_to_num(parse_amounts(amounts)) * 100).astype(np.int64)
+
+    @staticmethod
+    def _days(dates) -> np.ndarray:
+        # datetime.date -> days since epoch via toordinal(); numpy's own
+        # conversion of date objects is an order of magnitude slower.
+        try:
+            days = np.fromiter(
+                (d.toordinal() - EPOCH_ORDINAL if d else NAT for d in dates), dtype=np.int64, count=len(dates)
+            )
+            return days.astype("datetime64[D]")
+        except AttributeError:
+            return np.array([d if d else "NaT" for d in dates], dtype="datetime64[D]")
+
+    def appended(self, rows: list) -> "SnapshotColumns":
+        """A new version with rows added; this one is left as it is for readers still using it."""
+        if not rows:
+            return self
+        ids, numbers, customers, suppliers, dates, amounts = zip(*rows)
+        labels = {key: list(values) for key, values in self.labels.items()}
+        codes = {key: dict(values) for key, values in self._codes.items()}
+        return SnapshotColumns(
+            customer_id=np.concatenate([self.customer_id, np.array(ids, dtype=np.int64)]),
+            invoice_date=np.concatenate([self.invoice_date, self._days(dates)]),
+            amount_paise=np.concatenate([self.amount_paise, self._paise(amounts)]),
+            customer_code=np.concatenate([self.customer_code, self._encode(customers, labels["customer"], codes["customer"])]),
+            supplier_code=np.concatenate([self.supplier_code, self._encode(suppliers, labels["supplier"], codes["supplier"])]),
+            invoice_number=np.concatenate([self.invoice_number, np.array(numbers, dtype=object)]),
+            labels=labels,
+        )
+
+    # --- Queries ---
+    def mask(self, date_from=None, date_to=None, min_amount=None, max_amount=None,
+             customers=None, suppliers=None) -> np.ndarray:
+        """Rows matching the filters; customers/suppliers are label lists (any of them)."""
+        selected = np.ones(len(self), dtype=bool)
+        if date_from is not None:
+            selected &= self.invoice_date >= np.datetime64(date_from, "D")
+        if date_to is not None:
+            selected &= self.invoice_date <= np.datetime64(date_to, "D")
+        if min_amount is not None:
+            selected &= self.amount_paise >= round(float(min_amount) * 100)
+        if max_amount is not None:
+            selected &= self.amount_paise <= round(float(max_amount) * 100)
+        for key, names, codes in (("customer", customers, self.customer_code), ("supplier", suppliers, self.supplier_code)):
+            if names:
+                wanted = [self._codes[key][name] for name in names if name in self._codes[key]]
+                selected &= np.isin(codes, wanted)
+        return selected
+
+    def _group_codes(self, key: str, selected: np.ndarray):
+        """(codes, labels, amounts) for the selected rows; rows without a date drop out of months."""
+        amounts = self.amount_paise[selected]
+        if key == "month":
+            months = self.invoice_date[selected].astype("datetime64[M]")
+            valid = ~np.isnat(months)
+            months = months[valid].astype(np.int64)
+            if not len(months):
+                return months, [], amounts[valid]
+            first = months.min()
+            codes = months - first
+            labels = [str(np.datetime64(int(first + i), "M")) for i in range(int(codes.max()) + 1)]
+            return codes, labels, amounts[valid]
+        codes = (self.customer_code if key == "customer" else self.supplier_code)[selected]
+        return codes, self.labels[key], amounts
+
+    def group_by(self, key: str, agg: str = "sum", selected: np.ndarray = None,
+                 top: int = None, ascending: bool = False) -> list:
+        """
+        Aggregate total_amount per customer, supplier or month.
+        Returns [(label, value, invoice_count)], best first (or chronological for month).
+        """
+        if key not in GROUP_KEYS or agg not in AGGREGATES:
+            raise ValueError(f"Unsupported group_by({key!r}, {agg!r})")
+        if selected is None:
+            selected = np.ones(len(self), dtype=bool)
+        codes, labels, amounts = self._group_codes(key, selected)
+        size = len(labels)
+        counts = np.bincount(codes, minlength=size)
+        if agg == "count":
+            values = counts.astype(np.float64)
+        elif agg in ("sum", "mean"):
+            values = np.bincount(codes, weights=amounts, minlength=size) / 100
+            if agg == "mean":
+                values = np.divide(values, counts, out=np.zeros(size), where=counts > 0)
+        else:
+            fill = np.iinfo(np.int64).min if agg == "max" else np.iinfo(np.int64).max
+            values = np.full(size, fill, dtype=np.int64)
+            (np.maximum if agg == "max" else np.minimum).at(values, codes, amounts)
+            values = values / 100
+        present = np.flatnonzero(counts)
+        if key == "month" and top is None:
+            order = present
+        else:
+            order = present[np.argsort(values[present] if ascending else -values[present], kind="stable")]
+        if top is not None:
+            order = order[:top]
+        return [(labels[i], float(values[i]), int(counts[i])) for i in order]
+
+    def top_invoices(self, n: int, selected: np.ndarray = None, ascending: bool = False) -> list:
+        """The n highest (or lowest) invoices by total, as small dicts."""
+        indices = np.flatnonzero(selected) if selected is not None else np.arange(len(self))
+        if not len(indices):
+            return []
+        keys = self.amount_paise[indices] if ascending else -self.amount_paise[indices]
+        n = min(n, len(indices))
+        part = np.argpartition(keys, n - 1)[:n]
+        part = part[np.argsort(keys[part], kind="stable")]
+        result = []
+        for i in indices[part]:
+            date = self.invoice_date[i]
+            result.append({
+                "customer_id": int(self.customer_id[i]),
+                "invoice_number": self.invoice_number[i],
+                "customer": self.labels["customer"][self.customer_code[i]],
+                "supplier": self.labels["supplier"][self.supplier_code[i]],
+                "invoice_date": None if np.isnat(date) else str(date),
+                "total_amount": self.amount_paise[i] / 100,
+            })
+        return result
+
+    def totals(self, selected: np.ndarray = None) -> dict:
+        amounts = self.amount_paise if selected is None else self.amount_paise[selected]
+        count = len(amounts)
+        total = int(amounts.sum()) / 100
+        return {"count": count, "sum": total, "mean": total / count if count else 0.0}
+
+
+class AnalyticsSnapshot:
+    """
+    Columnar copy of data_of_invoices for aggregate questions, one tenant's
+    rows. Persisted to ANALYTICS_SNAPSHOT_PATH and refreshed like the vector
+    index: rows above the customer_id high-water mark are appended, and
+    deletes trigger a rebuild.
+
+    refresh() builds a new SnapshotColumns and publishes it with a single
+    reference swap, so readers never see a half-appended column set. Code
+    that combines several calls (a mask, then a group_by over it) should
+    take one view() and use it throughout.
+    """
+
+    def __init__(self, path: str = ANALYTICS_SNAPSHOT_PATH, tenant_id: str = DEFAULT_TENANT):
+        self.path = path
+        self.tenant_id = tenant_id
+        self._lock = threading.Lock()
+        self.checked_at = 0.0
+        self._columns = SnapshotColumns()
+        self._load()
+
+    def view(self) -> SnapshotColumns:
+        """The current column set; it doesn't change under the caller."""
+        return self._columns
+
+    def __len__(self):
+        return len(self._columns)
+
+    @property
+    def high_water_mark(self) -> int:
+        return self._columns.high_water_mark
+
+    @property
+    def labels(self) -> dict:
+        return self._columns.labels
+
+    # --- Persistence ---
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                self._columns = SnapshotColumns(
+                    customer_id=data["customer_id"],
+                    invoice_date=data["invoice_date"],
+                    amount_paise=data["amount_paise"],
+                    customer_code=data["customer_code"],
+                    supplier_code=data["supplier_code"],
+                    invoice_number=data["invoice_number"].astype(object),
+                    labels={key: data[f"{key}_labels"].tolist() for key in ("customer", "supplier")},
+                )
+        except Exception as e:
+            print("Error loading analytics snapshot, it will be rebuilt:", e)
+            self._columns = SnapshotColumns()
+
+    def _save(self, columns: SnapshotColumns):
+        if not self.path:
+            return
+        # Unique per writer, so processes sharing the file don't clobber each other's temp file.
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        try:
+            np.savez(
+                tmp_path,
+                customer_id=columns.customer_id,
+                invoice_date=columns.invoice_date,
+                amount_paise=columns.amount_paise,
+                customer_code=columns.customer_code,
+                supplier_code=columns.supplier_code,
+                invoice_number=columns.invoice_number.astype(str),
+                customer_labels=np.array(columns.labels["customer"], dtype=str),
+                supplier_labels=np.array(columns.labels["supplier"], dtype=str),
+            )
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # --- Loading rows ---
+    def append_rows(self, rows: list):
+        """rows: (customer_id, invoice_number, customer, supplier, invoice_date, total_amount) tuples, ascending id."""
+        with self._lock:
+            self._columns = self._columns.appended(rows)
+
+    def _fetch_rows_after(self, columns: SnapshotColumns) -> SnapshotColumns:
+        # Named (server-side) cursor: rows arrive in batches, not all at once.
+        with get_connection() as conn:
+            with conn.cursor(name="analytics_snapshot") as cur:
+                cur.itersize = ANALYTICS_FETCH_BATCH
+                cur.execute(
+                    """
+                    SELECT customer_id, invoice_number, customer, supplier, invoice_date, total_amount
+                    FROM data_of_invoices
+                    WHERE tenant_id = %s AND customer_id > %s
+                    ORDER BY customer_id;
+                    """,
+                    (self.tenant_id, columns.high_water_mark)
+                )
+                while True:
+                    batch = cur.fetchmany(ANALYTICS_FETCH_BATCH)
+                    if not batch:
+                        break
+                    columns = columns.appended(batch)
+        return columns
+
+    def refresh(self, force: bool = False):
+        """Append rows added since the last refresh; rebuild if rows were deleted. Throttled."""
+        with self._lock:
+            if not force and time.monotonic() - self.checked_at < ANALYTICS_REFRESH_SECONDS:
+                return
+            self.checked_at = time.monotonic()
+            columns = self._columns
+            try:
+                with get_connection() as conn, conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT COUNT(*), COALESCE(MAX(customer_id), 0) FROM data_of_invoices WHERE tenant_id = %s;",
+                        (self.tenant_id,)
+                    )
+                    count, max_id = cur.fetchone()
+                if max_id == columns.high_water_mark and count == len(columns):
+                    return
+                if max_id < columns.high_water_mark or count < len(columns):
+                    columns = SnapshotColumns()
+                columns = self._fetch_rows_after(columns)
+                if len(columns) != count:
+                    # Rows were deleted or rewritten below the mark; start over.
+                    columns = self._fetch_rows_after(SnapshotColumns())
+                if columns is not self._columns:
+                    self._save(columns)
+                    self._columns = columns
+            except Exception as e:
+                print("Error refreshing analytics snapshot:", e)
+
+    # --- Queries, each over the current view ---
+    def mask(self, *args, **kwargs) -> np.ndarray:
+        return self._columns.mask(*args, **kwargs)
+
+    def group_by(self, *args, **kwargs) -> list:
+        return self._columns.group_by(*args, **kwargs)
+
+    def top_invoices(self, *args, **kwargs) -> list:
+        return self._columns.top_invoices(*args, **kwargs)
+
+    def totals(self, *args, **kwargs) -> dict:
+        return self._columns.totals(*args, **kwargs)
+
+
+_snapshots = TenantCache(
+    lambda tenant_id: AnalyticsSnapshot(tenant_path(ANALYTICS_SNAPSHOT_PATH, tenant_id), tenant_id),
+    ANALYTICS_MAX_TENANTS,
+)
+
+
+def get_analytics_snapshot(tenant_id: str = None) -> AnalyticsSnapshot:
+    """Process-wide snapshot of the (current) tenant, refreshed at most every ANALYTICS_REFRESH_SECONDS."""
+    snapshot = _snapshots.get(tenant_id)
+    snapshot.refresh()
+    return snapshot
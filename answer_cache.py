@@ -0,0 +1,317 @@
+"""
+Semantic answer cache for questions that go to Gemini.
+
+Users ask the same things over and over ("latest invoice total", "who
+bought from Amazon?"), often worded a little differently. Before retrieval
+and the Gemini call, ChatTurn and run_query look the question up here. It
+is embedded with the invoice index's model, so retrieval reuses the vector
+on a miss, and compared with the questions this tenant asked before. A
+stored answer is returned when:
+  - the cosine similarity is at least ANSWER_CACHE_THRESHOLD;
+  - both questions have the same key terms (question_signature): numbers
+    and ids ("invoice 12", INV-2003, 2024-05-01), ordering and comparison
+    words (first/last, highest/lowest, above/below), months and time units,
+    and the customer and supplier names mentioned. "Invoice 12" never
+    answers "invoice 13", and "last month" never answers "last week";
+  - the answer was stored at the tenant's current data version, on the same
+    day, since relative dates move at midnight. Every invoice write bumps
+    the version (migrations/011_data_version.sql).
+Follow-ups that lean on the conversation ("what was its total?", "the one
+before") are never looked up or stored (followup.is_followup).
+
+The data version is read per lookup, one primary-key query. With
+ANSWER_CACHE_LISTEN=1 a listener thread follows NOTIFY invoice_data_version
+instead. A tenant's answers are then dropped as soon as a write commits, and
+no version query is needed.
+"""
+import os
+import re
+import time
+import select
+import datetime
+import threading
+from dataclasses import dataclass, field
+import numpy as np
+from db.db_handler import connect, fetch_data_version
+from db.analytics import get_analytics_snapshot
+from db.tenants import TenantCache, current_tenant
+from llm.embeddings import get_embedding_service
+from llm.followup import is_followup
+from metrics import get_metrics, inc, trace_add
+
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "on").lower()  # on | off
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # cosine similarity
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))  # answers kept per tenant
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))  # seconds
+ANSWER_CACHE_MAX_TENANTS = int(os.getenv("ANSWER_CACHE_MAX_TENANTS", "32"))
+ANSWER_CACHE_LISTEN = os.getenv("ANSWER_CACHE_LISTEN", "0") == "1"
+DATA_VERSION_CHANNEL = "invoice_data_version"
+
+TOKEN_RE = re.compile(r"\w[\w/.:-]*")
+# Words that change what is asked while barely moving the embedding.
+KEY_WORDS = frozenset("""
+first last latest newest oldest earliest recent previous next second third fourth fifth
+highest lowest largest smallest biggest cheapest expensive most least max min maximum minimum top bottom
+above below over under more less greater fewer before after since until between not no without except
+sum total average mean count many much number odd even each per
+today yesterday tomorrow day days week weeks month months quarter year years
+january february march april may june july august september october november december
+jan feb mar apr jun jul aug sep sept oct nov dec
+""".split())
+
+
+def question_signature(question: str, tenant_id: str = None) -> frozenset:
+    """Key terms two questions must share for one's answer to serve the other (see module docstring)."""
+    lowered = question.lower()
+    terms = set()
+    for token in TOKEN_RE.findall(lowered):
+        token = token.strip(".:-/")
+        if any(ch.isdigit() for ch in token) or token in KEY_WORDS:
+            terms.add(token)
+    try:
+        labels = get_analytics_snapshot(tenant_id).labels
+    except Exception as e:
+        print("Error reading customer/supplier names for the answer cache:", e)
+        labels = {}
+    for key in ("customer", "supplier"):
+        for label in labels.get(key, ()):
+            name = label.lower()
+            if len(name) > 2 and name != "n/a" and name in lowered:
+                terms.add(f"{key}:{name}")
+    return frozenset(terms)
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    # Small dicts of the invoices the answer was about, for follow-up resolution.
+    invoices: list = field(default_factory=list)
+    similarity: float = 1.0
+
+
+class AnswerBucket:
+    """One tenant's answers at one data version, with their question vectors as a matrix."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset(None, None)
+
+    def _reset(self, version, day):
+        self.version = version
+        self.day = day
+        self.vectors = None
+        self.entries = []  # (signature, CachedAnswer, expires_at)
+
+    def lookup(self, vector: np.ndarray, signature: frozenset, version, day, threshold: float):
+        with self.lock:
+            if (version, day) != (self.version, self.day) or self.vectors is None:
+                return None
+            similarities = self.vectors @ vector
+            now = time.time()
+            for i in np.argsort(-similarities):
+                if similarities[i] < threshold:
+                    break
+                entry_signature, answer, expires_at = self.entries[i]
+                if entry_signature == signature and expires_at >= now:
+                    return CachedAnswer(answer.question, answer.answer, answer.invoices, float(similarities[i]))
+            return None
+
+    def store(self, vector: np.ndarray, signature: frozenset, answer: CachedAnswer, version, day,
+              ttl: int, max_entries: int):
+        with self.lock:
+            if (version, day) != (self.version, self.day):
+                self._reset(version, day)
+            self.entries.append((signature, answer, time.time() + ttl))
+            row = vector[np.newaxis, :]
+            self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+            if len(self.entries) > max_entries:
+                drop = len(self.entries) - max_entries
+                del self.entries[:drop]
+                self.vectors = self.vectors[drop:]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _compact_invoices(invoices: list) -> list:
+    # Only single-invoice answers feed follow-ups (remember_invoices); memory keeps labels.
+    keys = ("customer_id", "invoice_number", "customer", "position")
+    return [{key: inv.get(key) for key in keys} for inv in invoices[:20]]
+
+
+class AnswerCache:
+    """Per-tenant semantic cache of final answers; see the module docstring."""
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, max_entries: int = ANSWER_CACHE_SIZE,
+                 ttl: int = ANSWER_CACHE_TTL, max_tenants: int = ANSWER_CACHE_MAX_TENANTS, embeddings=None):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._embeddings = embeddings
+        self._buckets = TenantCache(lambda tenant_id: AnswerBucket(), max_tenants)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.skipped_followups = 0
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = get_embedding_service()
+        return self._embeddings
+
+    def _key(self, question: str, tenant_id: str):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector), question_signature(question, tenant_id)
+
+    @staticmethod
+    def cacheable(question: str) -> bool:
+        """Self-contained questions only: a follow-up's answer depends on the conversation."""
+        return bool(question.strip()) and not is_followup(question)
+
+    def lookup(self, question: str, data_version, tenant_id: str = None) -> CachedAnswer:
+        """
+        The stored answer for this (or a near-identical) question at
+        `data_version`, or None. `tenant_id` defaults to the current tenant.
+        """
+        if not self.cacheable(question):
+            self.skipped_followups += 1
+            return None
+        tenant_id = tenant_id or current_tenant()
+        vector, signature = self._key(question, tenant_id)
+        found = self._buckets.get(tenant_id).lookup(vector, signature, data_version, datetime.date.today(), self.threshold)
+        if found is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        inc("answer_cache_lookups_total", result="hit" if found is not None else "miss")
+        trace_add("answer_cache_hits" if found is not None else "answer_cache_misses")
+        return found
+
+    def store(self, question: str, data_version, answer: str, invoices: list = None, tenant_id: str = None):
+        """
+        Remember `answer`; `data_version` must be the one read before the
+        answer was computed, and `tenant_id` the tenant it was read for
+        (pass it when storing from another context, e.g. a streamed response).
+        """
+        if not answer or not self.cacheable(question):
+            return
+        tenant_id = tenant_id or current_tenant()
+        vector, signature = self._key(question, tenant_id)
+        entry = CachedAnswer(question, answer, _compact_invoices(invoices or []))
+        self._buckets.get(tenant_id).store(vector, signature, entry, data_version, datetime.date.today(),
+                                  self.ttl, self.max_entries)
+        self.stores += 1
+
+    def invalidate(self, tenant_id: str = None):
+        """Drop a tenant's answers (the data version check would skip them anyway)."""
+        bucket = self._buckets.get(tenant_id)
+        with bucket.lock:
+            bucket._reset(None, None)
+
+    def clear(self):
+        self._buckets.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "tenants": len(self._buckets),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "skipped_followups": self.skipped_followups,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class DataVersionListener:
+    """
+    Follows NOTIFY invoice_data_version ('<tenant>:<version>', sent by the
+    011 triggers on commit) on a dedicated connection. While it is connected,
+    versions it has seen are served from memory; after a disconnect it
+    forgets them and lookups query the table again until it reconnects.
+    """
+
+    def __init__(self, cache: AnswerCache):
+        self.cache = cache
+        self.versions = {}
+        self.connected = False
+        self.generation = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="data-version-listener", daemon=True).start()
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {DATA_VERSION_CHANNEL};")
+                with self._lock:
+                    self.connected = True
+                    self.generation += 1
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        tenant_id, _, version = conn.notifies.pop(0).payload.rpartition(":")
+                        with self._lock:
+                            self.versions[tenant_id] = int(version)
+                        self.cache.invalidate(tenant_id)
+            except Exception as e:
+                print("Data version listener disconnected, retrying:", e)
+            finally:
+                with self._lock:
+                    self.connected = False
+                    self.versions.clear()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(5)
+
+    def version(self, tenant_id: str):
+        with self._lock:
+            if self.connected and tenant_id in self.versions:
+                return self.versions[tenant_id]
+            generation = self.generation if self.connected else None
+        version = fetch_data_version()
+        with self._lock:
+            # Only trust the read if LISTEN was already active before it, so no bump was missed;
+            # a notification that arrived meanwhile wins.
+            if generation is not None and self.connected and self.generation == generation:
+                self.versions.setdefault(tenant_id, version)
+        return version
+
+
+_cache = None
+_listener = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """The process-wide answer cache, or None when ANSWER_CACHE=off."""
+    global _cache, _listener
+    if ANSWER_CACHE == "off":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                cache = AnswerCache()
+                if ANSWER_CACHE_LISTEN:
+                    _listener = DataVersionListener(cache)
+                get_metrics().register_collector("answer_cache", cache.stats)
+                _cache = cache
+    return _cache
+
+
+def current_data_version():
+    """Data version of the current tenant, from the listener when it is running."""
+    if _listener is not None:
+        return _listener.version(current_tenant())
+    return fetch_data_version()
@@ -1,111 +1,246 @@
 import os
-from datetime import datetime
-import json
+import uuid
 import streamlit as st
 from langchain.schema import HumanMessage, AIMessage
-from llm.query_llm import run_query, run_chat, llm_extract_invoice_fields
-from img2text.img2text import extract_text_from_image
-from db.db_handler import insert_invoice, insert_invoice_image, insert_chat_message
-from langchain.embeddings import HuggingFaceEmbeddings
+from llm.query_llm import ChatTurn
+from db.chat_store import get_chat_writer, fetch_chat_page
+from db.jobs import enqueue_job, fetch_jobs
+from db.blob_store import content_sha256, store_blob, dhash, find_duplicate
+from ingest_worker import start_workers, INGEST_WORKERS
+from llm.intent_router import router_stats
+from llm.llm_cache import get_llm_cache
+from llm.answer_cache import get_answer_cache
+from llm.followup import new_session
+from llm.memory import ChatMemory, CHAT_MEMORY_TURNS, CHAT_MEMORY_RELOAD_TURNS
+from metrics import get_metrics, start_metrics_server, METRICS_PORT
+from db.tenants import authenticate_tenant, set_current_tenant
 
 # Configure Streamlit.
 st.set_page_config(page_title="Robust Invoice Chatbot", layout="wide")
 st.title("Robust Invoice Chatbot")
 
+# Workspace of the signed ?token= (or the trusted proxy header, see tenants.py);
+# ?tenant= may only name that same workspace. Every query, upload and index in
+# this run is scoped to it.
+try:
+    tenant_id = authenticate_tenant(st.context.headers, token=st.query_params.get("token"),
+                                    requested=st.query_params.get("tenant"))
+    set_current_tenant(tenant_id)
+except (ValueError, PermissionError) as e:
+    st.error(str(e))
+    st.stop()
+# A conversation belongs to one workspace; switching starts a fresh one.
+if st.session_state.get("tenant_id") != tenant_id:
+    for key in ("last_uploaded_sha", "near_duplicate", "chat_history", "current_invoice_id", "chat_session",
+                "ingest_jobs", "chat_session_id"):
+        st.session_state.pop(key, None)
+    st.session_state.tenant_id = tenant_id
+
 # Initialize session state.
-if "last_uploaded_name" not in st.session_state:
-    st.session_state.last_uploaded_name = ""
+if "last_uploaded_sha" not in st.session_state:
+    st.session_state.last_uploaded_sha = ""
+if "near_duplicate" not in st.session_state:
+    st.session_state.near_duplicate = None
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 if "current_invoice_id" not in st.session_state:
     st.session_state.current_invoice_id = None
+if "chat_session" not in st.session_state:
+    st.session_state.chat_session = new_session()
+if "ingest_jobs" not in st.session_state:
+    st.session_state.ingest_jobs = []
+if "history_cursor" not in st.session_state:
+    st.session_state.history_cursor = None  # fetch_chat_page cursor for "Show earlier messages"
+    st.session_state.history_key = (None, None)
+
+
+def to_chat_messages(page: list) -> list:
+    return [
+        HumanMessage(content=message["content"]) if message["role"] == "user" else AIMessage(content=message["content"])
+        for message in page
+    ]
+
+
+def restore_conversation(invoice_id: int = None, session_id: str = None) -> bool:
+    """
+    Load the newest page of a stored conversation; older pages are fetched on
+    demand. Only the last few turns seed the chat memory (see load_chat_memory).
+    """
+    try:
+        page, cursor = fetch_chat_page(invoice_id, session_id)
+    except Exception as e:
+        print("Error loading chat history:", e)
+        return False
+    pairs = [(message["role"], message["content"]) for message in page]
+    st.session_state.chat_session = new_session()
+    st.session_state.chat_session["memory"] = ChatMemory.from_messages(
+        pairs[-2 * (CHAT_MEMORY_TURNS + CHAT_MEMORY_RELOAD_TURNS):]
+    )
+    st.session_state.chat_history = to_chat_messages(page)
+    st.session_state.history_cursor = cursor
+    st.session_state.history_key = (invoice_id, session_id)
+    return True
+
+
+def start_conversation():
+    """A new conversation id, kept in the URL so a page reload restores the conversation."""
+    st.session_state.chat_session_id = uuid.uuid4().hex
+    st.query_params["session"] = st.session_state.chat_session_id
+    st.session_state.history_cursor = None
+
+
+if "chat_session_id" not in st.session_state:
+    session_param = (st.query_params.get("session") or "")[:64]
+    if session_param:
+        st.session_state.chat_session_id = session_param
+        restore_conversation(session_id=session_param)
+    else:
+        start_conversation()
+
+
+@st.cache_resource
+def ingest_workers():
+    """Background worker processes shared by every session of this server."""
+    return start_workers(INGEST_WORKERS) if INGEST_WORKERS > 0 else []
+
+
+ingest_workers()
+
+
+@st.cache_resource
+def metrics_server():
+    """Prometheus /metrics endpoint on METRICS_PORT (off by default)."""
+    return start_metrics_server(METRICS_PORT)
+
+
+metrics_server()
 
 # --------------------------------------------------
 # Invoice Upload Section (Sidebar)
 # --------------------------------------------------
 st.sidebar.header("Upload Invoice")
-st.sidebar.write("Upload an invoice image for extraction.")
-
-uploaded_file = st.sidebar.file_uploader("Choose an invoice image", type=["png", "jpg", "jpeg"])
-
-if uploaded_file is not None and uploaded_file.name != st.session_state.last_uploaded_name:
-    st.session_state.last_uploaded_name = uploaded_file.name
-    st.session_state.chat_history = []  # Clear previous conversation.
-
-    # Save the uploaded file.
-    temp_folder = "temp_upload"
-    os.makedirs(temp_folder, exist_ok=True)
-    file_path = os.path.join(temp_folder, uploaded_file.name)
-    with open(file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    st.sidebar.success("Invoice uploaded and stored successfully!")
-
-    # Extract OCR text.
-    ocr_text = extract_text_from_image(file_path)
-
-    # LLM-based extraction.
-    extracted = llm_extract_invoice_fields(ocr_text)
-
-    # Post-process extracted data: Force missing keys to "N/A" or "0"
-    required_fields = ["invoice_number", "invoice_date", "total_amount", "supplier", "customer", "items"]
-    for key in required_fields:
-        if key not in extracted or not extracted.get(key) or extracted.get(key).strip() == "":
-            extracted[key] = "0" if key == "total_amount" else "N/A"
-
-    # Format invoice_date into YYYY-MM-DD
-    if extracted.get("invoice_date") and extracted["invoice_date"] != "N/A":
-        parsed_date = None
-        for fmt in ("%d/%m/%Y", "%d-%m-%Y"):  # support 06/05/2025 or 06-05-2025
-            try:
-                parsed_date = datetime.strptime(extracted["invoice_date"], fmt)
-                break
-            except Exception:
-                continue
-        extracted["invoice_date"] = parsed_date.strftime("%Y-%m-%d") if parsed_date else datetime.today().strftime("%Y-%m-%d")
-    else:
-        extracted["invoice_date"] = datetime.today().strftime("%Y-%m-%d")
-
-    # Compute vector embedding
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    invoice_content = (
-        f"Invoice Number: {extracted.get('invoice_number')}\n"
-        f"Customer: {extracted.get('customer')}\n"
-        f"Supplier: {extracted.get('supplier')}\n"
-        f"Date: {extracted.get('invoice_date')}\n"
-        f"Items: {extracted.get('items')}\n"
-        f"Total Amount: {extracted.get('total_amount')}"
-    )
-    vector = embeddings.embed_query(invoice_content)
-    extracted["vector_embedding"] = json.dumps(vector)
+st.sidebar.write("Upload an invoice image or PDF for extraction.")
+
+uploaded_file = st.sidebar.file_uploader("Choose an invoice image or PDF", type=["png", "jpg", "jpeg", "pdf"])
+
+
+def queue_upload(data: bytes, file_name: str, digest: str, phash):
+    """Store the file by content hash; OCR, extraction, embedding and the insert run in the ingest workers."""
+    _, file_path = store_blob(data, os.path.splitext(file_name)[1], digest=digest)
+    try:
+        st.session_state.ingest_jobs.append(enqueue_job(file_path, file_name, digest, phash))
+        st.session_state.current_invoice_id = None
+        st.sidebar.success("Invoice uploaded; processing in the background.")
+    except Exception as e:
+        print("Error queueing invoice:", e)
+        st.sidebar.error("Failed to queue invoice. Check the console for details.")
+
+
+if uploaded_file is not None:
+    data = uploaded_file.getvalue()
+    digest = content_sha256(data)
+    if digest != st.session_state.last_uploaded_sha:
+        st.session_state.last_uploaded_sha = digest
+        st.session_state.near_duplicate = None
+        st.session_state.chat_history = []  # Clear previous conversation.
+        st.session_state.chat_session = new_session()
+        start_conversation()
 
-    # Insert invoice into DB
-    inserted_id = insert_invoice(extracted)
-    if inserted_id:
-        st.session_state.current_invoice_id = inserted_id
+        phash = None
+        if not uploaded_file.name.lower().endswith(".pdf"):
+            try:
+                phash = dhash(uploaded_file)
+            except Exception as e:
+                print("Error computing image hash:", e)
         try:
-            insert_invoice_image(inserted_id, file_path, ocr_text)
+            duplicate = find_duplicate(digest, phash)
         except Exception as e:
-            print("Error inserting invoice image:", e)
+            print("Error checking for duplicates:", e)
+            duplicate = None
+
+        if duplicate and duplicate[1] == "exact":
+            # Same bytes as a stored upload: reuse it, no OCR/LLM/embedding.
+            st.session_state.current_invoice_id = duplicate[0]
+            st.sidebar.info(f"This invoice was already uploaded (invoice id {duplicate[0]}).")
+        elif duplicate:
+            st.session_state.current_invoice_id = duplicate[0]
+            st.session_state.near_duplicate = {
+                "invoice_id": duplicate[0], "file_name": uploaded_file.name, "digest": digest, "phash": phash
+            }
+        else:
+            queue_upload(data, uploaded_file.name, digest, phash)
+
+near_duplicate = st.session_state.near_duplicate
+if near_duplicate:
+    st.sidebar.warning(f"This looks like a re-scan of invoice id {near_duplicate['invoice_id']}; using that invoice.")
+    if uploaded_file is not None and st.sidebar.button("Process as a new invoice"):
+        st.session_state.near_duplicate = None
+        queue_upload(uploaded_file.getvalue(), near_duplicate["file_name"], near_duplicate["digest"], near_duplicate["phash"])
+
+
+@st.fragment(run_every=2)
+def ingest_status():
+    """Poll this session's upload jobs; chat stays usable while they run."""
+    job_ids = st.session_state.ingest_jobs
+    if not job_ids:
+        return
+    try:
+        jobs = fetch_jobs(job_ids[-5:])
+    except Exception as e:
+        print("Error fetching ingest jobs:", e)
+        return
+    st.subheader("Uploads")
+    for job in jobs:
+        if job["status"] == "stored":
+            st.caption(f"✅ {job['file_name']}: stored (invoice id {job['invoice_id']})")
+        elif job["status"] == "failed":
+            st.caption(f"❌ {job['file_name']}: failed ({job['error']})")
+        else:
+            st.caption(f"⏳ {job['file_name']}: {job['status']}")
+    latest = jobs[-1] if jobs else None
+    # Chat messages are stored against the most recent upload once it lands.
+    if latest and latest["id"] == job_ids[-1] and latest["status"] == "stored":
+        st.session_state.current_invoice_id = latest["invoice_id"]
+
+
+with st.sidebar:
+    ingest_status()
+
+# Resume a stored conversation: only the recent turns are loaded, older ones
+# are folded into the memory summary.
+resume_id = st.sidebar.number_input("Resume chat for invoice ID", min_value=0, step=1, value=0)
+if resume_id and st.sidebar.button("Resume chat"):
+    if restore_conversation(invoice_id=int(resume_id)):
+        st.session_state.current_invoice_id = int(resume_id)
     else:
-        st.sidebar.error("Failed to save invoice. Check the console for details.")
+        st.sidebar.error("Failed to load chat history. Check the console for details.")
 
 # --------------------------------------------------
 # Chat Interface Section
 # --------------------------------------------------
 st.header("Chat with Your Invoices")
 
-chat_placeholder = st.empty()
+chat_container = st.container()
+
+if st.session_state.history_cursor and chat_container.button("Show earlier messages"):
+    invoice_id, session_id = st.session_state.history_key
+    try:
+        page, st.session_state.history_cursor = fetch_chat_page(
+            invoice_id, session_id, before=st.session_state.history_cursor
+        )
+        st.session_state.chat_history = to_chat_messages(page) + st.session_state.chat_history
+    except Exception as e:
+        print("Error loading chat history:", e)
 
 
 def render_chat():
-    """Render the entire chat conversation."""
-    chat_content = ""
-    for msg in st.session_state.chat_history:
-        if msg.__class__.__name__ == "HumanMessage":
-            chat_content += f"**You:** {msg.content}\n\n"
-        elif msg.__class__.__name__ == "AIMessage":
-            chat_content += f"**Bot:** {msg.content}\n\n"
-    chat_placeholder.markdown(chat_content)
+    """Render the chat conversation, one message element per turn."""
+    with chat_container:
+        for msg in st.session_state.chat_history:
+            if msg.__class__.__name__ == "HumanMessage":
+                st.chat_message("user").markdown(msg.content)
+            elif msg.__class__.__name__ == "AIMessage":
+                st.chat_message("assistant").markdown(msg.content)
 
 
 render_chat()
@@ -116,24 +251,76 @@ with st.form(key="chat_form", clear_on_submit=True):
 
 if submit_button:
     if query.strip():
-        with st.spinner("Processing your query..."):
-            answer, updated_history = run_chat(query, st.session_state.chat_history)
-            # Update session state with new history
-            st.session_state.chat_history = updated_history
-            # Persist chat history in DB for later context
-            if st.session_state.current_invoice_id:
-                insert_chat_message(
-                    st.session_state.current_invoice_id,
-                    'user',
-                    query,
-                    datetime.utcnow()
-                )
-                insert_chat_message(
-                    st.session_state.current_invoice_id,
-                    'bot',
-                    answer,
-                    datetime.utcnow()
-                )
-        render_chat()
+        with chat_container:
+            st.chat_message("user").markdown(query)
+            with st.chat_message("assistant"):
+                with st.spinner("Processing your query..."):
+                    turn = ChatTurn(query, st.session_state.chat_history, st.session_state.chat_session)
+                # Tokens are rendered as Gemini produces them.
+                st.write_stream(turn.stream())
+        answer = turn.answer
+        # Update session state with new history
+        st.session_state.chat_history = turn.history
+        # Persist chat history for reloads and later context; written in
+        # batches by a background thread (chat_store.py).
+        get_chat_writer().append_turn(
+            query, answer,
+            invoice_id=st.session_state.current_invoice_id,
+            session_id=st.session_state.chat_session_id,
+        )
     else:
         st.warning("Please enter a valid query.")
+
+if router_stats.total:
+    st.sidebar.caption(f"Answered by SQL without an LLM call: {router_stats.served_fraction:.0%} of {router_stats.total} questions")
+turn_timings = st.session_state.chat_session["turn_timings"]
+if turn_timings:
+    last_turn = turn_timings[-1]
+    st.sidebar.caption(
+        f"Last turn: first token {last_turn.get('ttft', 0):.2f}s, total {last_turn['seconds']:.2f}s, "
+        f"{last_turn['llm_calls']} LLM call(s) via {last_turn['route']}"
+        + (" (condensed)" if last_turn["condensed"] else "")
+        + (f", {last_turn['prompt_tokens_saved']} prompt tokens saved" if last_turn.get("prompt_tokens_saved") else "")
+    )
+cache_stats = get_llm_cache().stats()
+if cache_stats["hits"] + cache_stats["misses"]:
+    st.sidebar.caption(f"LLM cache hit rate: {cache_stats['hit_rate']:.0%} ({cache_stats['hits']} hits, {cache_stats['misses']} misses)")
+answer_cache = get_answer_cache()
+if answer_cache is not None and answer_cache.hits + answer_cache.misses:
+    answer_stats = answer_cache.stats()
+    st.sidebar.caption(f"Answered from earlier answers: {answer_stats['hit_rate']:.0%} ({answer_stats['hits']} of {answer_stats['hits'] + answer_stats['misses']} questions)")
+
+
+def render_debug_panel(last_n: int = 10):
+    """Per-stage latency of the last few chat turns, plus totals and cache/token counters."""
+    metrics = get_metrics()
+    traces = metrics.recent_traces(last_n)
+    with st.expander("Latency breakdown", expanded=True):
+        if traces:
+            st.dataframe([
+                {
+                    "request": trace["name"],
+                    "route": trace.get("route", ""),
+                    "total s": trace["seconds"],
+                    "first token s": trace.get("ttft"),
+                    **{f"{stage} s": seconds for stage, seconds in trace["stages"].items()},
+                    "prompt chars": trace.get("prompt_chars", 0),
+                    "tokens in": trace.get("prompt_tokens", 0),
+                    "tokens out": trace.get("output_tokens", 0),
+                    "cache hits": trace.get("llm_cache_hits", 0),
+                    "tokens saved": trace.get("prompt_tokens_saved", 0),
+                }
+                for trace in reversed(traces)
+            ])
+        else:
+            st.caption("No requests traced yet.")
+        snapshot = metrics.snapshot()
+        st.caption("Stage totals since start")
+        st.dataframe([{"stage": stage, **stats} for stage, stats in sorted(snapshot["stages"].items())])
+        st.json({**snapshot["counters"], **snapshot["gauges"]}, expanded=False)
+        st.download_button("Prometheus metrics", metrics.prometheus_text(), file_name="metrics.prom")
+        st.download_button("Traces (JSON lines)", metrics.json_lines(), file_name="traces.jsonl")
+
+
+if st.sidebar.checkbox("Show debug metrics", value=os.getenv("METRICS_DEBUG_PANEL", "0") == "1"):
+    render_debug_panel()
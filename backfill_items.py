@@ -0,0 +1,76 @@
+"""
+Fill invoice_items from the legacy pipe-joined data_of_invoices.items strings.
+
+    python backfill_items.py [--batch-size 1000]
+
+Applies migrations/007_invoice_items.sql, then parses the items of every
+invoice that has no invoice_items rows yet ("Shoes | Kurta x2 | Burger ₹120"),
+in batches, one transaction per batch. Safe to re-run; invoices that
+already have line items are skipped.
+"""
+import os
+import sys
+import argparse
+from db.db_handler import unit_of_work
+from db.invoice_items import parse_items_string, insert_item_rows
+
+MIGRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations", "007_invoice_items.sql")
+
+
+def apply_schema():
+    with open(MIGRATION_FILE, "r", encoding="utf-8") as f:
+        sql = f.read()
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(sql)
+
+
+def backfill_batch(batch_size: int, after_id: int):
+    """Parse one batch of invoices above after_id. Returns (invoices seen, items written, last id)."""
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT d.customer_id, d.items
+            FROM data_of_invoices d
+            WHERE d.customer_id > %s
+              AND NOT EXISTS (SELECT 1 FROM invoice_items i WHERE i.invoice_id = d.customer_id)
+            ORDER BY d.customer_id
+            LIMIT %s;
+            """,
+            (after_id, batch_size)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return 0, 0, after_id
+        item_rows = [
+            (invoice_id, line_no, item["description"], item["quantity"], item["unit_price"], item["amount"])
+            for invoice_id, items in rows
+            for line_no, item in enumerate(parse_items_string(items or ""), 1)
+        ]
+        insert_item_rows(cur, item_rows)
+        return len(rows), len(item_rows), rows[-1][0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--skip-schema", action="store_true", help="Don't apply migrations/007_invoice_items.sql")
+    args = parser.parse_args(argv)
+
+    if not args.skip_schema:
+        apply_schema()
+    invoices = 0
+    items = 0
+    last_id = 0
+    while True:
+        count, written, last_id = backfill_batch(args.batch_size, last_id)
+        if not count:
+            break
+        invoices += count
+        items += written
+        print(f"Parsed {invoices} invoices, {items} line items (up to customer_id {last_id})", flush=True)
+    print(f"Done: {items} line items from {invoices} invoices.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
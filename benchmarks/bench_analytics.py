@@ -0,0 +1,123 @@
+"""
+Aggregate questions: columnar snapshot (db/analytics.py) versus the
+row-dict path (fetch_all_invoices + get_all_invoice_documents + Python loops).
+
+    python benchmarks/bench_analytics.py --sizes 10000 100000 1000000
+
+For each size, synthetic invoices are generated in memory, then both paths
+answer the same questions:
+  - average spend per customer last quarter
+  - total spend per month
+  - top 10 invoices by total
+The row path pays for building one dict and one Document string per
+invoice on every question, which is what the old chat path did. The snapshot
+path reports its one-off load time (append_rows) separately. No database is
+needed.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import datetime as dt
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.analytics import AnalyticsSnapshot  # noqa: E402
+
+CUSTOMERS = [f"Customer {i}" for i in range(2000)]
+SUPPLIERS = [f"Supplier {i}" for i in range(200)]
+QUARTER = (dt.date(2025, 1, 1), dt.date(2025, 3, 31))
+
+
+def synthetic_rows(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    start = dt.date(2023, 1, 1)
+    return [
+        (i, f"INV-{i:07d}", rng.choice(CUSTOMERS), rng.choice(SUPPLIERS),
+         start + dt.timedelta(days=rng.randrange(900)), f"{rng.uniform(50, 50000):.2f}")
+        for i in range(1, count + 1)
+    ]
+
+
+def row_path(rows: list) -> dict:
+    """Everything the old path did per question: dicts, Document text, then Python aggregation."""
+    timings = {}
+    start = time.perf_counter()
+    invoices = [
+        {"customer_id": r[0], "invoice_number": r[1], "customer": r[2], "supplier": r[3],
+         "invoice_date": r[4].isoformat(), "items": "N/A", "total_amount": r[5]}
+        for r in rows
+    ]
+    docs = [
+        f"Customer ID: {inv['customer_id']}\nInvoice Number: {inv['invoice_number']}\nCustomer: {inv['customer']}\n"
+        f"Supplier: {inv['supplier']}\nDate: {inv['invoice_date']}\nTotal Amount: {inv['total_amount']}"
+        for inv in invoices
+    ]
+    materialise = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sums, counts = defaultdict(float), defaultdict(int)
+    lo, hi = QUARTER[0].isoformat(), QUARTER[1].isoformat()
+    for inv in invoices:
+        if lo <= inv["invoice_date"] <= hi:
+            sums[inv["customer"]] += float(inv["total_amount"])
+            counts[inv["customer"]] += 1
+    sorted(((c, sums[c] / counts[c]) for c in sums), key=lambda x: -x[1])
+    timings["avg_per_customer_quarter"] = materialise + time.perf_counter() - start
+
+    start = time.perf_counter()
+    months = defaultdict(float)
+    for inv in invoices:
+        months[inv["invoice_date"][:7]] += float(inv["total_amount"])
+    sorted(months.items())
+    timings["sum_per_month"] = materialise + time.perf_counter() - start
+
+    start = time.perf_counter()
+    sorted(invoices, key=lambda inv: -float(inv["total_amount"]))[:10]
+    timings["top_10_invoices"] = materialise + time.perf_counter() - start
+    del docs
+    return timings
+
+
+def snapshot_path(rows: list):
+    snapshot = AnalyticsSnapshot(path=None)
+    start = time.perf_counter()
+    snapshot.append_rows(rows)
+    load = time.perf_counter() - start
+
+    timings = {}
+    start = time.perf_counter()
+    snapshot.group_by("customer", "mean", snapshot.mask(*QUARTER))
+    timings["avg_per_customer_quarter"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot.group_by("month", "sum")
+    timings["sum_per_month"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot.top_invoices(10)
+    timings["top_10_invoices"] = time.perf_counter() - start
+    return load, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        rows = synthetic_rows(size, args.seed)
+        rows_timings = row_path(rows)
+        load, snap_timings = snapshot_path(rows)
+        print(f"invoices={size} snapshot_load={load * 1000:.0f}ms")
+        for question, seconds in rows_timings.items():
+            fast = snap_timings[question]
+            print(f"  {question:<26} rows={seconds * 1000:9.1f}ms snapshot={fast * 1000:7.2f}ms "
+                  f"speedup={seconds / fast if fast else float('inf'):.0f}x")
+
+
+if __name__ == "__main__":
+    main()
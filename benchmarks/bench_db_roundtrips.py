@@ -0,0 +1,148 @@
+"""
+Round-trips per upload: one connection per insert (old db_handler) versus the
+pooled unit of work.
+
+An "upload" writes the invoice row, its image row and the first user/bot chat
+messages. For each path we count new connections (each is a TCP + auth
+handshake), statements, commits and wall time. Rows written by the benchmark
+are deleted afterwards.
+
+    python benchmarks/bench_db_roundtrips.py --uploads 50
+
+Needs the usual DB_HOST/DB_USER/DB_PASSWORD/DB_NAME environment.
+"""
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+import psycopg2
+from psycopg2.extensions import connection as _connection, cursor as _cursor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import db_handler  # noqa: E402
+
+COUNTS = {"connects": 0, "statements": 0, "commits": 0}
+
+
+class CountingCursor(_cursor):
+    def execute(self, query, vars=None):
+        COUNTS["statements"] += 1
+        return super().execute(query, vars)
+
+
+class CountingConnection(_connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        COUNTS["connects"] += 1
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        COUNTS["commits"] += 1
+        return super().commit()
+
+
+SAMPLE = {
+    "invoice_number": "BENCH-0001",
+    "customer": "Bench Customer",
+    "supplier": "Bench Supplier",
+    "invoice_date": "2025-05-06",
+    "total_amount": "100.00",
+    "items": "Widget",
+    "vector_embedding": None,
+}
+
+
+def _connect():
+    return psycopg2.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT", "5432"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        dbname=os.getenv("DB_NAME"),
+        connection_factory=CountingConnection
+    )
+
+
+def _legacy_execute(query, params, returning=True):
+    # Mirrors the pre-pool db_handler: connect, execute, commit, close per call.
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute(query, params)
+    result = cur.fetchone()[0] if returning else None
+    conn.commit()
+    cur.close()
+    conn.close()
+    return result
+
+
+def upload_before():
+    invoice_id = _legacy_execute(
+        """INSERT INTO data_of_invoices
+        (invoice_number, customer, supplier, invoice_date, total_amount, items, vector_embedding)
+        VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING customer_id;""",
+        tuple(SAMPLE.values())
+    )
+    _legacy_execute(
+        "INSERT INTO data_invoices_images (invoice_id, image_path, ocr_text) VALUES (%s, %s, %s) RETURNING id;",
+        (invoice_id, "bench.png", "bench")
+    )
+    for role in ("user", "bot"):
+        _legacy_execute(
+            "INSERT INTO chat_history (invoice_id, role, content, timestamp) VALUES (%s, %s, %s, %s)",
+            (invoice_id, role, "bench", datetime.utcnow()),
+            returning=False
+        )
+    return invoice_id
+
+
+def upload_after():
+    with db_handler.unit_of_work() as conn:
+        invoice_id = db_handler.insert_invoice(SAMPLE, conn=conn)
+        db_handler.insert_invoice_image(invoice_id, "bench.png", "bench", conn=conn)
+        db_handler.insert_chat_message(invoice_id, "user", "bench", datetime.utcnow(), conn=conn)
+        db_handler.insert_chat_message(invoice_id, "bot", "bench", datetime.utcnow(), conn=conn)
+    return invoice_id
+
+
+def run(label, upload, n):
+    for key in COUNTS:
+        COUNTS[key] = 0
+    ids = []
+    start = time.perf_counter()
+    for _ in range(n):
+        ids.append(upload())
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<8} connects/upload={COUNTS['connects'] / n:.2f} "
+        f"statements/upload={COUNTS['statements'] / n:.2f} "
+        f"commits/upload={COUNTS['commits'] / n:.2f} "
+        f"ms/upload={elapsed * 1000 / n:.2f}"
+    )
+    return ids
+
+
+def cleanup(ids):
+    with db_handler.unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM chat_history WHERE invoice_id = ANY(%s)", (ids,))
+        cur.execute("DELETE FROM data_invoices_images WHERE invoice_id = ANY(%s)", (ids,))
+        cur.execute("DELETE FROM data_of_invoices WHERE customer_id = ANY(%s)", (ids,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=50)
+    args = parser.parse_args()
+
+    db_handler.init_pool(connection_factory=CountingConnection)
+    ids = run("before", upload_before, args.uploads)
+    ids += run("after", upload_after, args.uploads)
+    cleanup(ids)
+
+
+if __name__ == "__main__":
+    main()
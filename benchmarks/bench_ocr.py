@@ -0,0 +1,130 @@
+"""
+OCR wall time and character accuracy: raw pytesseract versus the
+preprocessed path in img2text (DPI scaling, binarization, deskew, crop,
+PSM/OEM selection).
+
+    python benchmarks/bench_ocr.py --samples 10
+    python benchmarks/bench_ocr.py --dir path/to/samples
+
+With --dir, every image with a same-named .txt file next to it is used, and
+the .txt holds the expected text. Without it, synthetic invoices are rendered
+and degraded to look like phone photos (upscaled, rotated, grey background,
+noise, JPEG). Accuracy is 1 - edit distance / reference length, compared
+after collapsing whitespace.
+
+Needs the tesseract binary on PATH.
+"""
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import numpy as np
+import pytesseract
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from img2text.img2text import ocr_image  # noqa: E402
+
+ITEMS = ["Shoes", "Kurta", "Headphones", "Burger", "Notebook", "Charger", "Water Bottle", "Backpack"]
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def char_accuracy(reference: str, hypothesis: str) -> float:
+    reference, hypothesis = normalize(reference), normalize(hypothesis)
+    if not reference:
+        return 1.0 if not hypothesis else 0.0
+    return max(0.0, 1 - edit_distance(reference, hypothesis) / len(reference))
+
+
+def synthetic_invoice(rng: random.Random):
+    """Render a clean A4 invoice at 150 DPI, then degrade it like a phone photo."""
+    lines = [
+        f"INVOICE INV-{rng.randint(1000, 9999)}",
+        f"Date: {rng.randint(1, 28):02d}-{rng.randint(1, 12):02d}-2025",
+        f"Supplier: {rng.choice(['Amazon India', 'Flipkart', 'Reliance Retail'])}",
+        f"Customer: {rng.choice(['K. Patel', 'Ravi Kumar', 'Neha Joshi', 'N. Singh'])}",
+        "",
+    ]
+    total = 0.0
+    for _ in range(rng.randint(4, 12)):
+        qty, price = rng.randint(1, 5), rng.randint(50, 5000) / 10
+        total += qty * price
+        lines.append(f"{rng.choice(ITEMS):<14} x{qty}  {price:>8.2f}  {qty * price:>9.2f}")
+    lines += ["", f"Total Amount: {total:.2f}"]
+
+    page = Image.new("L", (1240, 1754), 255)
+    draw = ImageDraw.Draw(page)
+    font = ImageFont.load_default(size=26)
+    for i, line in enumerate(lines):
+        draw.text((110, 140 + i * 44), line, fill=0, font=font)
+
+    photo = page.rotate(rng.uniform(-3, 3), expand=True, fillcolor=255, resample=Image.BICUBIC)
+    photo = photo.resize((int(photo.width * 2.4), int(photo.height * 2.4)), Image.BICUBIC)
+    pixels = np.asarray(photo, dtype=np.float64) * 0.8 + 30
+    pixels += np.random.default_rng(rng.randint(0, 2 ** 31)).normal(0, 12, pixels.shape)
+    photo = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).convert("RGB")
+    buffer = io.BytesIO()
+    photo.save(buffer, "JPEG", quality=80)
+    buffer.seek(0)
+    return Image.open(buffer), "\n".join(lines)
+
+
+def load_samples(directory: str):
+    for name in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(name)
+        truth = os.path.join(directory, stem + ".txt")
+        if ext.lower() in (".png", ".jpg", ".jpeg") and os.path.exists(truth):
+            with open(truth, "r", encoding="utf-8") as f:
+                yield Image.open(os.path.join(directory, name)), f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=10, help="Synthetic invoices to render")
+    parser.add_argument("--dir", help="Directory of images with .txt ground truth")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.dir:
+        samples = list(load_samples(args.dir))
+    else:
+        rng = random.Random(args.seed)
+        samples = [synthetic_invoice(rng) for _ in range(args.samples)]
+
+    results = {"raw": ([], []), "preprocessed": ([], [])}
+    for image, truth in samples:
+        image.load()
+        start = time.perf_counter()
+        text = pytesseract.image_to_string(image)
+        results["raw"][0].append(time.perf_counter() - start)
+        results["raw"][1].append(char_accuracy(truth, text))
+
+        start = time.perf_counter()
+        text = ocr_image(image, preprocess=True, tile_workers=0)
+        results["preprocessed"][0].append(time.perf_counter() - start)
+        results["preprocessed"][1].append(char_accuracy(truth, text))
+
+    print(f"samples={len(samples)}")
+    for name, (times, accuracies) in results.items():
+        print(f"{name:<13} mean={np.mean(times):.2f}s p95={np.percentile(times, 95):.2f}s "
+              f"total={np.sum(times):.1f}s char_accuracy={np.mean(accuracies):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Offline end-to-end scenarios: ingest throughput, chat latency and memory
+per query as the corpus grows. No Gemini key, model download or Streamlit
+is needed; see harness.py for the fakes and the disposable database.
+
+    python benchmarks/bench_scenarios.py                       # 100, 10k, 100k invoices
+    python benchmarks/bench_scenarios.py --sizes 100 1000 --questions 50
+    python benchmarks/bench_scenarios.py --scenarios chat --llm-latency 0.3
+
+For each corpus size the database is emptied, then:
+  ingest  --uploads rendered images go through the upload path (jobs
+          table, process_job: OCR, extraction, embedding, insert) on
+          --upload-workers threads; the rest of the corpus is bulk-loaded
+          with insert_invoices_bulk. Reports invoices/s for both.
+  chat    a fixed mix of SQL-routed, analytics, item, retrieval+LLM and
+          follow-up questions through ChatTurn (what the app runs), plus a
+          few through run_query. Reports the cold first question, p50/p90/p99
+          latency and time to first token, overall and per route, and the
+          peak Python allocation per query (tracemalloc, separate pass).
+The corpus is always loaded, so "--scenarios chat" still bulk-loads it
+(just without reporting ingest numbers).
+
+Results go to benchmarks/results/scenarios-<UTC timestamp>.json together
+with the commit, settings and the per-stage timings from metrics.py, so
+runs can be compared over time.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import harness  # noqa: F401  (sets up paths and env before project imports)
+from harness import (  # noqa: E402
+    WORK_DIR, SyntheticCorpus, DisposablePostgres, install_fake_llm, install_fake_embeddings,
+    install_fake_ocr, reset_caches, latency_summary, max_rss_mb, write_results,
+)
+
+QUESTION_TEMPLATES = [
+    # (expected route, template)
+    ("sql", "What is the total amount of all invoices?"),
+    ("sql", "What is the average invoice total?"),
+    ("sql", "Summarize invoice number {invoice_number}"),
+    ("sql", "Show the {position} invoice"),
+    ("analytics", "Total spend per customer"),
+    ("analytics", "Top 5 suppliers"),
+    ("analytics", "Total spend by month"),
+    ("items", "Which invoices contain {item}?"),
+    ("items", "How much was spent on {item}?"),
+    ("llm", "What did {customer} buy from {supplier}?"),
+    ("llm", "Which invoices from {supplier} look unusually expensive?"),
+    ("llm", "Give me a short summary of what {customer} usually buys"),
+]
+FOLLOWUPS = ["What was its total?", "Who was the supplier?"]
+
+
+def ordinal(n: int) -> str:
+    suffix = "th" if 10 <= n % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th")
+    return f"{n}{suffix}"
+
+
+def make_questions(corpus: SyntheticCorpus, count: int, seed: int) -> list:
+    """(expected route, question) pairs; every fifth question is a follow-up."""
+    rng = random.Random(seed)
+    questions = []
+    while len(questions) < count:
+        if questions and len(questions) % 5 == 4:
+            questions.append(("followup", rng.choice(FOLLOWUPS)))
+            continue
+        route, template = rng.choice(QUESTION_TEMPLATES)
+        invoice = rng.choice(corpus.invoices)
+        questions.append((route, template.format(
+            invoice_number=invoice["invoice_number"],
+            position=ordinal(rng.randint(1, corpus.size)),
+            item=rng.choice(invoice["line_items"])["description"],
+            customer=invoice["customer"],
+            supplier=invoice["supplier"],
+        )))
+    return questions
+
+
+# --- Loading ---
+def to_record(invoice: dict):
+    from db.invoice_items import items_summary
+    from db.invoice_record import Invoice
+    return Invoice(
+        invoice_number=invoice["invoice_number"], customer=invoice["customer"], supplier=invoice["supplier"],
+        invoice_date=invoice["invoice_date"], items=items_summary(invoice["line_items"]),
+        total_amount=invoice["total_amount"], line_items=invoice["line_items"],
+    )
+
+
+def bulk_load(invoices: list, batch_size: int) -> dict:
+    import json
+    from llm.embeddings import get_embedding_service, invoice_embedding_text
+    from db.db_handler import insert_invoices_bulk, unit_of_work
+    embed_seconds = insert_seconds = 0.0
+    for start in range(0, len(invoices), batch_size):
+        records = [to_record(invoice) for invoice in invoices[start:start + batch_size]]
+        t0 = time.perf_counter()
+        vectors = get_embedding_service().embed_batch([invoice_embedding_text(r) for r in records])
+        for record, vector in zip(records, vectors):
+            record.vector_embedding = json.dumps(vector)
+        t1 = time.perf_counter()
+        with unit_of_work() as conn:
+            insert_invoices_bulk(records, conn=conn)
+        insert_seconds += time.perf_counter() - t1
+        embed_seconds += t1 - t0
+    total = embed_seconds + insert_seconds
+    return {
+        "invoices": len(invoices),
+        "seconds": round(total, 3),
+        "invoices_per_second": round(len(invoices) / total, 1) if total else 0.0,
+        "embed_seconds": round(embed_seconds, 3),
+        "insert_seconds": round(insert_seconds, 3),
+    }
+
+
+def upload(corpus: SyntheticCorpus, invoices: list, workers: int) -> dict:
+    """Render, queue and process uploads the way the app and ingest_worker do."""
+    from db.blob_store import image_hashes
+    from db.jobs import enqueue_job, claim_job
+    from ingest_worker import process_job
+    upload_dir = os.path.join(WORK_DIR, f"uploads-{corpus.size}")
+    os.makedirs(upload_dir, exist_ok=True)
+    texts = {}
+    render_start = time.perf_counter()
+    for invoice in invoices:
+        path = os.path.join(upload_dir, invoice["invoice_number"] + ".png")
+        corpus.render(invoice, path)
+        texts[path] = corpus.ocr_text(invoice)
+    render_seconds = time.perf_counter() - render_start
+    install_fake_ocr(texts)
+
+    for path in texts:
+        digest, phash = image_hashes(path)
+        enqueue_job(path, os.path.basename(path), digest, phash)
+
+    latencies, failures = [], []
+
+    def worker():
+        while True:
+            job = claim_job()
+            if job is None:
+                return
+            t0 = time.perf_counter()
+            try:
+                process_job(*job)
+                latencies.append(time.perf_counter() - t0)
+            except Exception as e:
+                failures.append(str(e))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(worker) for _ in range(workers)]:
+            future.result()
+    seconds = time.perf_counter() - start
+    return {
+        "invoices": len(latencies),
+        "failed": len(failures),
+        "workers": workers,
+        "seconds": round(seconds, 3),
+        "invoices_per_second": round(len(latencies) / seconds, 2) if seconds else 0.0,
+        "per_upload": latency_summary(latencies),
+        "render_seconds": round(render_seconds, 3),
+    }
+
+
+# --- Chat ---
+def run_questions(questions: list, measure_memory: bool = False) -> list:
+    """Run the questions through ChatTurn in conversations of five turns."""
+    from llm.query_llm import ChatTurn
+    from llm.followup import new_session
+    samples = []
+    session, history = new_session(), []
+    for i, (expected, question) in enumerate(questions):
+        if i % 5 == 0:
+            session, history = new_session(), []
+        if measure_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        turn = ChatTurn(question, history, session)
+        for _ in turn.stream():
+            pass
+        seconds = time.perf_counter() - t0
+        history = turn.history
+        sample = {"expected": expected, "route": turn.timing["route"], "seconds": seconds,
+                  "ttft": turn.timing.get("ttft", seconds), "llm_calls": turn.timing["llm_calls"]}
+        if measure_memory:
+            sample["peak_kb"] = (tracemalloc.get_traced_memory()[1] - baseline) / 1024
+        samples.append(sample)
+    return samples
+
+
+def chat_scenario(corpus: SyntheticCorpus, args) -> dict:
+    from llm.query_llm import run_query
+    questions = make_questions(corpus, args.questions, args.seed)
+
+    t0 = time.perf_counter()
+    run_questions([("sql", "How many invoices are there?")])
+    cold_seconds = time.perf_counter() - t0  # first question: index and snapshot load
+
+    samples = run_questions(questions)
+    result = {
+        "cold_first_question_ms": round(cold_seconds * 1000, 3),
+        "questions": len(samples),
+        "latency": latency_summary([s["seconds"] for s in samples]),
+        "ttft": latency_summary([s["ttft"] for s in samples]),
+        "llm_calls": sum(s["llm_calls"] for s in samples),
+        "by_route": {},
+        "by_question_type": {},
+    }
+    for key, field in (("by_route", "route"), ("by_question_type", "expected")):
+        for name in sorted({s[field] for s in samples}):
+            group = [s["seconds"] for s in samples if s[field] == name]
+            result[key][name] = latency_summary(group)
+
+    query_latencies = []
+    for _, question in questions[:max(1, args.questions // 10)]:
+        t0 = time.perf_counter()
+        run_query(question)
+        query_latencies.append(time.perf_counter() - t0)
+    result["run_query"] = latency_summary(query_latencies)
+
+    if args.memory_questions:
+        tracemalloc.start()
+        memory_samples = run_questions(questions[:args.memory_questions], measure_memory=True)
+        tracemalloc.stop()
+        peaks = [s["peak_kb"] for s in memory_samples]
+        result["memory_per_query_kb"] = {
+            "mean": round(sum(peaks) / len(peaks), 1),
+            "max": round(max(peaks), 1),
+            "by_route": {
+                route: round(max(s["peak_kb"] for s in memory_samples if s["route"] == route), 1)
+                for route in sorted({s["route"] for s in memory_samples})
+            },
+        }
+    return result
+
+
+def run_size(pg: DisposablePostgres, size: int, args) -> dict:
+    import metrics
+    pg.reset()
+    reset_caches()
+    metrics._metrics = None
+    corpus = SyntheticCorpus(size, seed=args.seed)
+    result = {"size": size}
+
+    uploads = min(args.uploads, size) if "ingest" in args.scenarios else 0
+    if uploads:
+        result["upload"] = upload(corpus, corpus.invoices[:uploads], args.upload_workers)
+    bulk = bulk_load(corpus.invoices[uploads:], args.batch_size)
+    if "ingest" in args.scenarios:
+        result["bulk"] = bulk
+
+    if "chat" in args.scenarios:
+        result["chat"] = chat_scenario(corpus, args)
+    result["stages"] = metrics.get_metrics().snapshot()["stages"]
+    result["max_rss_mb"] = max_rss_mb()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--scenarios", nargs="+", choices=["ingest", "chat"], default=["ingest", "chat"])
+    parser.add_argument("--uploads", type=int, default=50, help="Invoices sent through the upload path per size")
+    parser.add_argument("--upload-workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1000, help="Bulk-load batch size")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--memory-questions", type=int, default=50, help="Questions re-run under tracemalloc; 0 = skip")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Simulated seconds per Gemini call")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="Simulated seconds per streamed chunk")
+    parser.add_argument("--real-embeddings", action="store_true", help="Use the sentence-transformers model")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results"))
+    parser.add_argument("--keep-db", action="store_true")
+    args = parser.parse_args(argv)
+
+    install_fake_llm(args.llm_latency, args.token_latency)
+    if not args.real_embeddings:
+        install_fake_embeddings()
+
+    results = []
+    with DisposablePostgres(keep=args.keep_db) as pg:
+        for size in args.sizes:
+            print(f"--- {size} invoices ---", flush=True)
+            result = run_size(pg, size, args)
+            results.append(result)
+            for name in ("upload", "bulk"):
+                if name in result:
+                    print(f"  {name:<7} {result[name]['invoices_per_second']} invoices/s")
+            if "chat" in result:
+                chat = result["chat"]
+                print(f"  chat    p50={chat['latency']['p50_ms']}ms p99={chat['latency']['p99_ms']}ms "
+                      f"cold={chat['cold_first_question_ms']}ms")
+        skipped = pg.skipped_migrations
+
+    path = write_results(args.out, "scenarios", {
+        "settings": {k: v for k, v in vars(args).items() if k != "out"},
+        "skipped_migrations": skipped,
+        "sizes": results,
+    })
+    print(f"Results written to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
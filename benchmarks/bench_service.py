@@ -0,0 +1,165 @@
+"""
+Load test for the multi-user service (service.ChatService): memory and
+latency as concurrent chat sessions grow, with several tenants sharing one
+process. Offline like bench_scenarios.py (fake Gemini, fake embeddings,
+disposable Postgres).
+
+    python benchmarks/bench_service.py
+    python benchmarks/bench_service.py --tenants 4 --sessions 1 10 100 1000 --max-sessions 200
+
+Each tenant gets its own corpus of --invoices invoices. For every entry of
+--sessions, that many new conversations (spread round-robin over the
+tenants) each ask --turns questions on --concurrency threads. After each
+step the process RSS, live Python memory (tracemalloc) and the number of
+sessions, indexes and snapshots held are recorded. With the model, pool
+and per-tenant indexes shared and sessions capped (--max-sessions) the
+memory should level off instead of growing with the session count.
+Every answer is also checked to only mention the asking tenant's invoices.
+
+Results go to benchmarks/results/service-<UTC timestamp>.json.
+"""
+import os
+import re
+import sys
+import gc
+import time
+import argparse
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import harness  # noqa: F401  (sets up paths and env before project imports)
+from harness import (  # noqa: E402
+    SyntheticCorpus, DisposablePostgres, install_fake_llm, install_fake_embeddings,
+    reset_caches, latency_summary, max_rss_mb, write_results,
+)
+from bench_scenarios import make_questions, bulk_load  # noqa: E402
+
+INVOICE_NUMBER_RE = re.compile(r"\bINV-\d{9}\b")
+
+
+def current_rss_mb() -> float:
+    """Resident set size now (max_rss_mb is the peak, which never goes down)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):
+        return max_rss_mb()
+
+
+def load_tenants(tenants: list, invoices: int, seed: int) -> dict:
+    """One corpus per tenant; the seed is part of the invoice number, so numbers never repeat across tenants."""
+    from db.tenants import use_tenant
+    corpora = {}
+    for i, tenant_id in enumerate(tenants):
+        corpus = SyntheticCorpus(invoices, seed=seed + i)
+        with use_tenant(tenant_id):
+            bulk_load(corpus.invoices, 1000)
+        corpora[tenant_id] = corpus
+    return corpora
+
+
+def run_step(service, corpora: dict, sessions: int, args, offset: int) -> dict:
+    tenants = list(corpora)
+    foreign = {
+        tenant_id: {inv["invoice_number"] for other, corpus in corpora.items() if other != tenant_id
+                    for inv in corpus.invoices}
+        for tenant_id in tenants
+    }
+    latencies, leaks, failures = [], [], []
+
+    def conversation(n: int):
+        tenant_id = tenants[n % len(tenants)]
+        session_id = None
+        for _, question in make_questions(corpora[tenant_id], args.turns, args.seed + offset + n):
+            t0 = time.perf_counter()
+            try:
+                reply = service.chat(tenant_id, question, session_id)
+            except Exception as e:
+                failures.append(str(e))
+                return
+            latencies.append(time.perf_counter() - t0)
+            session_id = reply["session_id"]
+            mentioned = set(INVOICE_NUMBER_RE.findall(reply["answer"] or ""))
+            leaks.extend(mentioned & foreign[tenant_id])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for future in [pool.submit(conversation, n) for n in range(sessions)]:
+            future.result()
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": round(seconds, 3),
+        "turns": len(latencies),
+        "failed": len(failures),
+        "cross_tenant_leaks": len(leaks),
+        "latency": latency_summary(latencies),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenants", type=int, default=3)
+    parser.add_argument("--invoices", type=int, default=1000, help="Invoices per tenant")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 50, 100, 200, 500])
+    parser.add_argument("--turns", type=int, default=5, help="Questions per session")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--max-sessions", type=int, default=100, help="SessionStore cap")
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--token-latency", type=float, default=0.002)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results"))
+    parser.add_argument("--keep-db", action="store_true")
+    args = parser.parse_args(argv)
+
+    install_fake_llm(args.llm_latency, args.token_latency)
+    install_fake_embeddings()
+
+    steps = []
+    with DisposablePostgres(keep=args.keep_db) as pg:
+        pg.reset()
+        reset_caches()
+        from service import ChatService, SessionStore
+        from llm import vector_index
+        from db import analytics
+        tenant_ids = [f"tenant{i}" for i in range(args.tenants)]
+        print(f"Loading {args.invoices} invoices for each of {args.tenants} tenants", flush=True)
+        corpora = load_tenants(tenant_ids, args.invoices, args.seed)
+        service = ChatService(SessionStore(max_sessions=args.max_sessions))
+
+        tracemalloc.start()
+        gc.collect()
+        baseline = {"rss_mb": current_rss_mb(), "python_mb": round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 1)}
+        offset = 0
+        for sessions in args.sessions:
+            step = {"sessions": sessions, **run_step(service, corpora, sessions, args, offset)}
+            offset += sessions
+            gc.collect()
+            step.update({
+                "rss_mb": current_rss_mb(),
+                "python_mb": round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 1),
+                "sessions_held": len(service.sessions),
+                "sessions_evicted": service.sessions.evicted,
+                "indexes_held": len(vector_index._indexes),
+                "snapshots_held": len(analytics._snapshots),
+            })
+            steps.append(step)
+            print(f"  {sessions:>5} sessions: p50={step['latency']['p50_ms']}ms p99={step['latency']['p99_ms']}ms "
+                  f"rss={step['rss_mb']}MB python={step['python_mb']}MB held={step['sessions_held']} "
+                  f"leaks={step['cross_tenant_leaks']}", flush=True)
+        tracemalloc.stop()
+        skipped = pg.skipped_migrations
+
+    path = write_results(args.out, "service", {
+        "settings": {k: v for k, v in vars(args).items() if k != "out"},
+        "skipped_migrations": skipped,
+        "baseline": baseline,
+        "steps": steps,
+        "max_rss_mb": max_rss_mb(),
+    })
+    print(f"Results written to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
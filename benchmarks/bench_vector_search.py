@@ -0,0 +1,100 @@
+"""
+pgvector (HNSW, in PostgreSQL) versus the in-process FAISS path.
+
+Loads N random 384-d vectors into a scratch table and into a flat FAISS index
+(what langchain's FAISS wrapper uses), runs the same queries against both and
+reports p50/p95 latency and pgvector's recall@k against FAISS's exact result.
+Also reports the time to build the FAISS index from scratch, which is what
+the old per-request path paid on every chat turn.
+
+    python benchmarks/bench_vector_search.py --rows 10000 --queries 200 --k 8
+
+Needs a PostgreSQL with the vector extension and the usual DB_* environment.
+The scratch table bench_vectors is dropped afterwards.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import faiss
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.db_handler import unit_of_work, get_connection  # noqa: E402
+from db.pgvector_store import to_pgvector, EMBEDDING_DIM  # noqa: E402
+from psycopg2.extras import execute_values  # noqa: E402
+
+
+def percentile(values, pct):
+    return float(np.percentile(values, pct)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = rng.standard_normal((args.rows, EMBEDDING_DIM)).astype("float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = rng.standard_normal((args.queries, EMBEDDING_DIM)).astype("float32")
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    start = time.perf_counter()
+    index = faiss.IndexFlatL2(EMBEDDING_DIM)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - start
+
+    faiss_times = []
+    exact = []
+    for q in queries:
+        start = time.perf_counter()
+        _, ids = index.search(q.reshape(1, -1), args.k)
+        faiss_times.append(time.perf_counter() - start)
+        exact.append(set(ids[0].tolist()))
+
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+        cur.execute("DROP TABLE IF EXISTS bench_vectors;")
+        cur.execute(f"CREATE TABLE bench_vectors (id INT PRIMARY KEY, embedding vector({EMBEDDING_DIM}));")
+        execute_values(
+            cur,
+            "INSERT INTO bench_vectors (id, embedding) VALUES %s",
+            [(i, to_pgvector(v)) for i, v in enumerate(vectors)],
+            page_size=1000
+        )
+        start = time.perf_counter()
+        cur.execute("CREATE INDEX ON bench_vectors USING hnsw (embedding vector_l2_ops);")
+        hnsw_build_seconds = time.perf_counter() - start
+
+    pg_times = []
+    recalls = []
+    try:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SET hnsw.ef_search = %s;", (max(64, args.k),))
+            for q, truth in zip(queries, exact):
+                literal = to_pgvector(q)
+                start = time.perf_counter()
+                cur.execute(
+                    "SELECT id FROM bench_vectors ORDER BY embedding <-> %s::vector LIMIT %s;",
+                    (literal, args.k)
+                )
+                found = {row[0] for row in cur.fetchall()}
+                pg_times.append(time.perf_counter() - start)
+                recalls.append(len(found & truth) / args.k)
+    finally:
+        with unit_of_work() as conn, conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS bench_vectors;")
+
+    print(f"rows={args.rows} queries={args.queries} k={args.k}")
+    print(f"faiss    build={build_seconds * 1000:.1f}ms p50={percentile(faiss_times, 50):.3f}ms p95={percentile(faiss_times, 95):.3f}ms")
+    print(f"pgvector build={hnsw_build_seconds * 1000:.1f}ms p50={percentile(pg_times, 50):.3f}ms p95={percentile(pg_times, 95):.3f}ms "
+          f"recall@{args.k}={np.mean(recalls):.3f}")
+
+
+if __name__ == "__main__":
+    main()
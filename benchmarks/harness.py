@@ -0,0 +1,489 @@
+"""
+Shared pieces for the offline benchmark scenarios (bench_scenarios.py):
+
+  - SyntheticCorpus: deterministic invoices as rows, OCR-style text and
+    rendered PNGs.
+  - FakeGeminiModel: a local stand-in for the Gemini model behind
+    GeminiClient. It answers extraction prompts with the JSON that the OCR
+    text implies, condense prompts with the question, and chat prompts with a
+    streamed answer, after a fixed simulated latency. It reports
+    usage_metadata like the real API.
+  - FakeEmbeddingService: hashed bag-of-words vectors instead of the
+    sentence-transformers model (--real-embeddings keeps the model).
+  - DisposablePostgres: a throwaway database with the repo schema and
+    migrations applied, on a temporary initdb cluster when the PostgreSQL
+    binaries are on PATH, otherwise as a scratch database on the DB_* server.
+
+Import this module before any project module: it points the on-disk state
+(FAISS index, analytics snapshot, blob store) at a temporary directory.
+"""
+import os
+import re
+import sys
+import glob
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import asyncio
+import hashlib
+import tempfile
+import subprocess
+import datetime as dt
+from langchain.embeddings.base import Embeddings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORK_DIR = tempfile.mkdtemp(prefix="invoice-bench-")
+os.environ.setdefault("INVOICE_INDEX_DIR", os.path.join(WORK_DIR, "faiss_index"))
+os.environ.setdefault("ANALYTICS_SNAPSHOT_PATH", os.path.join(WORK_DIR, "analytics_snapshot.npz"))
+os.environ.setdefault("BLOB_DIR", os.path.join(WORK_DIR, "blob_store"))
+os.environ.setdefault("LLM_CACHE_BACKEND", "memory")
+os.environ.setdefault("INGEST_WORKERS", "0")
+os.environ.setdefault("GEMINI_RATE_LIMIT", "0")
+
+MIGRATIONS_DIR = os.path.join(ROOT, "migrations")
+# The base tables are created by hand in a normal install (see README); the
+# migrations only alter them.
+BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS data_of_invoices (
+    customer_id SERIAL PRIMARY KEY,
+    invoice_number TEXT,
+    customer TEXT,
+    supplier TEXT,
+    invoice_date DATE,
+    items TEXT,
+    total_amount NUMERIC(12,2),
+    vector_embedding TEXT,
+    uploaded_at TIMESTAMP DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS data_invoices_images (
+    id SERIAL PRIMARY KEY,
+    invoice_id INT REFERENCES data_of_invoices (customer_id) ON DELETE CASCADE,
+    image_path TEXT,
+    ocr_text TEXT,
+    uploaded_at TIMESTAMP DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS chat_history (
+    id SERIAL PRIMARY KEY,
+    invoice_id INT,
+    role TEXT,
+    content TEXT,
+    timestamp TIMESTAMP
+);
+"""
+RESET_TABLES = ("invoice_items", "data_invoices_images", "chat_history", "ingest_jobs", "llm_cache", "data_of_invoices")
+
+FIRST_NAMES = ["Aarav", "Neha", "Ravi", "Kiran", "Priya", "Jacob", "Anita", "Vikram", "Sara", "Imran", "Meera", "Rahul"]
+LAST_NAMES = ["Patel", "Joshi", "Kumar", "Singh", "John", "Shah", "Iyer", "Khan", "Rao", "Das", "Mehta", "Nair"]
+SUPPLIERS = ["Amazon India", "Flipkart", "Reliance Retail", "Croma", "BigBasket", "Myntra", "Tata Cliq", "DMart",
+             "Nykaa", "Decathlon", "Lenskart", "Pepperfry", "Ajio", "Snapdeal", "Meesho", "JioMart"]
+CATALOGUE = [("Shoes", 2499), ("Kurta", 899), ("Headphones", 1299), ("Burger", 120), ("Notebook", 60),
+             ("Charger", 799), ("Water Bottle", 349), ("Backpack", 1599), ("Battery", 45), ("Jeans", 1799),
+             ("Coffee Beans", 650), ("Desk Lamp", 1199), ("Yoga Mat", 999), ("Sunglasses", 1499), ("Rice 5kg", 420)]
+FIRST_DATE = dt.date(2024, 1, 1)
+LAST_DATE = dt.date(2025, 5, 6)  # the app's fixed "today"
+
+
+# --- Synthetic corpus ---
+class SyntheticCorpus:
+    """
+    Deterministic invoices for a given size and seed. About one customer per
+    20 invoices, so per-customer questions stay meaningful as the corpus grows.
+    """
+
+    def __init__(self, size: int, seed: int = 0):
+        self.size = size
+        self.seed = seed
+        rng = random.Random(seed)
+        customer_count = max(5, size // 20)
+        # "Neha Joshi", ..., then "Neha Joshi 2" once the 144 pairs run out.
+        self.customers = [
+            f"{FIRST_NAMES[i % 12]} {LAST_NAMES[(i // 12) % 12]}" + (f" {i // 144 + 1}" if i >= 144 else "")
+            for i in range(customer_count)
+        ]
+        self.invoices = [self._invoice(rng, i) for i in range(size)]
+
+    def _invoice(self, rng: random.Random, i: int) -> dict:
+        line_items = []
+        for _ in range(rng.randint(1, 6)):
+            description, price = rng.choice(CATALOGUE)
+            quantity = rng.randint(1, 4)
+            line_items.append({"description": description, "quantity": quantity,
+                               "unit_price": float(price), "amount": float(price * quantity)})
+        day = FIRST_DATE + dt.timedelta(days=rng.randint(0, (LAST_DATE - FIRST_DATE).days))
+        return {
+            "invoice_number": f"INV-{self.seed:02d}{i + 1:07d}",
+            "customer": rng.choice(self.customers),
+            "supplier": rng.choice(SUPPLIERS),
+            "invoice_date": day,
+            "line_items": line_items,
+            "total_amount": round(sum(item["amount"] for item in line_items), 2),
+        }
+
+    @staticmethod
+    def ocr_text(invoice: dict) -> str:
+        """What a clean OCR pass over the rendered invoice reads."""
+        lines = [
+            f"INVOICE {invoice['invoice_number']}",
+            f"Date: {invoice['invoice_date']:%d-%m-%Y}",
+            f"Supplier: {invoice['supplier']}",
+            f"Customer: {invoice['customer']}",
+            "",
+        ]
+        for item in invoice["line_items"]:
+            lines.append(f"{item['description']} x{item['quantity']} @ {item['unit_price']:.2f} = {item['amount']:.2f}")
+        lines += ["", f"Total Amount: ₹{invoice['total_amount']:,.2f}"]
+        return "\n".join(lines)
+
+    def render(self, invoice: dict, path: str):
+        """A small A4-proportioned PNG of the invoice text."""
+        from PIL import Image, ImageDraw
+        page = Image.new("L", (620, 877), 255)
+        draw = ImageDraw.Draw(page)
+        for i, line in enumerate(self.ocr_text(invoice).replace("₹", "Rs.").splitlines()):
+            draw.text((40, 50 + i * 22), line, fill=0)
+        page.save(path)
+
+
+# --- Fake LLM ---
+class _Usage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.cached_content_token_count = 0
+
+
+class _Response:
+    def __init__(self, text: str, usage: _Usage = None):
+        self.text = text
+        self.usage_metadata = usage
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class FakeGeminiModel:
+    """
+    Drop-in for genai.GenerativeModel inside GeminiClient. Deterministic: the
+    same prompt always gets the same answer. `latency` seconds per call, plus
+    `token_latency` per streamed chunk.
+    """
+
+    LINE_RE = re.compile(r"^(.+?) x(\d+) @ ([\d.]+) = ([\d.]+)$", re.M)
+
+    def __init__(self, latency: float = 0.05, token_latency: float = 0.002, answer_words: int = 40):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.answer_words = answer_words
+        self.calls = 0
+
+    def respond(self, prompt: str) -> str:
+        if "OCR Text:" in prompt:
+            return self._extract(prompt.split("OCR Text:", 1)[1])
+        if "Rephrased Question:" in prompt:
+            return prompt.rsplit("Question:", 2)[-2].split("\n")[0].strip()
+        return self._answer(prompt)
+
+    def _extract(self, text: str) -> str:
+        def field(pattern):
+            match = re.search(pattern, text, re.M)
+            return match.group(1).strip() if match else "N/A"
+        items = [
+            {"description": d, "quantity": int(q), "unit_price": float(p), "amount": float(a)}
+            for d, q, p, a in self.LINE_RE.findall(text)
+        ]
+        return json.dumps({
+            "invoice_number": field(r"^INVOICE (\S+)"),
+            "invoice_date": field(r"^Date: (.+)$"),
+            "total_amount": field(r"^Total Amount: (.+)$"),
+            "supplier": field(r"^Supplier: (.+)$"),
+            "customer": field(r"^Customer: (.+)$"),
+            "items": items,
+        })
+
+    def _answer(self, prompt: str) -> str:
+        # Labelled documents or context table rows ("id | pos | invoice_number | ...").
+        numbers = re.findall(r"Invoice Number: (\S+)|^\d+ \| \S+ \| (\S+) \|", prompt, re.M)
+        numbers = [labelled or row for labelled, row in numbers]
+        seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        words = [rng.choice(["invoice", "total", "customer", "supplier", "amount", "items", "date"])
+                 for _ in range(self.answer_words)]
+        lead = f"Invoice {numbers[0]}" if numbers else "No matching invoice"
+        return lead + ": " + " ".join(words) + "."
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        text = self.respond(prompt)
+        usage = _Usage(estimate_tokens(prompt), estimate_tokens(text))
+        if not stream:
+            return _Response(text, usage)
+        return self._stream(text, usage)
+
+    async def _stream(self, text: str, usage: _Usage):
+        words = text.split(" ")
+        for i in range(0, len(words), 4):
+            await asyncio.sleep(self.token_latency)
+            last = i + 4 >= len(words)
+            yield _Response(" ".join(words[i:i + 4]) + ("" if last else " "), usage if last else None)
+
+
+def install_fake_llm(latency: float = 0.05, token_latency: float = 0.002) -> FakeGeminiModel:
+    from llm.llm_client import configure_gemini_client
+    model = FakeGeminiModel(latency, token_latency)
+    configure_gemini_client(model=model, rate=0)
+    return model
+
+
+# --- Fake embeddings and OCR ---
+class FakeEmbeddingService(Embeddings):
+    """
+    Hashed bag-of-words vectors of EmbeddingService's width. Texts sharing
+    words land close together, so vector retrieval still returns sensible
+    neighbours. Same interface as llm.embeddings.EmbeddingService.
+    """
+
+    TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _vector(self, text: str) -> list:
+        vector = [0.0] * self.dim
+        for token in self.TOKEN_RE.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [round(v / norm, 5) for v in vector]
+
+    def embed_batch(self, texts, batch_size: int = None) -> list:
+        return [self._vector(text) for text in texts]
+
+    def embed_one(self, text: str) -> list:
+        return self._vector(text)
+
+    def embed_documents(self, texts):
+        return self.embed_batch(list(texts))
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+def install_fake_embeddings() -> FakeEmbeddingService:
+    from llm import embeddings
+    service = FakeEmbeddingService()
+    embeddings._service = service
+    return service
+
+
+def install_fake_ocr(texts: dict):
+    """OCR returns the known text for each rendered path instead of running tesseract."""
+    from llm import query_llm
+
+    def extract_text_from_image(path, preprocess=True):
+        return texts.get(path, "")
+
+    query_llm.extract_text_from_image = extract_text_from_image
+
+
+def reset_caches():
+    """Drop in-process state that depends on table contents between corpus sizes."""
+    from llm import vector_index
+    from db import analytics
+    from llm.llm_cache import get_llm_cache
+    from llm.answer_cache import get_answer_cache
+    vector_index._indexes.clear()
+    analytics._snapshots.clear()
+    paths = []
+    for base in (os.environ["INVOICE_INDEX_DIR"], os.environ["ANALYTICS_SNAPSHOT_PATH"]):
+        root = os.path.splitext(base)[0]
+        # Per-tenant copies live next to the default one (tenants.tenant_path).
+        paths.append(base)
+        paths.extend(glob.glob(root + ".*"))
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+    get_llm_cache().clear()
+    if get_answer_cache() is not None:
+        get_answer_cache().clear()
+
+
+# --- Disposable Postgres ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class DisposablePostgres:
+    """
+    with DisposablePostgres() as pg: ...  # DB_* env and the pool point at it
+
+    Uses a temporary initdb cluster when initdb/pg_ctl are on PATH and DB_HOST
+    is not set; otherwise creates a scratch database on the DB_* server. The
+    schema and every migration are applied; migrations needing an extension
+    the server lacks (pgvector, pg_trgm) are skipped with a note. Everything
+    is dropped on exit unless keep=True.
+    """
+
+    def __init__(self, keep: bool = False):
+        self.keep = keep
+        self.cluster_dir = None
+        self.dbname = f"invoice_bench_{os.getpid()}_{random.randint(0, 99999)}"
+        self.skipped_migrations = []
+
+    def __enter__(self):
+        if not os.getenv("DB_HOST") and shutil.which("initdb") and shutil.which("pg_ctl"):
+            self._start_cluster()
+        else:
+            self._create_database()
+        from db import db_handler
+        db_handler.init_pool()
+        self._apply_schema()
+        return self
+
+    def _start_cluster(self):
+        self.cluster_dir = os.path.join(WORK_DIR, "pgdata")
+        port = _free_port()
+        subprocess.run(["initdb", "-D", self.cluster_dir, "-U", "bench", "--auth=trust"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(["pg_ctl", "-D", self.cluster_dir, "-w", "-l", os.path.join(WORK_DIR, "pg.log"),
+                        "-o", f"-p {port} -k {WORK_DIR} -c listen_addresses=''", "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+        os.environ.update({"DB_HOST": WORK_DIR, "DB_PORT": str(port), "DB_USER": "bench", "DB_PASSWORD": ""})
+        self._admin("CREATE DATABASE " + self.dbname)
+        os.environ["DB_NAME"] = self.dbname
+
+    def _admin_connect(self):
+        import psycopg2
+        conn = psycopg2.connect(
+            host=os.getenv("DB_HOST"), port=os.getenv("DB_PORT", "5432"), user=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASSWORD"), dbname="postgres"
+        )
+        conn.autocommit = True
+        return conn
+
+    def _admin(self, sql: str):
+        conn = self._admin_connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+        finally:
+            conn.close()
+
+    def _create_database(self):
+        self._admin("CREATE DATABASE " + self.dbname)
+        os.environ["DB_NAME"] = self.dbname
+
+    def _apply_schema(self):
+        from db.db_handler import unit_of_work
+        with unit_of_work() as conn, conn.cursor() as cur:
+            cur.execute(BASE_SCHEMA)
+        for name in sorted(os.listdir(MIGRATIONS_DIR)):
+            if not name.endswith(".sql"):
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, name), "r", encoding="utf-8") as f:
+                sql = f.read()
+            try:
+                with unit_of_work() as conn, conn.cursor() as cur:
+                    cur.execute(sql)
+            except Exception as e:
+                self.skipped_migrations.append(name)
+                print(f"Skipping migration {name}: {str(e).strip().splitlines()[0]}")
+
+    def reset(self):
+        """Empty every table (ids restart at 1) between corpus sizes."""
+        from db.db_handler import unit_of_work
+        with unit_of_work() as conn, conn.cursor() as cur:
+            cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public';")
+            existing = {row[0] for row in cur.fetchall()}
+            tables = [t for t in RESET_TABLES if t in existing]
+            if tables:
+                cur.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE;")
+
+    def __exit__(self, *exc):
+        from db import db_handler
+        try:
+            db_handler.get_pool().closeall()
+        except Exception as e:
+            print("Error closing pool:", e)
+        db_handler._pool = None
+        if self.keep:
+            print(f"Kept database {self.dbname}" + (f" in {self.cluster_dir}" if self.cluster_dir else ""))
+            return
+        try:
+            self._admin("DROP DATABASE IF EXISTS " + self.dbname)
+        except Exception as e:
+            print("Error dropping benchmark database:", e)
+        if self.cluster_dir:
+            subprocess.run(["pg_ctl", "-D", self.cluster_dir, "-w", "-m", "fast", "stop"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+# --- Results ---
+def percentile_ms(values, pct) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    value = ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+    return round(value * 1000, 3)
+
+
+def latency_summary(seconds: list) -> dict:
+    return {
+        "n": len(seconds),
+        "p50_ms": percentile_ms(seconds, 50),
+        "p90_ms": percentile_ms(seconds, 90),
+        "p99_ms": percentile_ms(seconds, 99),
+        "max_ms": round(max(seconds) * 1000, 3) if seconds else 0.0,
+    }
+
+
+def max_rss_mb() -> float:
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+    except ImportError:
+        return 0.0
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except Exception:
+        return ""
+
+
+def write_results(out_dir: str, scenario: str, results: dict) -> str:
+    """One JSON file per run: benchmarks/results/<scenario>-<UTC timestamp>.json."""
+    os.makedirs(out_dir, exist_ok=True)
+    stamp = dt.datetime.now(dt.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    payload = {
+        "scenario": scenario,
+        "timestamp": stamp,
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        **results,
+    }
+    path = os.path.join(out_dir, f"{scenario}-{stamp}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2, default=str)
+    return path
+
+
+def elapsed(start: float) -> float:
+    return time.perf_counter() - start
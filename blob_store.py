@@ -0,0 +1,108 @@
+import os
+import hashlib
+from PIL import Image
+
+# Uploaded files, stored once per content hash: <BLOB_DIR>/ab/cd/abcd....png
+BLOB_DIR = os.getenv("BLOB_DIR", "blob_store")
+# Max differing dHash bits (of 64) for two images to count as the same scan.
+# Kept tight: different invoices printed from one template can be ~5 bits apart,
+# and the app lets the user override a near match. -1 disables near matching.
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "2"))
+
+
+def content_sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_path(digest: str, extension: str = "") -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest + extension.lower())
+
+
+def store_blob(data: bytes, extension: str = "", digest: str = None):
+    """
+    Write `data` under its SHA-256 unless it is already there.
+    Returns (digest, path). Writes go through a temp file and os.replace,
+    so a reader never sees a half-written blob.
+    """
+    digest = digest or content_sha256(data)
+    path = blob_path(digest, extension)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return digest, path
+
+
+def dhash(image, size: int = 8) -> int:
+    """
+    64-bit difference hash: grayscale, shrink to (size+1) x size, one bit per
+    horizontally adjacent pixel pair. Survives re-encoding, resizing and small
+    brightness changes, so a re-scan or re-export hashes within a few bits.
+    Returned as a signed int so it fits a Postgres BIGINT.
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    small = image.convert("L").resize((size + 1, size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def image_hashes(path: str):
+    """(content_sha256, dhash) for a stored file; dhash is None for PDFs and unreadable images."""
+    with open(path, "rb") as f:
+        digest = content_sha256(f.read())
+    if path.lower().endswith(".pdf"):
+        return digest, None
+    try:
+        return digest, dhash(path)
+    except Exception as e:
+        print("Error computing image hash:", e)
+        return digest, None
+
+
+def find_duplicate(digest: str, phash: int = None, max_distance: int = PHASH_MAX_DISTANCE):
+    """
+    Look up an invoice already stored for this file by the current tenant.
+    Returns (invoice_id, "exact" | "near", distance) or None.
+    """
+    from db.db_handler import get_connection
+    from db.tenants import current_tenant
+    tenant_id = current_tenant()
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT i.invoice_id FROM data_invoices_images i
+            JOIN data_of_invoices d ON d.customer_id = i.invoice_id
+            WHERE i.content_sha256 = %s AND d.tenant_id = %s
+            ORDER BY i.id LIMIT 1;
+            """,
+            (digest, tenant_id)
+        )
+        row = cur.fetchone()
+        if row:
+            return row[0], "exact", 0
+        if phash is None or max_distance < 0:
+            return None
+        cur.execute(
+            """
+            SELECT i.invoice_id, bit_count((i.phash # %s)::bit(64)) AS distance
+            FROM data_invoices_images i
+            JOIN data_of_invoices d ON d.customer_id = i.invoice_id
+            WHERE i.phash IS NOT NULL AND d.tenant_id = %s
+            ORDER BY distance, i.id
+            LIMIT 1;
+            """,
+            (phash, tenant_id)
+        )
+        row = cur.fetchone()
+    if row and row[1] <= max_distance:
+        return row[0], "near", row[1]
+    return None
@@ -0,0 +1,305 @@
+"""
+Chat history: buffered writes, paged restore and retention.
+
+A chat turn used to cost two INSERTs, each with its own commit. Now turns go
+to ChatHistoryWriter, which buffers the messages and writes them with one
+multi-row INSERT from a background thread. It flushes every
+CHAT_FLUSH_SECONDS, or sooner once CHAT_FLUSH_BATCH messages are waiting.
+Reads flush first, so a restore always sees the latest turn.
+
+Messages belong to an invoice and/or a chat session: the app's ?session=
+URL parameter, or the service's session_id. fetch_chat_page() reads a
+conversation backwards one page at a time, so a reloaded page or a
+restarted service can pick it up again. Both reads are served by the
+indexes in migrations/010_chat_history.sql.
+
+compact_chat_history() is the retention job. It deletes messages older
+than CHAT_RETENTION_DAYS and keeps the newest CHAT_KEEP_MESSAGES of each
+conversation. The writer thread runs it every CHAT_COMPACT_SECONDS;
+compact_chat_history.py runs it on demand, e.g. from cron.
+"""
+import os
+import time
+import atexit
+import threading
+from datetime import datetime
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
+from db.db_handler import get_connection, unit_of_work, insert_chat_messages
+from db.tenants import current_tenant
+from metrics import get_metrics, timer
+
+CHAT_FLUSH_SECONDS = float(os.getenv("CHAT_FLUSH_SECONDS", "1.0"))
+CHAT_FLUSH_BATCH = int(os.getenv("CHAT_FLUSH_BATCH", "200"))
+# Messages held in memory while the database is unreachable; the oldest are dropped beyond this.
+CHAT_BUFFER_MAX = int(os.getenv("CHAT_BUFFER_MAX", "10000"))
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "50"))
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "0"))  # 0 = keep forever
+CHAT_KEEP_MESSAGES = int(os.getenv("CHAT_KEEP_MESSAGES", "1000"))  # per conversation; 0 = no cap
+CHAT_COMPACT_SECONDS = int(os.getenv("CHAT_COMPACT_SECONDS", "3600"))  # 0 = only via compact_chat_history.py
+CHAT_COMPACT_BATCH = int(os.getenv("CHAT_COMPACT_BATCH", "5000"))
+
+# The database was unreachable: the messages are fine, write them later.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+
+
+class ChatHistoryWriter:
+    """
+    Buffered, batched writer for chat_history. append() only queues the
+    message; a daemon thread writes the queue in one transaction. When the
+    database can't be reached (TRANSIENT_ERRORS) the messages stay queued
+    for the next flush. Any other error means a message the database
+    rejects (e.g. a NUL byte), so the batch is retried one message at a
+    time and the rejected ones are dropped and counted.
+    """
+
+    def __init__(self, flush_seconds: float = CHAT_FLUSH_SECONDS, batch_size: int = CHAT_FLUSH_BATCH,
+                 max_buffer: int = CHAT_BUFFER_MAX, compact_seconds: int = CHAT_COMPACT_SECONDS):
+        self.flush_seconds = flush_seconds
+        self.batch_size = max(1, batch_size)
+        self.max_buffer = max(self.batch_size, max_buffer)
+        self.compact_seconds = compact_seconds
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time keeps messages in order
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.errors = 0
+        get_metrics().register_collector("chat_history", self.stats)
+        atexit.register(self.close)
+
+    def append(self, role: str, content: str, invoice_id: int = None, session_id: str = None,
+               timestamp: datetime = None, tenant_id: str = None):
+        """
+        Queue one message for `tenant_id` (the current tenant by default).
+        Messages with neither an invoice nor a session are not kept.
+        """
+        if invoice_id is None and not session_id:
+            return
+        row = (invoice_id, session_id, tenant_id or current_tenant(), role, content, timestamp or datetime.utcnow())
+        with self._lock:
+            self._buffer.append(row)
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                del self._buffer[:overflow]
+                self.dropped += overflow
+            full = len(self._buffer) >= self.batch_size
+        self._start()
+        if full:
+            self._wake.set()
+
+    def append_turn(self, user: str, bot: str, invoice_id: int = None, session_id: str = None,
+                    tenant_id: str = None):
+        now = datetime.utcnow()
+        self.append("user", user, invoice_id, session_id, now, tenant_id)
+        self.append("bot", bot, invoice_id, session_id, now, tenant_id)
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        """Write everything queued now, on the calling thread. Returns the number of messages written."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            try:
+                with timer("chat_history_write"):
+                    insert_chat_messages(rows)
+            except TRANSIENT_ERRORS as e:
+                print("Error writing chat history:", e)
+                self._requeue(rows)
+                return 0
+            except Exception as e:
+                print("Error writing chat history, retrying message by message:", e)
+                self.errors += 1
+                written = self._write_each(rows)
+            else:
+                written = len(rows)
+            self.written += written
+            self.flushes += 1
+            return written
+
+    def _write_each(self, rows: list) -> int:
+        """Write rows one at a time, dropping those the database rejects."""
+        written = 0
+        for i, row in enumerate(rows):
+            try:
+                insert_chat_messages([row])
+            except TRANSIENT_ERRORS as e:
+                print("Error writing chat history:", e)
+                self._requeue(rows[i:])
+                break
+            except Exception as e:
+                print("Dropping chat message the database rejects:", e)
+                self.rejected += 1
+            else:
+                written += 1
+        return written
+
+    def _requeue(self, rows: list):
+        """Put unwritten rows back at the front of the queue."""
+        with self._lock:
+            self._buffer[:0] = rows
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                del self._buffer[:overflow]
+                self.dropped += overflow
+            self.errors += 1
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None and not self._closed:
+                    self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        compacted = time.monotonic()
+        while not self._closed:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+            if self.compact_seconds > 0 and time.monotonic() - compacted >= self.compact_seconds:
+                compacted = time.monotonic()
+                try:
+                    compact_chat_history()
+                except Exception as e:
+                    print("Error compacting chat history:", e)
+
+    def close(self):
+        """Stop the thread and write what is left (registered with atexit)."""
+        self._closed = True
+        self._wake.set()
+        if self.pending():
+            self.flush()
+
+    def stats(self) -> dict:
+        return {"pending": self.pending(), "written": self.written, "flushes": self.flushes,
+                "dropped": self.dropped, "rejected": self.rejected, "errors": self.errors}
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_chat_writer() -> ChatHistoryWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ChatHistoryWriter()
+    return _writer
+
+
+def fetch_chat_page(invoice_id: int = None, session_id: str = None, limit: int = CHAT_PAGE_SIZE,
+                    before: int = None):
+    """
+    One page of a conversation of the current tenant, selected by invoice,
+    session or both. Returns (messages, cursor). `messages` holds the newest
+    `limit` messages older than the message id `before`, oldest first, as
+    dicts {id, role, content, timestamp, invoice_id, session_id}. `cursor`
+    is the `before` that fetches the page preceding this one, or None when
+    nothing older is left.
+    """
+    if invoice_id is None and not session_id:
+        return [], None
+    if _writer is not None and _writer.pending():
+        _writer.flush()
+    conditions = ["tenant_id = %s"]
+    params = [current_tenant()]
+    if invoice_id is not None:
+        conditions.append("invoice_id = %s")
+        params.append(invoice_id)
+    if session_id:
+        conditions.append("session_id = %s")
+        params.append(session_id)
+    if before is not None:
+        conditions.append("(timestamp, id) < (SELECT timestamp, id FROM chat_history WHERE id = %s)")
+        params.append(before)
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with timer("chat_history_read"):
+            cur.execute(
+                f"""
+                SELECT id, role, content, timestamp, invoice_id, session_id
+                FROM chat_history
+                WHERE {" AND ".join(conditions)}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT %s;
+                """,
+                params + [limit + 1]
+            )
+            rows = cur.fetchall()
+    more = len(rows) > limit
+    messages = list(reversed(rows[:limit]))
+    return messages, (messages[0]["id"] if more and messages else None)
+
+
+def compact_chat_history(retention_days: int = CHAT_RETENTION_DAYS, keep_messages: int = CHAT_KEEP_MESSAGES,
+                         batch_size: int = CHAT_COMPACT_BATCH) -> int:
+    """
+    Delete messages older than `retention_days` and all but the newest
+    `keep_messages` of each conversation (tenant, invoice, session), in
+    batches of `batch_size`, one short transaction each. Returns the number
+    of messages deleted.
+
+    The conversations over the cap are found with one GROUP BY ... HAVING
+    pass; each is then trimmed through its restore index, so the batches
+    don't rank the whole table every time.
+    """
+    deleted = 0
+    batches = []
+    if retention_days > 0:
+        batches.append((
+            """
+            SELECT id FROM chat_history
+            WHERE timestamp < (now() AT TIME ZONE 'utc') - %s * interval '1 day'
+            LIMIT %s
+            """,
+            (retention_days, batch_size)
+        ))
+    if keep_messages > 0:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT tenant_id, invoice_id, session_id FROM chat_history
+                GROUP BY tenant_id, invoice_id, session_id
+                HAVING count(*) > %s;
+                """,
+                (keep_messages,)
+            )
+            conversations = cur.fetchall()
+        for tenant_id, invoice_id, session_id in conversations:
+            conditions = [
+                "tenant_id = %s",
+                "invoice_id IS NULL" if invoice_id is None else "invoice_id = %s",
+                "session_id IS NULL" if session_id is None else "session_id = %s",
+            ]
+            params = [value for value in (tenant_id, invoice_id, session_id) if value is not None]
+            batches.append((
+                f"""
+                SELECT id FROM chat_history
+                WHERE {" AND ".join(conditions)}
+                ORDER BY timestamp DESC, id DESC
+                OFFSET %s LIMIT %s
+                """,
+                params + [keep_messages, batch_size]
+            ))
+    for select, params in batches:
+        while True:
+            with unit_of_work() as conn, conn.cursor() as cur:
+                cur.execute(f"DELETE FROM chat_history WHERE id IN ({select});", params)
+                count = cur.rowcount
+            deleted += count
+            if count < batch_size:
+                break
+    if deleted:
+        print(f"Compacted chat history: {deleted} messages deleted")
+    return deleted
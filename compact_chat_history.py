@@ -0,0 +1,29 @@
+"""
+Apply the chat history retention policy once (see chat_store.py).
+
+    python compact_chat_history.py [--retention-days 90] [--keep-messages 1000]
+
+Deletes messages older than --retention-days and all but the newest
+--keep-messages of each conversation, in small transactions. The app and
+the service already do this every CHAT_COMPACT_SECONDS; run this from cron
+when they run with CHAT_COMPACT_SECONDS=0 or to apply a stricter policy.
+"""
+import sys
+import argparse
+from db.chat_store import compact_chat_history, CHAT_RETENTION_DAYS, CHAT_KEEP_MESSAGES, CHAT_COMPACT_BATCH
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--retention-days", type=int, default=CHAT_RETENTION_DAYS, help="0 = no age limit")
+    parser.add_argument("--keep-messages", type=int, default=CHAT_KEEP_MESSAGES, help="Per conversation; 0 = no cap")
+    parser.add_argument("--batch-size", type=int, default=CHAT_COMPACT_BATCH)
+    args = parser.parse_args(argv)
+
+    deleted = compact_chat_history(args.retention_days, args.keep_messages, args.batch_size)
+    print(f"Done: {deleted} messages deleted.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,87 +1,247 @@
 import os
+import threading
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from db.pgvector_store import use_pgvector
+from db.invoice_items import insert_items, insert_item_rows
+from db.invoice_record import Invoice
+from db.tenants import current_tenant
+from metrics import timer
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+
+_pool = None
+_pool_slots = None  # one per connection the pool may hand out; getconn() raises instead of waiting
+_pool_lock = threading.Lock()
+
+def init_pool(minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX, **connect_kwargs):
+    """
+    Create the process-wide connection pool. Called lazily by get_connection();
+    call it explicitly to change the pool size or pass extra psycopg2.connect
+    arguments (e.g. connection_factory).
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = ThreadedConnectionPool(minconn, maxconn, **connection_params(), **connect_kwargs)
+        _pool_slots = threading.BoundedSemaphore(maxconn)
+    return _pool
+
+def connection_params() -> dict:
+    """psycopg2.connect arguments from the DB_* environment."""
+    return {
+        "host": os.getenv("DB_HOST"),
+        "port": os.getenv("DB_PORT", "5432"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "dbname": os.getenv("DB_NAME"),
+    }
+
+def connect():
+    """A dedicated connection outside the pool, for long-lived use such as LISTEN."""
+    return psycopg2.connect(**connection_params())
+
+def get_pool() -> ThreadedConnectionPool:
+    if _pool is None:
+        init_pool()
+    return _pool
+
+@contextmanager
 def get_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT", "5432"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        dbname=os.getenv("DB_NAME")
-    )
-    return conn
+    """
+    Borrow a connection from the pool for the duration of a with-block.
+    When all DB_POOL_MAX connections are out, waits up to DB_POOL_TIMEOUT
+    seconds for one to come back. Uncommitted work is rolled back before
+    the connection goes back.
+
+    Don't take a second connection while holding one (e.g. by refreshing
+    the analytics snapshot or the FAISS index inside the block): under load
+    every thread can end up holding one and waiting for another.
+    """
+    pool = get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError(f"No database connection free after {DB_POOL_TIMEOUT:g}s (DB_POOL_MAX={pool.maxconn})")
+    try:
+        conn = pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+    try:
+        yield conn
+    finally:
+        try:
+            if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            slots.release()
+
+@contextmanager
+def unit_of_work():
+    """
+    One transaction on one connection: everything written inside the block
+    commits together, or nothing does.
+
+        with unit_of_work() as conn:
+            invoice_id = insert_invoice(data, conn=conn)
+            insert_invoice_image(invoice_id, path, text, conn=conn)
+    """
+    with get_connection() as conn:
+        yield conn
+        conn.commit()
+
+INVOICE_COLUMNS = ["invoice_number", "customer", "supplier", "invoice_date", "total_amount", "items", "vector_embedding"]
+
+def _invoice_columns() -> list:
+    # With the pgvector backend the JSON embedding ("[0.1, ...]") is also
+    # written to the vector(384) column; it is valid pgvector input as-is.
+    return INVOICE_COLUMNS + ["tenant_id"] + (["embedding"] if use_pgvector() else [])
 
-def insert_invoice(data: dict) -> int:
+def _invoice_values(invoice: Invoice, tenant_id: str) -> tuple:
+    values = [getattr(invoice, column) for column in INVOICE_COLUMNS] + [tenant_id]
+    if use_pgvector():
+        values.append(invoice.vector_embedding)
+    return tuple(values)
+
+def fetch_data_version() -> int:
+    """
+    Current invoice data version of the tenant. Bumped in the same transaction
+    by every insert_invoice / insert_invoices_bulk and any other change to its
+    invoices (triggers in migrations/011_data_version.sql).
+    """
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT version FROM invoice_data_version WHERE tenant_id = %s;", (current_tenant(),))
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+def insert_invoice(data, conn=None) -> int:
     """
     Inserts an invoice into the data_of_invoices table.
-    Expects data to be a dictionary with keys: invoice_number, customer, supplier,
-    invoice_date, total_amount, items, vector_embedding.
-    Returns the inserted record’s ID.
+    Expects an Invoice, or a dictionary with keys: invoice_number, customer,
+    supplier, invoice_date, total_amount, items, vector_embedding, and
+    optionally line_items (written to invoice_items); dictionaries go
+    through Invoice.from_extracted, so totals and dates are stored typed.
+    Returns the inserted record’s ID. The row belongs to the current tenant.
+    Commits on its own unless an open unit-of-work connection is passed in.
     """
-    conn = get_connection()
-    cur = conn.cursor()
-    query = """
-    INSERT INTO data_of_invoices 
-    (invoice_number, customer, supplier, invoice_date, total_amount, items, vector_embedding)
-    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    if conn is None:
+        with unit_of_work() as conn:
+            return insert_invoice(data, conn=conn)
+    invoice = Invoice.coerce(data)
+    columns = _invoice_columns()
+    query = f"""
+    INSERT INTO data_of_invoices
+    ({", ".join(columns)})
+    VALUES ({", ".join(["%s"] * len(columns))})
     RETURNING customer_id;
     """
-    cur.execute(query, (
-        data.get("invoice_number"),
-        data.get("customer"),
-        data.get("supplier"),
-        data.get("invoice_date"),
-        data.get("total_amount"),
-        data.get("items"),
-        data.get("vector_embedding")
-    ))
-    result = cur.fetchone()
+    with conn.cursor() as cur, timer("db_insert"):
+        cur.execute(query, _invoice_values(invoice, current_tenant()))
+        result = cur.fetchone()
+        if result is not None:
+            insert_items(cur, result[0], invoice.line_items)
     if result is None:
-        conn.rollback()
-        cur.close()
-        conn.close()
         raise Exception("Insert invoice query did not return any row.")
-    inserted_id = result[0]
-    conn.commit()
-    cur.close()
-    conn.close()
-    return inserted_id
+    return result[0]
 
-def insert_invoice_image(invoice_id: int, image_path: str, ocr_text: str) -> int:
+def insert_invoice_image(invoice_id: int, image_path: str, ocr_text: str, conn=None,
+                         content_sha256: str = None, phash: int = None, page_number: int = 1) -> int:
     """
-    Inserts a record into the data_invoices_images table.
+    Inserts a record into the data_invoices_images table, with the file's
+    content and perceptual hashes for duplicate detection (db/blob_store.py).
     """
-    conn = get_connection()
-    cur = conn.cursor()
+    if conn is None:
+        with unit_of_work() as conn:
+            return insert_invoice_image(invoice_id, image_path, ocr_text, conn=conn,
+                                        content_sha256=content_sha256, phash=phash, page_number=page_number)
     query = """
-    INSERT INTO data_invoices_images (invoice_id, image_path, ocr_text)
-    VALUES (%s, %s, %s)
+    INSERT INTO data_invoices_images (invoice_id, image_path, ocr_text, content_sha256, phash, page_number)
+    VALUES (%s, %s, %s, %s, %s, %s)
     RETURNING id;
     """
-    cur.execute(query, (invoice_id, image_path, ocr_text))
-    result = cur.fetchone()
+    with conn.cursor() as cur:
+        cur.execute(query, (invoice_id, image_path, ocr_text, content_sha256, phash, page_number))
+        result = cur.fetchone()
     if result is None:
-        conn.rollback()
-        cur.close()
-        conn.close()
         raise Exception("Insert invoice image query did not return any row.")
-    inserted_id = result[0]
-    conn.commit()
-    cur.close()
-    conn.close()
-    return inserted_id
+    return result[0]
 
 # in db/db_handler.py
-def insert_chat_message(invoice_id, role, content, timestamp):
-    conn = get_connection()
+def insert_chat_message(invoice_id, role, content, timestamp, conn=None, session_id=None):
+    """One message; chat turns go through chat_store.ChatHistoryWriter, which batches them."""
+    insert_chat_messages([(invoice_id, session_id, current_tenant(), role, content, timestamp)], conn=conn)
+
+
+def insert_chat_messages(rows: list, conn=None):
+    """Inserts (invoice_id, session_id, tenant_id, role, content, timestamp) tuples with one multi-row INSERT."""
+    if not rows:
+        return
+    if conn is None:
+        with unit_of_work() as conn:
+            return insert_chat_messages(rows, conn=conn)
     with conn.cursor() as cur:
-        cur.execute(
+        execute_values(
+            cur,
             """
-            INSERT INTO chat_history (invoice_id, role, content, timestamp)
-            VALUES (%s, %s, %s, %s)
+            INSERT INTO chat_history (invoice_id, session_id, tenant_id, role, content, timestamp)
+            VALUES %s
             """,
-            (invoice_id, role, content, timestamp)
+            rows,
+            page_size=len(rows)
         )
-        conn.commit()
-    conn.close()
+
+def insert_invoices_bulk(rows: list, conn=None) -> list:
+    """
+    Inserts many invoices with one multi-row INSERT per page (execute_values).
+    rows are Invoices or dicts shaped like insert_invoice's data. Returns
+    the new customer_ids in the same order as rows.
+    """
+    if not rows:
+        return []
+    if conn is None:
+        with unit_of_work() as conn:
+            return insert_invoices_bulk(rows, conn=conn)
+    query = f"""
+    INSERT INTO data_of_invoices
+    ({", ".join(_invoice_columns())})
+    VALUES %s
+    RETURNING customer_id;
+    """
+    invoices = [Invoice.coerce(data) for data in rows]
+    tenant_id = current_tenant()
+    values = [_invoice_values(invoice, tenant_id) for invoice in invoices]
+    with conn.cursor() as cur, timer("db_insert"):
+        result = execute_values(cur, query, values, page_size=len(values), fetch=True)
+        ids = [row[0] for row in result]
+        insert_item_rows(cur, [
+            (invoice_id, line_no, item["description"], item.get("quantity"), item.get("unit_price"), item.get("amount"))
+            for invoice_id, invoice in zip(ids, invoices)
+            for line_no, item in enumerate(invoice.line_items, 1)
+        ])
+    return ids
+
+def insert_invoice_images_bulk(rows: list, conn=None) -> list:
+    """
+    Inserts many (invoice_id, image_path, ocr_text, content_sha256, phash,
+    page_number) tuples into data_invoices_images. Returns the new ids in order.
+    """
+    if not rows:
+        return []
+    if conn is None:
+        with unit_of_work() as conn:
+            return insert_invoice_images_bulk(rows, conn=conn)
+    query = """
+    INSERT INTO data_invoices_images (invoice_id, image_path, ocr_text, content_sha256, phash, page_number)
+    VALUES %s
+    RETURNING id;
+    """
+    with conn.cursor() as cur:
+        result = execute_values(cur, query, rows, page_size=len(rows), fetch=True)
+    return [row[0] for row in result]
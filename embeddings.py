@@ -0,0 +1,117 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from langchain.embeddings.base import Embeddings
+from metrics import timer, inc
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # 0 = torch default
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+
+
+def invoice_embedding_text(invoice) -> str:
+    """The text an invoice is embedded from, shared by upload and batch ingestion."""
+    return (
+        f"Invoice Number: {invoice.get('invoice_number')}\n"
+        f"Customer: {invoice.get('customer')}\n"
+        f"Supplier: {invoice.get('supplier')}\n"
+        f"Date: {invoice.get('invoice_date') or 'N/A'}\n"
+        f"Items: {invoice.get('items')}\n"
+        f"Total Amount: {invoice.get('total_amount')}"
+    )
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingService(Embeddings):
+    """
+    One sentence-transformers model per process with a batched encode API.
+
+    Vectors are cached by a SHA-256 of the input text (LRU, EMBEDDING_CACHE_SIZE
+    entries), so re-embedding the same invoice or question is free. Implements
+    the LangChain Embeddings interface so it can back FAISS directly.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_size: int = EMBEDDING_BATCH_SIZE,
+                 num_threads: int = EMBEDDING_THREADS, cache_size: int = EMBEDDING_CACHE_SIZE):
+        from sentence_transformers import SentenceTransformer
+        if num_threads > 0:
+            import torch
+            torch.set_num_threads(num_threads)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._model_lock = threading.Lock()
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+            return vector
+
+    def _cache_put(self, key, vector):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def embed_batch(self, texts, batch_size: int = None) -> list:
+        """Embed many texts, encoding only the ones not already cached."""
+        keys = [content_hash(t) for t in texts]
+        vectors = [self._cache_get(k) for k in keys]
+        todo = {}
+        for i, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None:
+                todo.setdefault(key, []).append(i)
+        inc("embedding_cache_lookups_total", len(texts) - sum(len(p) for p in todo.values()), result="hit")
+        inc("embedding_cache_lookups_total", sum(len(p) for p in todo.values()), result="miss")
+        if todo:
+            unique_texts = [texts[positions[0]] for positions in todo.values()]
+            with self._model_lock, timer("embed"):
+                encoded = self.model.encode(
+                    unique_texts,
+                    batch_size=batch_size or self.batch_size,
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                )
+            for (key, positions), row in zip(todo.items(), encoded):
+                vector = row.tolist()
+                self._cache_put(key, vector)
+                for i in positions:
+                    vectors[i] = vector
+        return vectors
+
+    def embed_one(self, text: str) -> list:
+        return self.embed_batch([text])[0]
+
+    # LangChain Embeddings interface
+    def embed_documents(self, texts):
+        return self.embed_batch(list(texts))
+
+    def embed_query(self, text):
+        return self.embed_one(text)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    """Return the process-wide embedding service, loading the model on first use."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService()
+    return _service
@@ -0,0 +1,62 @@
+import re
+from llm.memory import ChatMemory
+
+# Phrases that point at a neighbour of the last referenced invoice.
+BEFORE_RE = re.compile(r"\b(?:the\s+)?(?:one|invoice)\s+before(?:\s+(?:that|it|this))?\b|\bprevious\s+(?:one|invoice)\b", re.I)
+AFTER_RE = re.compile(r"\b(?:the\s+)?(?:one|invoice)\s+after(?:\s+(?:that|it|this))?\b|\bnext\s+(?:one|invoice)\b", re.I)
+# Singular references to "the invoice we were just talking about".
+SINGULAR_RE = re.compile(
+    r"\b(?:its?\b|(?:this|that|same)\s+(?:invoice|one|bill)\b|(?:this|that)(?=\s*(?:[?.!,]|$)))",
+    re.I
+)
+# References the local resolver can't map to one invoice; these fall back to
+# the LLM condense call.
+AMBIGUOUS_RE = re.compile(r"\b(these|those|them|they|their|the others?|same ones?)\b", re.I)
+
+
+def new_session() -> dict:
+    """Per-conversation state threaded through run_chat (kept in st.session_state)."""
+    return {"last_invoice_id": None, "last_position": None, "turn_timings": [], "memory": ChatMemory()}
+
+
+def is_followup(question: str) -> bool:
+    return bool(BEFORE_RE.search(question) or AFTER_RE.search(question)
+                or SINGULAR_RE.search(question) or AMBIGUOUS_RE.search(question))
+
+
+def resolve_followup(question: str, session: dict):
+    """
+    Rewrite a follow-up into a self-contained question using the invoice the
+    conversation last referenced, without an LLM call.
+
+    Returns (question, needs_condense). needs_condense is True only when the
+    reference can't be resolved locally and the condense call is needed.
+    """
+    last_id = session.get("last_invoice_id")
+    last_position = session.get("last_position")
+
+    for regex, step in ((BEFORE_RE, -1), (AFTER_RE, 1)):
+        if regex.search(question):
+            if not last_position or last_position + step < 1:
+                return question, True
+            return regex.sub(f"invoice {last_position + step}", question), False
+
+    if AMBIGUOUS_RE.search(question):
+        return question, True
+
+    if SINGULAR_RE.search(question):
+        if last_id is not None:
+            return f"{question} (customer id {last_id})", False
+        # Nothing referenced yet: "it"/"this invoice" means the most recent upload.
+        return f"{question} (latest invoice)", False
+
+    return question, False
+
+
+def remember_invoices(session: dict, invoices: list):
+    """Track the invoice a turn was about, so the next turn can refer back to it."""
+    if len(invoices) != 1:
+        return
+    invoice = invoices[0]
+    session["last_invoice_id"] = invoice.get("customer_id")
+    session["last_position"] = invoice.get("position")
@@ -1,10 +1,57 @@
+import os
+import multiprocessing
 import pytesseract
 from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from img2text.preprocess import preprocess_image, split_tiles
+from metrics import timer
 
-def extract_text_from_image(image_path: str) -> str:
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "1") != "0"
+OCR_OEM = os.getenv("OCR_OEM", "1")  # 1 = LSTM engine only
+OCR_PSM = os.getenv("OCR_PSM", "auto")  # tesseract page segmentation mode, or "auto"
+OCR_TILE_HEIGHT = int(os.getenv("OCR_TILE_HEIGHT", "2000"))
+OCR_TILE_WORKERS = int(os.getenv("OCR_TILE_WORKERS", "0"))  # 0 = no tiling
+
+
+def choose_psm(image: Image.Image) -> str:
+    """Long narrow receipts read best as one column (4); full pages with automatic layout (3)."""
+    if OCR_PSM != "auto":
+        return OCR_PSM
+    return "4" if image.height > 2.5 * image.width else "3"
+
+
+def tesseract_config(psm: str) -> str:
+    return f"--oem {OCR_OEM} --psm {psm}"
+
+
+def _ocr_tile(args) -> str:
+    image, config = args
+    return pytesseract.image_to_string(image, config=config)
+
+
+def ocr_image(image: Image.Image, preprocess: bool = OCR_PREPROCESS, tile_workers: int = OCR_TILE_WORKERS) -> str:
+    with timer("ocr"):
+        return _ocr_image(image, preprocess, tile_workers)
+
+
+def _ocr_image(image: Image.Image, preprocess: bool, tile_workers: int) -> str:
+    if preprocess:
+        image = preprocess_image(image)
+    config = tesseract_config(choose_psm(image))
+    # Daemon processes (the ingest workers) may not start children; OCR whole there.
+    if tile_workers <= 0 or not preprocess or multiprocessing.current_process().daemon:
+        return pytesseract.image_to_string(image, config=config)
+    tiles = split_tiles(image, OCR_TILE_HEIGHT)
+    if len(tiles) == 1:
+        return pytesseract.image_to_string(image, config=config)
+    with ProcessPoolExecutor(max_workers=min(tile_workers, len(tiles))) as pool:
+        return "\n".join(pool.map(_ocr_tile, [(tile, config) for tile in tiles]))
+
+
+def extract_text_from_image(image_path: str, preprocess: bool = OCR_PREPROCESS) -> str:
     try:
         image = Image.open(image_path)
-        text = pytesseract.image_to_string(image)
+        text = ocr_image(image, preprocess=preprocess)
         return text
     except Exception as e:
         print("Error during OCR extraction:", e)
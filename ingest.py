@@ -0,0 +1,290 @@
+"""
+Batch invoice ingestion.
+
+    python ingest.py scans/                # a directory of images and PDFs
+    python ingest.py scans.zip             # or a .zip / .tar(.gz) archive
+    python ingest.py scans/ --tenant acme  # into one tenant's workspace
+
+Files go through the same path as uploads from the app: each is copied into
+the blob store by content hash, and files the tenant already has an invoice
+for (or that repeat earlier in the run) are skipped.
+
+Stages run as a pipeline over chunks of --batch-size files:
+  1. Tesseract OCR in a process pool (the next chunk is OCR'd while the
+     current one is being extracted). PDF pages with a text layer skip OCR;
+     each PDF is read by one pool process, page by page.
+  2. Concurrent async Gemini extraction through the shared client, bounded by
+     --llm-concurrency and rate-limited to --llm-rate requests per second,
+     with retries on 429/5xx.
+  3. One batched embedding call per chunk.
+  4. execute_values bulk inserts into data_of_invoices and
+     data_invoices_images, one transaction per chunk.
+
+Finished files are appended to a state file (default: <source>.ingest.jsonl)
+after their chunk commits, so re-running the same command resumes where it
+stopped. Files whose extraction failed are retried on the next run.
+"""
+import os
+import sys
+import json
+import time
+import tarfile
+import zipfile
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from img2text.img2text import extract_text_from_image
+from img2text.pdf2text import iter_pdf_pages
+from llm.query_llm import allm_extract_invoice_fields, normalize_invoice_fields
+from llm.llm_client import configure_gemini_client
+from llm.embeddings import get_embedding_service, invoice_embedding_text
+from db.db_handler import unit_of_work, insert_invoices_bulk, insert_invoice_images_bulk
+from db.blob_store import store_blob, dhash, find_duplicate
+from db.tenants import DEFAULT_TENANT, use_tenant
+
+INGEST_EXTENSIONS = (".png", ".jpg", ".jpeg", ".pdf")
+UPLOAD_FOLDER = "temp_upload"
+
+
+def collect_files(source: str) -> list:
+    """Return image and PDF paths under a directory, extracting archives into UPLOAD_FOLDER first."""
+    if os.path.isfile(source):
+        name = os.path.splitext(os.path.basename(source))[0]
+        if name.endswith(".tar"):
+            name = name[:-4]
+        target = os.path.join(UPLOAD_FOLDER, name)
+        os.makedirs(target, exist_ok=True)
+        if zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                archive.extractall(target)
+        elif tarfile.is_tarfile(source):
+            with tarfile.open(source) as archive:
+                archive.extractall(target, filter="data")
+        else:
+            raise ValueError(f"Unsupported input file: {source}")
+        source = target
+    paths = []
+    for root, _, files in os.walk(source):
+        for file_name in files:
+            if file_name.lower().endswith(INGEST_EXTENSIONS):
+                paths.append(os.path.abspath(os.path.join(root, file_name)))
+    return sorted(paths)
+
+
+def extract_pages(path: str) -> list:
+    """OCR one file into [(page_number, text), ...]; runs in the OCR pool."""
+    if path.lower().endswith(".pdf"):
+        # The pool already spreads files over the cores.
+        return [(page_number, text) for page_number, text, _ in iter_pdf_pages(path, workers=1)]
+    return [(1, extract_text_from_image(path))]
+
+
+def pages_text(pages: list) -> str:
+    if len(pages) == 1:
+        return pages[0][1]
+    return "\n".join(f"--- Page {page_number} ---\n{text}" for page_number, text in pages if text.strip())
+
+
+def load_state(state_path: str) -> set:
+    done = set()
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["path"])
+                except Exception:
+                    continue
+    return done
+
+
+def append_state(state_path: str, records: list):
+    with open(state_path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+class Stats:
+    def __init__(self, total: int):
+        self.total = total
+        self.stored = 0
+        self.failed = 0
+        self.skipped = 0  # already stored, or a repeat within this run
+        self.stage_seconds = {"stage": 0.0, "ocr": 0.0, "extract": 0.0, "embed": 0.0, "insert": 0.0}
+        self.started = time.perf_counter()
+
+    def rate(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.stored / elapsed if elapsed > 0 else 0.0
+
+    def progress(self):
+        done = self.stored + self.failed + self.skipped
+        print(f"[{done}/{self.total}] stored={self.stored} failed={self.failed} skipped={self.skipped} "
+              f"{self.rate():.2f} invoices/s", flush=True)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        print(f"Done in {elapsed:.1f}s: stored={self.stored} failed={self.failed} skipped={self.skipped} "
+              f"({self.rate():.2f} invoices/s)")
+        for stage, seconds in self.stage_seconds.items():
+            print(f"  {stage:<8} {seconds:.1f}s")
+
+
+async def extract_chunk(texts: list) -> list:
+    """Extract every OCR text in the chunk concurrently; the client enforces the limits."""
+    async def extract(text):
+        if not text.strip():
+            return None
+        try:
+            data = await allm_extract_invoice_fields(text)
+        except Exception as e:
+            print("LLM extraction error:", e)
+            return None
+        return normalize_invoice_fields(data) if data else None
+
+    return await asyncio.gather(*(extract(text) for text in texts))
+
+
+def embed_chunk(invoices: list):
+    vectors = get_embedding_service().embed_batch([invoice_embedding_text(inv) for inv in invoices])
+    for inv, vector in zip(invoices, vectors):
+        inv["vector_embedding"] = json.dumps(vector)
+
+
+def stage_files(paths: list, seen: dict):
+    """
+    Copy files into the blob store, as uploads are, and leave out those the
+    tenant already has an invoice for (find_duplicate, exact matches only
+    like the ingest worker: nobody is here to confirm a near match) or whose
+    content appeared earlier in the run (`seen`: digest -> path).
+    Returns ([(path, blob_path, digest, phash)], state records of stored duplicates, repeats).
+    """
+    staged, duplicates, repeats = [], [], 0
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        extension = os.path.splitext(path)[1].lower()
+        digest, blob_path = store_blob(data, extension)
+        if digest in seen:
+            # Not recorded in the state file: if the first copy fails, this one is tried next run.
+            print(f"Skipping {path}: same file as {seen[digest]}")
+            repeats += 1
+            continue
+        seen[digest] = path
+        try:
+            duplicate = find_duplicate(digest, max_distance=-1)
+        except Exception as e:
+            print("Error checking for duplicates:", e)
+            duplicate = None
+        if duplicate:
+            duplicates.append({"path": path, "invoice_id": duplicate[0], "duplicate": True})
+            continue
+        phash = None
+        if extension != ".pdf":
+            try:
+                phash = dhash(blob_path)
+            except Exception as e:
+                print("Error computing image hash:", e)
+        staged.append((path, blob_path, digest, phash))
+    return staged, duplicates, repeats
+
+
+def store_chunk(files: list, pages: list, invoices: list) -> list:
+    """Insert one chunk of staged files in a single transaction. Returns state records."""
+    with unit_of_work() as conn:
+        invoice_ids = insert_invoices_bulk(invoices, conn=conn)
+        insert_invoice_images_bulk(
+            [(invoice_id, blob_path, text, digest, phash, page_number)
+             for invoice_id, (_, blob_path, digest, phash), file_pages in zip(invoice_ids, files, pages)
+             for page_number, text in file_pages],
+            conn=conn
+        )
+    return [{"path": path, "invoice_id": invoice_id} for (path, _, _, _), invoice_id in zip(files, invoice_ids)]
+
+
+def run(source: str, state_path: str, batch_size: int, ocr_workers: int,
+        llm_concurrency: int, llm_rate: float):
+    paths = collect_files(source)
+    done = load_state(state_path)
+    pending = [p for p in paths if p not in done]
+    print(f"{len(paths)} files found, {len(paths) - len(pending)} already ingested, {len(pending)} to go.")
+    stats = Stats(len(pending))
+    if not pending:
+        return stats
+
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    seen = {}
+
+    def stage(paths: list) -> list:
+        start = time.perf_counter()
+        staged, duplicates, repeats = stage_files(paths, seen)
+        append_state(state_path, duplicates)
+        stats.skipped += len(duplicates) + repeats
+        stats.stage_seconds["stage"] += time.perf_counter() - start
+        return staged
+
+    configure_gemini_client(max_concurrency=llm_concurrency, rate=llm_rate)
+    with ProcessPoolExecutor(max_workers=ocr_workers) as ocr_pool:
+        chunk = stage(chunks[0])
+        next_ocr = ocr_pool.map(extract_pages, [blob_path for _, blob_path, _, _ in chunk])
+        for i in range(len(chunks)):
+            start = time.perf_counter()
+            pages = list(next_ocr)
+            texts = [pages_text(file_pages) for file_pages in pages]
+            stats.stage_seconds["ocr"] += time.perf_counter() - start
+            # Start OCR on the next chunk while this one goes through the LLM.
+            if i + 1 < len(chunks):
+                next_chunk = stage(chunks[i + 1])
+                next_ocr = ocr_pool.map(extract_pages, [blob_path for _, blob_path, _, _ in next_chunk])
+
+            start = time.perf_counter()
+            invoices = asyncio.run(extract_chunk(texts))
+            stats.stage_seconds["extract"] += time.perf_counter() - start
+
+            keep = [j for j, inv in enumerate(invoices) if inv]
+            stats.failed += len(chunk) - len(keep)
+            for j in range(len(chunk)):
+                if not invoices[j]:
+                    print("Extraction failed, will retry on next run:", chunk[j][0])
+            if keep:
+                kept = [invoices[j] for j in keep]
+                start = time.perf_counter()
+                embed_chunk(kept)
+                stats.stage_seconds["embed"] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                try:
+                    records = store_chunk([chunk[j] for j in keep], [pages[j] for j in keep], kept)
+                except Exception as e:
+                    print("Error storing chunk:", e)
+                    stats.failed += len(keep)
+                else:
+                    append_state(state_path, records)
+                    stats.stored += len(records)
+                stats.stage_seconds["insert"] += time.perf_counter() - start
+            stats.progress()
+            if i + 1 < len(chunks):
+                chunk = next_chunk
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Directory of invoice images/PDFs, or a .zip/.tar archive")
+    parser.add_argument("--state", help="Resume state file (default: <source>.ingest.jsonl)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--ocr-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--llm-concurrency", type=int, default=4)
+    parser.add_argument("--llm-rate", type=float, default=4.0, help="Max Gemini requests per second")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT, help="Tenant the invoices are stored for")
+    args = parser.parse_args(argv)
+
+    state_path = args.state or os.path.abspath(args.source).rstrip(os.sep) + ".ingest.jsonl"
+    with use_tenant(args.tenant):
+        stats = run(args.source, state_path, args.batch_size, args.ocr_workers,
+                    args.llm_concurrency, args.llm_rate)
+    stats.summary()
+    return 0 if stats.failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Background ingestion worker for uploads queued by the Streamlit app.
+
+    python ingest_worker.py --workers 2
+
+Each worker process claims jobs from the ingest_jobs table
+(migrations/004_ingest_jobs.sql) and takes them through OCR, Gemini
+extraction, embedding and the DB insert, updating the job status at every
+step so the app can show progress. Failed jobs are retried up to
+INGEST_MAX_ATTEMPTS times. A worker holds a lease on its job and renews it
+every INGEST_HEARTBEAT_SECONDS while it works; every worker periodically
+puts jobs whose heartbeat stopped for INGEST_STALE_SECONDS (a crashed or
+hung worker) back on the queue, and the old worker can no longer store them.
+
+Workers are not daemon processes, so a PDF job can OCR its pages in its own
+process pool (img2text/pdf2text.py). They are stopped through a shared event
+when the parent exits, and terminated if they don't finish in time.
+
+The app starts INGEST_WORKERS of these itself (default 1); set it to 0 when
+running workers separately with this script.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import argparse
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from db.jobs import (claim_job, set_job_status, fail_job, heartbeat_job, requeue_stale_jobs,
+                     INGEST_HEARTBEAT_SECONDS, INGEST_STALE_SECONDS)
+from db.blob_store import find_duplicate, image_hashes
+from db.tenants import current_tenant, use_tenant
+from metrics import get_metrics, start_trace, use_trace
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "1"))
+# How long stop_workers waits for a worker to finish its current job.
+INGEST_STOP_TIMEOUT = float(os.getenv("INGEST_STOP_TIMEOUT", "30"))
+
+
+def process_job(job_id: int, file_path: str, digest: str = None, phash: int = None,
+                tenant_id: str = None) -> int:
+    """Take one claimed job to a stored invoice of the job's tenant (default: the current one)."""
+    with use_tenant(tenant_id or current_tenant()):
+        return _process_job(job_id, file_path, digest, phash)
+
+
+def _process_job(job_id: int, file_path: str, digest: str = None, phash: int = None) -> int:
+    # Imported here so the parent process doesn't load the models.
+    from llm.query_llm import extract_invoice_image, extract_invoice_pdf, normalize_invoice_fields
+    from llm.embeddings import get_embedding_service, invoice_embedding_text
+    from db.db_handler import insert_invoice, insert_invoice_images_bulk, unit_of_work
+
+    if digest is None:
+        digest, phash = image_hashes(file_path)
+    # The same file may have been stored since it was queued.
+    duplicate = find_duplicate(digest, max_distance=-1)
+    if duplicate:
+        set_job_status(job_id, "stored", invoice_id=duplicate[0])
+        return duplicate[0]
+
+    on_stage = lambda stage: set_job_status(job_id, stage)  # noqa: E731
+    if file_path.lower().endswith(".pdf"):
+        pages, extracted = extract_invoice_pdf(file_path, on_stage=on_stage)
+    else:
+        ocr_text, extracted = extract_invoice_image(file_path, on_stage=on_stage)
+        pages = [(1, ocr_text)]
+    if not extracted:
+        raise ValueError("no fields could be extracted")
+    invoice = normalize_invoice_fields(extracted)
+
+    set_job_status(job_id, "embedding")
+    vector = get_embedding_service().embed_one(invoice_embedding_text(invoice))
+    invoice.vector_embedding = json.dumps(vector)
+
+    # Invoice, its page rows and the job's final state commit together.
+    with unit_of_work() as conn:
+        invoice_id = insert_invoice(invoice, conn=conn)
+        insert_invoice_images_bulk(
+            [(invoice_id, file_path, text, digest, phash, page_number) for page_number, text in pages],
+            conn=conn
+        )
+        set_job_status(job_id, "stored", invoice_id=invoice_id, conn=conn)
+    return invoice_id
+
+
+@contextmanager
+def job_heartbeat(job_id: int, interval: float = INGEST_HEARTBEAT_SECONDS):
+    """Renew this worker's lease on the job from a background thread while the block runs."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                if not heartbeat_job(job_id):
+                    return
+            except Exception as e:
+                print("Error renewing ingest job lease:", e)
+
+    thread = threading.Thread(target=beat, name=f"ingest-heartbeat-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue_if_due(last_run: float) -> float:
+    """Run requeue_stale_jobs every INGEST_STALE_SECONDS; returns when it last ran."""
+    now = time.monotonic()
+    if now - last_run < INGEST_STALE_SECONDS:
+        return last_run
+    try:
+        requeue_stale_jobs()
+    except Exception as e:
+        print("Error requeueing stale ingest jobs:", e)
+    return now
+
+
+def worker_loop(poll_seconds: float = INGEST_POLL_SECONDS, stop_event=None):
+    if stop_event is not None:
+        # Ctrl+C reaches the whole process group; the parent stops us through
+        # the event instead, so the current job isn't cut off half-way.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    requeued = time.monotonic()  # start_workers has just run it
+    while stop_event is None or not stop_event.is_set():
+        requeued = requeue_if_due(requeued)
+        try:
+            job = claim_job()
+        except Exception as e:
+            print("Error claiming ingest job:", e)
+            job = None
+        if job is None:
+            if stop_event is None:
+                time.sleep(poll_seconds)
+            else:
+                stop_event.wait(poll_seconds)
+            continue
+        job_id = job[0]
+        trace = start_trace("ingest", job_id=job_id, tenant=job[4])
+        try:
+            with use_trace(trace), job_heartbeat(job_id):
+                process_job(*job)
+        except Exception as e:
+            trace.set("error", str(e))
+            print(f"Ingest job {job_id} failed:", e)
+            try:
+                fail_job(job_id, str(e))
+            except Exception as db_error:
+                print("Error recording job failure:", db_error)
+        finally:
+            get_metrics().finish_trace(trace)
+
+
+def start_workers(count: int = INGEST_WORKERS, poll_seconds: float = INGEST_POLL_SECONDS) -> list:
+    """
+    Start `count` worker processes. They are stopped by stop_workers, which
+    also runs when the parent exits.
+    """
+    try:
+        requeue_stale_jobs()
+    except Exception as e:
+        print("Error requeueing stale ingest jobs:", e)
+    # spawn: children must not inherit the parent's DB connections or model threads.
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    workers = []
+    for i in range(count):
+        # Not daemonic: daemon processes can't have children, and PDF pages
+        # are OCR'd in a pool started by the worker.
+        process = context.Process(target=worker_loop, args=(poll_seconds, stop_event),
+                                  name=f"ingest-worker-{i}", daemon=False)
+        process.start()
+        workers.append(process)
+    # Runs before multiprocessing's own exit handler, which would otherwise
+    # wait forever for non-daemon children.
+    atexit.register(stop_workers, workers, stop_event)
+    return workers
+
+
+def stop_workers(workers: list, stop_event, timeout: float = INGEST_STOP_TIMEOUT):
+    """Ask the workers to stop after their current job; terminate those that don't."""
+    stop_event.set()
+    deadline = time.monotonic() + timeout
+    for process in workers:
+        process.join(max(0.0, deadline - time.monotonic()))
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=max(1, INGEST_WORKERS))
+    parser.add_argument("--poll-interval", type=float, default=INGEST_POLL_SECONDS)
+    args = parser.parse_args(argv)
+
+    workers = start_workers(args.workers, args.poll_interval)
+    print(f"{len(workers)} ingest worker(s) running. Ctrl+C to stop.")
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        print("Stopping ingest workers after their current job...")
+    # stop_workers runs at exit (start_workers registers it).
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
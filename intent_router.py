@@ -0,0 +1,522 @@
+import re
+import time
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+from db.db_handler import get_connection
+from llm.retrieval import extract_filters, fetch_invoices_by_keys, resolve_invoice_numbers, QueryFilters, MONTHS
+from llm.followup import is_followup
+from db.invoice_items import like_pattern
+from db.analytics import get_analytics_snapshot
+from db.tenants import current_tenant
+from metrics import get_metrics, current_trace, inc
+
+SUM_RE = re.compile(r"\b(sum|total spend|total spent|spent in total|grand total|total of all|total amount of all|altogether|combined)\b", re.I)
+AVG_RE = re.compile(r"\b(average|mean|avg)\b", re.I)
+COUNT_RE = re.compile(r"\bhow many invoices\b|\bnumber of invoices\b|\bcount (?:of )?(?:the )?invoices\b", re.I)
+MAX_RE = re.compile(r"\b(highest|largest|biggest|most expensive|maximum|max)\b", re.I)
+MIN_RE = re.compile(r"\b(lowest|smallest|cheapest|least expensive|minimum|min)\b", re.I)
+TOP_SPENDER_RE = re.compile(r"\bwho (?:has )?(?:spent|spends|paid) the most\b|\btop (?:customer|spender)\b|\bbiggest spender\b", re.I)
+DIFFERENCE_RE = re.compile(r"\b(difference|compare|vs\.?|versus)\b", re.I)
+DATE_FIELD_RE = re.compile(r"\b(date|when|issued)\b", re.I)
+TOTAL_FIELD_RE = re.compile(r"\b(total|amount|cost|price|how much)\b", re.I)
+SUPPLIER_FIELD_RE = re.compile(r"\b(supplier|vendor|seller|bought from|purchased from)\b", re.I)
+CUSTOMER_FIELD_RE = re.compile(r"\b(customer name|who bought|buyer|billed to)\b", re.I)
+ITEMS_FIELD_RE = re.compile(r"\b(items?|products?|what did .* (?:buy|purchase))\b", re.I)
+NUMBER_FIELD_RE = re.compile(r"\binvoice (?:number|no)\b", re.I)
+
+# Item questions, answered from invoice_items (migrations/007_invoice_items.sql).
+ITEM_QUOTED_RE = re.compile(r"[\"'‘“]([^\"'’”]{2,60})[\"'’”]")
+ITEM_TERM_RE = re.compile(
+    r"\b(?:contains?|containing|includes?|including|spent on|spend on|spending on|bought|purchased|ordered)\s+"
+    r"(?!from\b)(?:an?\s+|any\s+|the\s+|some\s+)?([a-z][\w\s-]{1,40}?)"
+    r"(?=\s*(?:[?.!,]|$|\b(?:in|on|from|during|since|last|this|between|before|after|by|and)\b))",
+    re.I
+)
+ITEM_QUANTITY_RE = re.compile(
+    r"\bhow many ([a-z][\w\s-]{1,40}?)\s+(?:were|was|have been|did we|did i)?\s*(?:bought|purchased|sold|ordered)\b", re.I
+)
+ITEM_CONTAINS_RE = re.compile(r"\b(contains?|containing|includes?|including|which invoices|who bought|who purchased|any invoice)\b", re.I)
+ITEM_SPEND_RE = re.compile(r"\b(spent on|spend on|spending on|how much .*\b(?:on|for))\b", re.I)
+ITEM_COUNT_RE = re.compile(r"\bhow many (?:line )?items\b|\bnumber of (?:line )?items\b|\bitem count\b", re.I)
+# Group-by and top-N questions, answered from the columnar snapshot (db/analytics.py).
+GROUP_BY_RE = re.compile(r"\b(?:per|by|for each|each|across)\s+(customer|supplier|vendor|month)s?\b", re.I)
+TOP_N_RE = re.compile(r"\b(top|bottom)\s+(?:(\d+)\s+)?(customers|spenders|suppliers|vendors|invoices|months)\b", re.I)
+ANALYTICS_MAX_GROUPS = 10
+
+NOT_ITEMS = {
+    "it", "this", "that", "them", "what", "anything", "something", "the most", "most", "items", "item",
+    "invoices", "invoice", "everything", "all", "total", "amount",
+}
+
+
+def format_amount(value) -> str:
+    try:
+        return f"₹{float(value):,.2f}"
+    except (TypeError, ValueError):
+        return str(value)
+
+
+@dataclass
+class RoutedAnswer:
+    intent: str
+    answer: str
+    invoices: list = field(default_factory=list)
+
+
+class RouterStats:
+    """How many questions were answered by SQL without an LLM call."""
+
+    def __init__(self):
+        self.total = 0
+        self.served = 0
+        self.by_intent = {}
+        self.errors = 0
+        self.skipped_text_amounts = 0
+        self._lock = threading.Lock()
+
+    def record(self, intent: Optional[str]):
+        with self._lock:
+            self.total += 1
+            if intent:
+                self.served += 1
+                self.by_intent[intent] = self.by_intent.get(intent, 0) + 1
+
+    def record_skipped_amounts(self):
+        """An amount question left to the LLM because total_amount is still TEXT."""
+        with self._lock:
+            self.total += 1
+            self.skipped_text_amounts += 1
+        inc("router_skipped_total", reason="text_total_amount")
+
+    def record_error(self, error: Exception):
+        """A failed SQL route; the question falls through to the LLM path."""
+        with self._lock:
+            self.errors += 1
+        inc("router_errors_total", error=type(error).__name__)
+        trace = current_trace()
+        if trace is not None:
+            trace.set("router_error", f"{type(error).__name__}: {error}")
+
+    @property
+    def served_fraction(self) -> float:
+        return self.served / self.total if self.total else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "total": self.total,
+            "served_without_llm": self.served,
+            "served_fraction": round(self.served_fraction, 4),
+            "by_intent": dict(self.by_intent),
+            "errors": self.errors,
+            "skipped_text_amounts": self.skipped_text_amounts,
+        }
+
+
+router_stats = RouterStats()
+get_metrics().register_collector("router", router_stats.as_dict)
+
+# SUM/AVG/ORDER BY and amount filters on total_amount need the NUMERIC column
+# of migrations/008_numeric_total_amount.sql; on the old TEXT column they fail
+# or compare strings. Checked once it is NUMERIC, every minute until then.
+NUMERIC_AMOUNTS_RECHECK_SECONDS = 60
+_numeric_amounts = False
+_numeric_amounts_checked = None
+
+
+def _amounts_are_numeric(cur) -> bool:
+    global _numeric_amounts, _numeric_amounts_checked
+    now = time.monotonic()
+    if _numeric_amounts or (
+        _numeric_amounts_checked is not None and now - _numeric_amounts_checked < NUMERIC_AMOUNTS_RECHECK_SECONDS
+    ):
+        return _numeric_amounts
+    cur.execute(
+        """
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'data_of_invoices' AND column_name = 'total_amount';
+        """
+    )
+    row = cur.fetchone()
+    _numeric_amounts = bool(row) and row[0] == "numeric"
+    _numeric_amounts_checked = now
+    return _numeric_amounts
+
+
+def _uses_amounts(question: str, filters: QueryFilters) -> bool:
+    """Whether routing the question would aggregate, sort or filter on total_amount."""
+    if filters.min_amount is not None or filters.max_amount is not None:
+        return True
+    return any(regex.search(question) for regex in (TOP_SPENDER_RE, AVG_RE, SUM_RE, MAX_RE, MIN_RE))
+
+
+# A word after one of these prepositions (or before 's) narrows the question to
+# someone or something: "from Amazon", "for Neha Joshi", "Ravi's invoices",
+# "on headphones". The SQL paths only handle the qualifiers they parse (dates,
+# amounts, known customer/supplier names, the item term); with any other the
+# question goes to the LLM rather than being answered for the whole table.
+QUALIFIER_RE = re.compile(r"\b(?:from|for|by|at|of|on|in|to|with)\s+(?:(?:the|a|an|my|our)\s+)?([^\W\d_][\w&.-]*)", re.I)
+POSSESSIVE_RE = re.compile(r"\b([^\W\d_][\w&.-]*)['’]s\b", re.I)
+SCOPE_WORDS = frozenset("""
+all each every any this that these those them it us me last next previous past current recent
+invoice invoices bill bills purchase purchases order orders total totals amount amounts value
+sum average mean spend spending spent money count number
+customer customers supplier suppliers vendor vendors spender spenders buyer buyers
+date dates day days week weeks month months quarter quarters year years today yesterday
+time period range database data records system table list rs inr usd
+""".split()) | frozenset(MONTHS)
+
+
+def _match_names(question: str, snapshot) -> dict:
+    """Known customer and supplier names mentioned in the question, {"customer": [...], "supplier": [...]}."""
+    lowered = question.lower()
+    found = {"customer": [], "supplier": []}
+    if snapshot is None:
+        return found
+    for key in found:
+        for label in snapshot.labels.get(key, ()):
+            name = label.lower()
+            if len(name) > 2 and name != "n/a" and re.search(rf"(?<!\w){re.escape(name)}(?!\w)", lowered):
+                found[key].append(label)
+    return found
+
+
+def _unparsed_qualifiers(question: str, names: dict) -> list:
+    """Qualifier words the SQL paths would ignore (see QUALIFIER_RE)."""
+    known = set(SCOPE_WORDS)
+    for label in names["customer"] + names["supplier"]:
+        known.update(label.lower().split())
+    term = extract_item_term(question)
+    if term:
+        known.update(term.lower().split())
+    words = [m.group(1).lower().rstrip(".") for m in QUALIFIER_RE.finditer(question)]
+    words += [m.group(1).lower() for m in POSSESSIVE_RE.finditer(question)]
+    return [word for word in words if word not in known]
+
+
+def _range_where(filters: QueryFilters):
+    # Always scoped to the current tenant, so the WHERE is never empty.
+    clauses = ["tenant_id = %s"]
+    params = [current_tenant()]
+    if filters.date_from is not None:
+        clauses.append("invoice_date >= %s")
+        params.append(filters.date_from)
+    if filters.date_to is not None:
+        clauses.append("invoice_date <= %s")
+        params.append(filters.date_to)
+    if filters.min_amount is not None:
+        clauses.append("total_amount >= %s")
+        params.append(filters.min_amount)
+    if filters.max_amount is not None:
+        clauses.append("total_amount <= %s")
+        params.append(filters.max_amount)
+    if filters.customers:
+        clauses.append("lower(customer) = ANY(%s)")
+        params.append([name.lower() for name in filters.customers])
+    if filters.suppliers:
+        clauses.append("lower(supplier) = ANY(%s)")
+        params.append([name.lower() for name in filters.suppliers])
+    return " WHERE " + " AND ".join(clauses), params
+
+
+def _scope(filters: QueryFilters) -> str:
+    scope = ""
+    if filters.customers:
+        scope += " for " + " or ".join(filters.customers)
+    if filters.suppliers:
+        scope += " from " + " or ".join(filters.suppliers)
+    if filters.date_from and filters.date_to:
+        return scope + f" between {filters.date_from} and {filters.date_to}"
+    if filters.date_from:
+        return scope + f" since {filters.date_from}"
+    if filters.date_to:
+        return scope + f" up to {filters.date_to}"
+    return scope
+
+
+def _describe(inv: dict) -> str:
+    return (
+        f"Invoice {inv['invoice_number']} ({inv['customer']}) from {inv['supplier']} on {inv['invoice_date']}. "
+        f"Total {format_amount(inv['total_amount'])}; Items: {inv['items']}."
+    )
+
+
+def _answer_lookup(question: str, invoices: list) -> Optional[str]:
+    if not invoices:
+        return None
+    if len(invoices) == 2 and DIFFERENCE_RE.search(question):
+        a, b = invoices
+        try:
+            diff = abs(float(a["total_amount"]) - float(b["total_amount"]))
+        except (TypeError, ValueError):
+            return None
+        return (
+            f"Invoice {a['invoice_number']} ({format_amount(a['total_amount'])}) vs. "
+            f"Invoice {b['invoice_number']} ({format_amount(b['total_amount'])}): difference {format_amount(diff)}."
+        )
+    if len(invoices) != 1:
+        return "\n".join(_describe(inv) for inv in invoices)
+    inv = invoices[0]
+    if NUMBER_FIELD_RE.search(question) and not DATE_FIELD_RE.search(question):
+        return f"The invoice number is {inv['invoice_number']}."
+    if DATE_FIELD_RE.search(question):
+        return f"Invoice {inv['invoice_number']} was issued on {inv['invoice_date']}."
+    if SUPPLIER_FIELD_RE.search(question):
+        return f"{inv['customer']} bought from {inv['supplier']}."
+    if CUSTOMER_FIELD_RE.search(question):
+        return f"Invoice {inv['invoice_number']} was billed to {inv['customer']}."
+    if ITEMS_FIELD_RE.search(question) and not TOTAL_FIELD_RE.search(question):
+        return f"Invoice {inv['invoice_number']} ({inv['customer']}) items: {inv['items']}."
+    if TOTAL_FIELD_RE.search(question) and not ITEMS_FIELD_RE.search(question):
+        return f"Invoice {inv['invoice_number']} ({inv['customer']}) total is {format_amount(inv['total_amount'])}."
+    return _describe(inv)
+
+
+def _answer_aggregate(cur, question: str, filters: QueryFilters) -> Optional[RoutedAnswer]:
+    where, params = _range_where(filters)
+    scope = _scope(filters)
+
+    if TOP_SPENDER_RE.search(question):
+        cur.execute(
+            "SELECT customer, SUM(total_amount) FROM data_of_invoices" + where +
+            " GROUP BY customer ORDER BY 2 DESC NULLS LAST LIMIT 1;",
+            params
+        )
+        row = cur.fetchone()
+        if not row:
+            return RoutedAnswer("top_spender", f"No invoices found{scope}.")
+        return RoutedAnswer("top_spender", f"{row[0]} spent the most{scope}: {format_amount(row[1])}.")
+
+    if COUNT_RE.search(question):
+        cur.execute("SELECT COUNT(*) FROM data_of_invoices" + where + ";", params)
+        return RoutedAnswer("count", f"There are {cur.fetchone()[0]} invoices{scope}.")
+
+    if AVG_RE.search(question):
+        cur.execute("SELECT AVG(total_amount), COUNT(*) FROM data_of_invoices" + where + ";", params)
+        avg, count = cur.fetchone()
+        if not count:
+            return RoutedAnswer("average", f"No invoices found{scope}.")
+        return RoutedAnswer("average", f"The average invoice total{scope} is {format_amount(avg)} across {count} invoices.")
+
+    if SUM_RE.search(question):
+        cur.execute("SELECT SUM(total_amount), COUNT(*) FROM data_of_invoices" + where + ";", params)
+        total, count = cur.fetchone()
+        if not count:
+            return RoutedAnswer("sum", f"No invoices found{scope}.")
+        return RoutedAnswer("sum", f"The total of {count} invoices{scope} is {format_amount(total)}.")
+
+    for regex, order, intent in ((MAX_RE, "DESC", "max"), (MIN_RE, "ASC", "min")):
+        if regex.search(question) and re.search(r"\b(invoice|amount|total|bill|purchase)", question, re.I):
+            cur.execute(
+                """
+                SELECT customer_id, invoice_number, customer, supplier,
+                    to_char(invoice_date, 'YYYY-MM-DD') as invoice_date, items, total_amount
+                FROM data_of_invoices""" + where + f"""
+                ORDER BY total_amount {order} NULLS LAST, customer_id
+                LIMIT 1;
+                """,
+                params
+            )
+            row = cur.fetchone()
+            if not row:
+                return RoutedAnswer(intent, f"No invoices found{scope}.")
+            inv = dict(zip(("customer_id", "invoice_number", "customer", "supplier", "invoice_date", "items", "total_amount"), row))
+            label = "highest" if intent == "max" else "lowest"
+            return RoutedAnswer(intent, f"The {label} invoice{scope} is {_describe(inv)}", [inv])
+    return None
+
+
+def extract_item_term(question: str) -> Optional[str]:
+    """The product a question is about: a quoted name, or the phrase after contains/bought/spent on."""
+    match = ITEM_QUOTED_RE.search(question)
+    if match:
+        return match.group(1).strip()
+    for regex in (ITEM_QUANTITY_RE, ITEM_TERM_RE):
+        match = regex.search(question)
+        if match:
+            term = match.group(1).strip()
+            if term.lower() not in NOT_ITEMS:
+                return term
+    return None
+
+
+def _answer_items(cur, question: str, filters: QueryFilters) -> Optional[RoutedAnswer]:
+    """
+    Item questions served by the trigram-indexed invoice_items table: how many
+    line items an invoice has, which invoices contain a product, how many
+    units were bought and how much was spent on it.
+    """
+    scope_ids = None
+    if filters.has_keys:
+        scope_ids = [inv["customer_id"] for inv in fetch_invoices_by_keys(cur, filters)]
+        if not scope_ids:
+            return None
+
+    if scope_ids and ITEM_COUNT_RE.search(question):
+        cur.execute(
+            """
+            SELECT d.invoice_number, COUNT(i.id), COALESCE(SUM(i.quantity), 0)
+            FROM data_of_invoices d LEFT JOIN invoice_items i ON i.invoice_id = d.customer_id
+            WHERE d.customer_id = ANY(%s)
+            GROUP BY d.customer_id, d.invoice_number ORDER BY d.customer_id;
+            """,
+            (scope_ids,)
+        )
+        lines = [f"Invoice {number} has {count} line items ({units:g} units)." for number, count, units in cur.fetchall()]
+        return RoutedAnswer("item_count", "\n".join(lines))
+
+    term = extract_item_term(question)
+    if not term:
+        return None
+    where, params = _range_where(filters)
+    conditions = ["i.description ILIKE %s", where[len(" WHERE "):]]
+    params = [like_pattern(term)] + params
+    if scope_ids:
+        conditions.append("d.customer_id = ANY(%s)")
+        params.append(scope_ids)
+    condition = " AND ".join(conditions)
+    scope = _scope(filters)
+
+    if ITEM_SPEND_RE.search(question) or ITEM_QUANTITY_RE.search(question):
+        cur.execute(
+            f"""
+            SELECT COALESCE(SUM(i.amount), 0), COALESCE(SUM(i.quantity), 0),
+                COUNT(DISTINCT i.invoice_id), COUNT(*) FILTER (WHERE i.amount IS NULL)
+            FROM invoice_items i JOIN data_of_invoices d ON d.customer_id = i.invoice_id
+            WHERE {condition};
+            """,
+            params
+        )
+        spent, units, invoices, unpriced = cur.fetchone()
+        if not invoices:
+            return RoutedAnswer("item_spend", f"No invoices contain '{term}'{scope}.")
+        if ITEM_QUANTITY_RE.search(question):
+            return RoutedAnswer("item_quantity", f"{units:g} × '{term}' bought across {invoices} invoices{scope}.")
+        note = f" ({unpriced} lines had no printed amount)" if unpriced else ""
+        return RoutedAnswer(
+            "item_spend", f"{format_amount(spent)} spent on '{term}' across {invoices} invoices{scope}{note}."
+        )
+
+    if ITEM_CONTAINS_RE.search(question):
+        cur.execute(
+            f"""
+            SELECT d.customer_id, d.invoice_number, d.customer, d.supplier,
+                to_char(d.invoice_date, 'YYYY-MM-DD') AS invoice_date, d.items, d.total_amount
+            FROM data_of_invoices d
+            WHERE EXISTS (SELECT 1 FROM invoice_items i WHERE i.invoice_id = d.customer_id AND {condition})
+            ORDER BY d.customer_id
+            LIMIT 50;
+            """,
+            params
+        )
+        keys = ("customer_id", "invoice_number", "customer", "supplier", "invoice_date", "items", "total_amount")
+        invoices = [dict(zip(keys, row)) for row in cur.fetchall()]
+        if not invoices:
+            return RoutedAnswer("item_contains", f"No invoices contain '{term}'{scope}.")
+        listed = "; ".join(f"{inv['invoice_number']} ({inv['customer']}, {inv['invoice_date']})" for inv in invoices)
+        return RoutedAnswer("item_contains", f"{len(invoices)} invoices contain '{term}'{scope}: {listed}.", invoices)
+    return None
+
+
+def _group_key(word: str) -> str:
+    word = word.lower().rstrip("s")
+    return {"spender": "customer", "vendor": "supplier"}.get(word, word)
+
+
+def _wants_grouped(question: str) -> bool:
+    return bool(GROUP_BY_RE.search(question) or TOP_N_RE.search(question))
+
+
+def _answer_grouped(question: str, filters: QueryFilters, snapshot) -> Optional[RoutedAnswer]:
+    """Per-customer/supplier/month aggregates and top-N lists, vectorised over the snapshot."""
+    group = GROUP_BY_RE.search(question)
+    top = TOP_N_RE.search(question)
+    if not group and not top:
+        return None
+    selected = snapshot.mask(filters.date_from, filters.date_to, filters.min_amount, filters.max_amount,
+                             filters.customers, filters.suppliers)
+    scope = _scope(filters)
+    ascending = bool(top and top.group(1).lower() == "bottom")
+    limit = int(top.group(2)) if top and top.group(2) else (5 if top else ANALYTICS_MAX_GROUPS)
+
+    if top and _group_key(top.group(3)) == "invoice":
+        invoices = snapshot.top_invoices(limit, selected, ascending=ascending)
+        if not invoices:
+            return RoutedAnswer("top_invoices", f"No invoices found{scope}.")
+        lines = [
+            f"{i}. {inv['invoice_number']} ({inv['customer']}, {inv['invoice_date']}): {format_amount(inv['total_amount'])}"
+            for i, inv in enumerate(invoices, 1)
+        ]
+        label = "Lowest" if ascending else "Top"
+        return RoutedAnswer("top_invoices", f"{label} {len(invoices)} invoices by total{scope}:\n" + "\n".join(lines), invoices)
+
+    key = _group_key(group.group(1) if group else top.group(3))
+    if COUNT_RE.search(question) or re.search(r"\bhow many\b", question, re.I):
+        agg, label = "count", "Invoices"
+    elif AVG_RE.search(question):
+        agg, label = "mean", "Average invoice total"
+    elif MAX_RE.search(question) and not top:
+        agg, label = "max", "Largest invoice"
+    elif MIN_RE.search(question) and not top:
+        agg, label = "min", "Smallest invoice"
+    else:
+        agg, label = "sum", "Total spend"
+    rows = snapshot.group_by(key, agg, selected, top=limit if top or key != "month" else None, ascending=ascending)
+    if not rows:
+        return RoutedAnswer("group_by", f"No invoices found{scope}.")
+    lines = [
+        f"- {name}: {int(value) if agg == 'count' else format_amount(value)}"
+        + ("" if agg == "count" else f" ({count} invoice{'' if count == 1 else 's'})")
+        for name, value, count in rows
+    ]
+    return RoutedAnswer("group_by", f"{label} per {key}{scope}:\n" + "\n".join(lines))
+
+
+def route_query(question: str, allow_followup: bool = False) -> Optional[RoutedAnswer]:
+    """
+    Answer aggregate and lookup questions with indexed SQL, without the LLM.
+    Returns None when the question needs the retrieval + LLM path.
+    Unresolved follow-ups are declined unless the caller has already
+    rewritten them (allow_followup=True).
+    """
+    routed = None
+    if allow_followup or not is_followup(question):
+        filters = extract_filters(question)
+        try:
+            # Refreshing the snapshot takes its own connection, so do it before taking ours.
+            # One view for the whole question: a refresh can't swap the columns under a mask.
+            snapshot = get_analytics_snapshot().view()
+            if not filters.has_keys and not filters.candidate_numbers:
+                names = _match_names(question, snapshot)
+                ambiguous = set(names["customer"]) & set(names["supplier"])
+                if ambiguous or _unparsed_qualifiers(question, names):
+                    router_stats.record(None)
+                    return None
+                filters.customers, filters.suppliers = names["customer"], names["supplier"]
+            with get_connection() as conn, conn.cursor() as cur:
+                if filters.candidate_numbers:
+                    # "Summarize AMD-2024-559": a lookup if such an invoice exists, else not ours to answer.
+                    if not resolve_invoice_numbers(cur, filters).has_keys:
+                        router_stats.record(None)
+                        return None
+                if not filters.has_keys and _uses_amounts(question, filters) and not _amounts_are_numeric(cur):
+                    router_stats.record_skipped_amounts()
+                    return None
+                routed = _answer_items(cur, question, filters)
+                if routed is None and filters.has_keys:
+                    invoices = fetch_invoices_by_keys(cur, filters)
+                    answer = _answer_lookup(question, invoices)
+                    if answer:
+                        routed = RoutedAnswer("lookup", answer, invoices)
+                    elif filters.customer_ids and not invoices:
+                        ids = ", ".join(str(i) for i in filters.customer_ids)
+                        routed = RoutedAnswer("lookup", f"Customer ID {ids} not found.")
+                elif routed is None:
+                    if _wants_grouped(question):
+                        routed = _answer_grouped(question, filters, snapshot)
+                    routed = routed or _answer_aggregate(cur, question, filters)
+        except Exception as e:
+            router_stats.record_error(e)
+            routed = None
+    router_stats.record(routed.intent if routed else None)
+    return routed
@@ -0,0 +1,140 @@
+import re
+from psycopg2.extras import execute_values
+
+ITEM_COLUMNS = ["invoice_id", "line_no", "description", "quantity", "unit_price", "amount"]
+
+NUMBER_RE = re.compile(r"-?\d[\d,]*(?:\.\d+)?")
+# "Headphones x2", "Headphones × 2", "2 x Headphones", "Headphones (2)"
+QTY_SUFFIX_RE = re.compile(r"^(.*?)\s*(?:[x×]\s*(\d+(?:\.\d+)?)|\((\d+(?:\.\d+)?)\))$", re.I)
+QTY_PREFIX_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*[x×]\s+(.+)$", re.I)
+# A trailing price: "Headphones 1,299.00", "Headphones - ₹1299"
+PRICE_SUFFIX_RE = re.compile(r"^(.*?)\s*[-:@]?\s*(?:₹|rs\.?|inr|\$)\s*([\d,]+(?:\.\d+)?)$|^(.*?)\s+([\d,]+\.\d{2})$", re.I)
+
+
+def to_number(value):
+    """'₹1,299.00' / '2' / 2 -> float; None when there is no number."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER_RE.search(str(value))
+    if not match:
+        return None
+    try:
+        return float(match.group(0).replace(",", ""))
+    except ValueError:
+        return None
+
+
+def _line_item(description, quantity=None, unit_price=None, amount=None):
+    description = " ".join(str(description or "").split())
+    if not description or description.upper() == "N/A":
+        return None
+    quantity, unit_price, amount = to_number(quantity), to_number(unit_price), to_number(amount)
+    if amount is None and quantity is not None and unit_price is not None:
+        amount = round(quantity * unit_price, 2)
+    if unit_price is None and amount is not None and quantity:
+        unit_price = round(amount / quantity, 2)
+    return {"description": description, "quantity": quantity, "unit_price": unit_price, "amount": amount}
+
+
+def parse_item_text(text: str):
+    """One pipe-separated entry of the legacy items string -> line item dict."""
+    text = " ".join(text.split())
+    amount = None
+    match = PRICE_SUFFIX_RE.match(text)
+    if match:
+        text = (match.group(1) if match.group(1) is not None else match.group(3)).strip()
+        amount = match.group(2) or match.group(4)
+    quantity = None
+    match = QTY_SUFFIX_RE.match(text)
+    if match:
+        text, quantity = match.group(1), match.group(2) or match.group(3)
+    else:
+        match = QTY_PREFIX_RE.match(text)
+        if match:
+            quantity, text = match.group(1), match.group(2)
+    return _line_item(text, quantity=quantity, amount=amount)
+
+
+def parse_items_string(items: str) -> list:
+    """Legacy "A | B x2 | C ₹100" strings -> list of line item dicts."""
+    if not items or str(items).strip().upper() == "N/A":
+        return []
+    separator = "|" if "|" in items else ";"
+    return [item for item in (parse_item_text(part) for part in str(items).split(separator)) if item]
+
+
+def normalize_line_items(raw) -> list:
+    """
+    Items as returned by the extraction prompt (a JSON list of objects), or a
+    legacy string, -> list of {description, quantity, unit_price, amount}.
+    """
+    if isinstance(raw, str):
+        return parse_items_string(raw)
+    if not isinstance(raw, list):
+        return []
+    items = []
+    for entry in raw:
+        if isinstance(entry, dict):
+            item = _line_item(
+                entry.get("description") or entry.get("name") or entry.get("item"),
+                entry.get("quantity") or entry.get("qty"),
+                entry.get("unit_price") or entry.get("price"),
+                entry.get("amount") or entry.get("total"),
+            )
+        else:
+            item = parse_item_text(str(entry))
+        if item:
+            items.append(item)
+    return items
+
+
+def items_summary(line_items: list) -> str:
+    """The pipe-joined string kept in data_of_invoices.items for display and prompts."""
+    parts = []
+    for item in line_items:
+        quantity = item.get("quantity")
+        if quantity and quantity != 1:
+            parts.append(f"{item['description']} x{quantity:g}")
+        else:
+            parts.append(item["description"])
+    return " | ".join(parts) if parts else "N/A"
+
+
+def insert_items(cur, invoice_id: int, line_items: list):
+    rows = [
+        (invoice_id, line_no, item["description"], item.get("quantity"), item.get("unit_price"), item.get("amount"))
+        for line_no, item in enumerate(line_items, 1)
+    ]
+    insert_item_rows(cur, rows)
+
+
+def insert_item_rows(cur, rows: list):
+    """rows are tuples in ITEM_COLUMNS order."""
+    if rows:
+        execute_values(
+            cur,
+            f"INSERT INTO invoice_items ({', '.join(ITEM_COLUMNS)}) VALUES %s",
+            rows,
+            page_size=1000
+        )
+
+
+def item_stem(term: str) -> str:
+    """Crude stem so "burgers" matches "Burger" and "batteries" matches "Battery" ("batter")."""
+    lower = term.lower()
+    if len(lower) > 4 and lower.endswith(("ies", "y")):
+        return term[:-3] if lower.endswith("ies") else term[:-1]
+    if len(lower) > 4 and lower.endswith(("ches", "shes", "xes", "sses")):
+        return term[:-2]
+    if len(lower) > 3 and lower.endswith("s") and not lower.endswith("ss"):
+        return term[:-1]
+    return term
+
+
+def like_pattern(term: str) -> str:
+    """ILIKE pattern for a product name (escaped, stemmed, substring match)."""
+    term = item_stem(term.strip())
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
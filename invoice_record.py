@@ -0,0 +1,194 @@
+import re
+from datetime import date, datetime
+from decimal import Decimal
+import numpy as np
+
+TEXT_FIELDS = ("invoice_number", "customer", "supplier", "items")
+
+CURRENCY_RE = re.compile(r"(₹|rs\.?|inr|usd|eur|gbp|\$|€|£)", re.I)
+AMOUNT_RE = re.compile(r"\(?-?\d[\d.,'  ]*")
+ORDINAL_RE = re.compile(r"(\d)(st|nd|rd|th)\b", re.I)
+AMOUNT_LIMIT = 1e10  # total_amount is NUMERIC(12,2): at most 10 integer digits
+# Tried in order; day-first before month-first, as on Indian invoices.
+DATE_FORMATS = (
+    "%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y%m%d",
+    "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%m-%y", "%d.%m.%y",
+    "%d %b %Y", "%d %B %Y", "%d %b, %Y", "%d %B, %Y", "%d-%b-%Y", "%d-%B-%Y", "%d %b %y", "%d-%b-%y", "%d/%b/%Y",
+    "%b %d %Y", "%B %d %Y", "%b %d, %Y", "%B %d, %Y",
+    "%m/%d/%Y", "%m-%d-%Y",
+    "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M", "%d-%m-%Y %H:%M",
+)
+
+
+def _clean_text(value) -> str:
+    if value is None:
+        return "N/A"
+    text = " ".join(str(value).split())
+    return text or "N/A"
+
+
+def parse_amount(value):
+    """
+    '₹5,658.10' / 'Rs. 1,23,456' / '1.234,56 €' / 5658.1 -> float rounded to
+    paise; None when there is no number, or one too large for the column.
+    The last '.' or ',' followed by one or two digits is the decimal point,
+    every other separator is grouping.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        number = float(value)
+        return None if number != number or abs(round(number, 2)) >= AMOUNT_LIMIT else round(number, 2)
+    match = AMOUNT_RE.search(CURRENCY_RE.sub("", str(value)))
+    if not match:
+        return None
+    token = match.group(0).strip().rstrip(".,")
+    negative = token.startswith(("(", "-"))
+    digits = re.sub(r"[^\d.,]", "", token)
+    last = max(digits.rfind("."), digits.rfind(","))
+    if last != -1 and 1 <= len(digits) - last - 1 <= 2:
+        whole, fraction = digits[:last], digits[last + 1:]
+    else:
+        whole, fraction = digits, ""
+    whole = re.sub(r"[.,]", "", whole)
+    if not whole and not fraction:
+        return None
+    number = round(float(f"{whole or 0}.{fraction or 0}"), 2)
+    if number >= AMOUNT_LIMIT:
+        return None
+    return -number if negative else number
+
+
+def parse_date(value):
+    """Invoice date in any of DATE_FORMATS (or a date/datetime) -> date; None when unparseable."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = ORDINAL_RE.sub(r"\1", " ".join(str(value).split()))
+    if not text or text.upper() == "N/A":
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _memoized(values, parse) -> list:
+    # Extracted and stored values repeat a lot (same supplier format, same
+    # day); parse each distinct value once.
+    cache = {}
+    out = []
+    for value in values:
+        key = value if isinstance(value, (str, int, float)) else None
+        if key is None:
+            out.append(parse(value))
+            continue
+        if key not in cache:
+            cache[key] = parse(value)
+        out.append(cache[key])
+    return out
+
+
+def parse_amounts(values) -> np.ndarray:
+    """parse_amount over a column -> float64 array, NaN where missing."""
+    try:
+        # NUMERIC values and clean strings convert in one pass.
+        numbers = np.round(np.array(values, dtype=np.float64), 2)
+        numbers[np.abs(numbers) >= AMOUNT_LIMIT] = np.nan
+        return numbers
+    except (TypeError, ValueError):
+        parsed = _memoized(values, parse_amount)
+        return np.array([np.nan if number is None else number for number in parsed], dtype=np.float64)
+
+
+def parse_dates(values) -> np.ndarray:
+    """parse_date over a column -> datetime64[D] array, NaT where missing."""
+    try:
+        # ISO strings and date objects convert in one pass.
+        return np.array([value if value else "NaT" for value in values], dtype="datetime64[D]")
+    except ValueError:
+        parsed = _memoized(values, parse_date)
+        return np.array([day if day else "NaT" for day in parsed], dtype="datetime64[D]")
+
+
+class Invoice:
+    """
+    One invoice row. Slots instead of a per-instance dict keep the fetch path
+    small, and the typed fields (date, float total) are what gets written,
+    so total_amount aggregates in SQL. Item-style access (inv["customer"],
+    inv.get("items")) is kept for code written against the old row dicts.
+    """
+
+    __slots__ = ("customer_id", "invoice_number", "customer", "supplier", "invoice_date",
+                 "items", "total_amount", "vector_embedding", "line_items")
+
+    def __init__(self, customer_id=None, invoice_number="N/A", customer="N/A", supplier="N/A",
+                 invoice_date=None, items="N/A", total_amount=None, vector_embedding=None, line_items=None):
+        self.customer_id = customer_id
+        self.invoice_number = invoice_number
+        self.customer = customer
+        self.supplier = supplier
+        self.invoice_date = invoice_date
+        self.items = items
+        self.total_amount = total_amount
+        self.vector_embedding = vector_embedding
+        self.line_items = line_items or []
+
+    @classmethod
+    def from_extracted(cls, data: dict) -> "Invoice":
+        """Normalize one extraction result (strings, numbers or None in any field)."""
+        fields = {key: _clean_text(data.get(key)) for key in TEXT_FIELDS}
+        raw_date = data.get("invoice_date")
+        invoice_date = parse_date(raw_date)
+        if invoice_date is None and raw_date not in (None, "", "N/A"):
+            print(f"Could not parse invoice date {raw_date!r}; storing it as empty.")
+        return cls(
+            customer_id=data.get("customer_id"),
+            invoice_date=invoice_date,
+            total_amount=parse_amount(data.get("total_amount")),
+            vector_embedding=data.get("vector_embedding"),
+            line_items=data.get("line_items"),
+            **fields
+        )
+
+    @classmethod
+    def coerce(cls, data) -> "Invoice":
+        return data if isinstance(data, cls) else cls.from_extracted(data)
+
+    @classmethod
+    def from_row(cls, row) -> "Invoice":
+        """(customer_id, invoice_number, customer, supplier, invoice_date, items, total_amount, vector_embedding)"""
+        customer_id, invoice_number, customer, supplier, invoice_date, items, total_amount, vector_embedding = row
+        return cls(customer_id, invoice_number, customer, supplier, invoice_date, items,
+                   None if total_amount is None else float(total_amount), vector_embedding)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def to_dict(self) -> dict:
+        data = {key: getattr(self, key) for key in self.__slots__}
+        data["invoice_date"] = self.invoice_date.isoformat() if self.invoice_date else None
+        return data
+
+    def __repr__(self):
+        return (f"Invoice(customer_id={self.customer_id!r}, invoice_number={self.invoice_number!r}, "
+                f"invoice_date={self.invoice_date!r}, total_amount={self.total_amount!r})")
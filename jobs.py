@@ -0,0 +1,151 @@
+import os
+import socket
+from psycopg2.extras import RealDictCursor
+from db.db_handler import get_connection, unit_of_work
+from db.tenants import current_tenant
+
+JOB_STATES = ("queued", "ocr", "extracting", "embedding", "stored", "failed")
+FINAL_STATES = ("stored", "failed")
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+# A job whose worker hasn't sent a heartbeat for this long goes back on the queue.
+INGEST_STALE_SECONDS = int(os.getenv("INGEST_STALE_SECONDS", "120"))
+INGEST_HEARTBEAT_SECONDS = float(os.getenv("INGEST_HEARTBEAT_SECONDS", "20"))
+
+
+def job_worker_id() -> str:
+    """Lease holder name of this process (migrations/012_ingest_job_leases.sql)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_job(file_path: str, file_name: str, content_sha256: str = None, phash: int = None) -> int:
+    """
+    Queue a file for the current tenant; the same content already waiting or
+    in progress for that tenant returns that job instead. One statement
+    against the partial unique index of migrations/013, so two uploads of
+    the same file at once can't both queue it.
+    """
+    with unit_of_work() as conn, conn.cursor() as cur:
+        # The no-op update makes RETURNING give the existing job's id on a conflict.
+        cur.execute(
+            """
+            INSERT INTO ingest_jobs (file_path, file_name, content_sha256, phash, tenant_id)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (tenant_id, content_sha256) WHERE status NOT IN ('stored', 'failed')
+            DO UPDATE SET content_sha256 = EXCLUDED.content_sha256
+            RETURNING id;
+            """,
+            (file_path, file_name, content_sha256, phash, current_tenant())
+        )
+        return cur.fetchone()[0]
+
+
+def claim_job():
+    """
+    Take the oldest queued job, mark it as in OCR and lease it to this
+    process (job_worker_id). SKIP LOCKED lets any number of workers poll the
+    table without handing out the same job twice.
+    Returns (job_id, file_path, content_sha256, phash, tenant_id) or None when the queue is empty.
+    """
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = 'ocr', attempts = attempts + 1, locked_by = %s, heartbeat_at = now(), updated_at = now()
+            WHERE id = (
+                SELECT id FROM ingest_jobs WHERE status = 'queued'
+                ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, file_path, content_sha256, phash, tenant_id;
+            """,
+            (job_worker_id(),)
+        )
+        return cur.fetchone()
+
+
+def heartbeat_job(job_id: int) -> bool:
+    """Renew this process's lease on a job; False once the job was taken back or finished."""
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE ingest_jobs SET heartbeat_at = now()
+            WHERE id = %s AND locked_by = %s AND status NOT IN ('queued', 'stored', 'failed');
+            """,
+            (job_id, job_worker_id())
+        )
+        return cur.rowcount == 1
+
+
+def set_job_status(job_id: int, status: str, invoice_id: int = None, error: str = None, conn=None):
+    """
+    Move a job this process holds to `status`. Raises if the lease was lost
+    (the job was requeued and may be in another worker's hands), which rolls
+    back a unit_of_work storing the invoice.
+    """
+    if conn is None:
+        with unit_of_work() as conn:
+            return set_job_status(job_id, status, invoice_id, error, conn=conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = %s, invoice_id = COALESCE(%s, invoice_id), error = %s,
+                heartbeat_at = now(), updated_at = now()
+            WHERE id = %s AND locked_by = %s;
+            """,
+            (status, invoice_id, error, job_id, job_worker_id())
+        )
+        if cur.rowcount == 0:
+            raise RuntimeError(f"Ingest job {job_id} is no longer leased to this worker")
+
+
+def fail_job(job_id: int, error: str):
+    """Re-queue the job if it has attempts left, otherwise mark it failed. Only the lease holder can."""
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END,
+                error = %s, locked_by = NULL, updated_at = now()
+            WHERE id = %s AND locked_by = %s;
+            """,
+            (INGEST_MAX_ATTEMPTS, error[:1000], job_id, job_worker_id())
+        )
+
+
+def requeue_stale_jobs(max_age_seconds: int = INGEST_STALE_SECONDS) -> int:
+    """
+    Put jobs whose worker stopped sending heartbeats (it died, or hangs) back
+    on the queue and release their lease. A job that has used up its attempts
+    is marked failed instead: a file that kills the worker process (OOM or a
+    crash in OCR) would otherwise be retried forever. Workers run this every
+    INGEST_STALE_SECONDS.
+    """
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END,
+                error = CASE WHEN attempts < %s THEN error
+                        ELSE 'Worker stopped while processing this file (' || status || '), ' || attempts || ' attempts' END,
+                locked_by = NULL,
+                updated_at = now()
+            WHERE status NOT IN ('queued', 'stored', 'failed')
+              AND COALESCE(heartbeat_at, updated_at) < now() - make_interval(secs => %s);
+            """,
+            (INGEST_MAX_ATTEMPTS, INGEST_MAX_ATTEMPTS, max_age_seconds)
+        )
+        return cur.rowcount
+
+
+def fetch_jobs(job_ids: list) -> list:
+    if not job_ids:
+        return []
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT id, file_name, status, invoice_id, error, attempts, created_at, updated_at
+            FROM ingest_jobs WHERE id = ANY(%s) AND tenant_id = %s ORDER BY id;
+            """,
+            (list(job_ids), current_tenant())
+        )
+        return cur.fetchall()
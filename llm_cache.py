@@ -0,0 +1,200 @@
+import os
+import re
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import get_metrics
+
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1000"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))  # seconds
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory").lower()  # memory | sqlite | postgres
+LLM_CACHE_SQLITE_PATH = os.getenv("LLM_CACHE_SQLITE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_PERSISTENT_SIZE = int(os.getenv("LLM_CACHE_PERSISTENT_SIZE", "100000"))
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", prompt).strip().lower()
+
+
+def make_key(prompt: str, model: str, data_version=None, namespace: str = "llm") -> str:
+    raw = "\0".join([namespace, model, str(data_version), normalize_prompt(prompt)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SQLiteTier:
+    """Persistent second tier in a local SQLite file."""
+
+    def __init__(self, path: str = LLM_CACHE_SQLITE_PATH, max_entries: int = LLM_CACHE_PERSISTENT_SIZE):
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._puts = 0
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, created_at REAL)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0], row[1]
+
+    def put(self, key: str, value: str, expires_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, time.time())
+            )
+            self._puts += 1
+            if self._puts % 100 == 0:
+                self._conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+
+
+class PostgresTier:
+    """Persistent second tier in the llm_cache table (migrations/003_llm_cache.sql)."""
+
+    def __init__(self, max_entries: int = LLM_CACHE_PERSISTENT_SIZE):
+        self.max_entries = max_entries
+        self._puts = 0
+
+    def get(self, key: str):
+        from db.db_handler import get_connection
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT value, EXTRACT(EPOCH FROM expires_at) FROM llm_cache WHERE key = %s AND expires_at > now();",
+                (key,)
+            )
+            row = cur.fetchone()
+        return (row[0], float(row[1])) if row else None
+
+    def put(self, key: str, value: str, expires_at: float):
+        from db.db_handler import unit_of_work
+        self._puts += 1
+        with unit_of_work() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO llm_cache (key, value, expires_at) VALUES (%s, %s, to_timestamp(%s))
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at, created_at = now();
+                """,
+                (key, value, expires_at)
+            )
+            if self._puts % 100 == 0:
+                cur.execute("DELETE FROM llm_cache WHERE expires_at < now();")
+                cur.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY created_at DESC OFFSET %s);",
+                    (self.max_entries,)
+                )
+
+
+class LLMCache:
+    """
+    In-memory LRU with per-entry TTL, optionally backed by a persistent tier.
+    Values are strings (responses, or JSON for structured results).
+    """
+
+    def __init__(self, max_entries: int = LLM_CACHE_SIZE, ttl: int = LLM_CACHE_TTL, persistent=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persistent = persistent
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+        if self.persistent is not None:
+            try:
+                found = self.persistent.get(key)
+            except Exception as e:
+                print("LLM cache read error:", e)
+                found = None
+            if found is not None:
+                self._remember(key, found[0], found[1])
+                with self._lock:
+                    self.hits += 1
+                    self.persistent_hits += 1
+                return found[0]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: str, value: str, expires_at: float):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key: str, value: str, ttl: int = None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._remember(key, value, expires_at)
+        if self.persistent is not None:
+            try:
+                self.persistent.put(key, value, expires_at)
+            except Exception as e:
+                print("LLM cache write error:", e)
+
+    def get_json(self, key: str):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def put_json(self, key: str, value, ttl: int = None):
+        self.put(key, json.dumps(value), ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "persistent_hits": self.persistent_hits,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                persistent = None
+                if LLM_CACHE_BACKEND == "sqlite":
+                    persistent = SQLiteTier()
+                elif LLM_CACHE_BACKEND == "postgres":
+                    persistent = PostgresTier()
+                _cache = LLMCache(persistent=persistent)
+                get_metrics().register_collector("llm_cache", _cache.stats)
+    return _cache
@@ -0,0 +1,210 @@
+import os
+import time
+import queue
+import random
+import asyncio
+import threading
+import google.generativeai as genai
+from metrics import get_metrics, current_trace, record_usage
+
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_RATE_LIMIT = float(os.getenv("GEMINI_RATE_LIMIT", "10"))  # requests per second, 0 = unlimited
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))  # seconds per attempt
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+def is_retryable(error: Exception) -> bool:
+    """429 and 5xx from google.api_core (which carry an HTTP .code), and timeouts."""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUS
+
+
+class TokenBucket:
+    """Async token bucket: `rate` requests per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class GeminiClient:
+    """
+    Shared asyncio Gemini client.
+
+    One GenerativeModel handle, generate_content_async on a private event loop
+    thread, a semaphore bounding in-flight requests, a token-bucket rate
+    limit, exponential backoff with jitter on 429/5xx/timeouts, and coalescing
+    of identical prompts that are already in flight. `model` can be any object
+    with an async generate_content_async(prompt), e.g. a local fake; calls can
+    pass another model (one bound to a context cache, see prompts.py).
+    Prompt characters and prompt tokens are totalled for the default model so
+    callers can measure characters per token.
+    """
+
+    def __init__(self, model_name: str = GEMINI_MODEL, model=None,
+                 max_concurrency: int = GEMINI_MAX_CONCURRENCY, rate: float = GEMINI_RATE_LIMIT,
+                 max_retries: int = GEMINI_MAX_RETRIES, timeout: float = GEMINI_TIMEOUT):
+        self.model_name = model_name
+        self.model = model if model is not None else genai.GenerativeModel(model_name)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.requests = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.prompt_chars = 0
+        self.prompt_tokens = 0
+        self._inflight = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True)
+        self._thread.start()
+        # Created on the client's loop so they are bound to it.
+        self._semaphore, self._bucket = self._run(self._make_limits(max_concurrency, rate))
+
+    async def _make_limits(self, max_concurrency, rate):
+        return asyncio.Semaphore(max_concurrency), TokenBucket(rate, capacity=max_concurrency)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _record_usage(self, prompt: str, usage, trace, model):
+        record_usage(usage, trace)
+        tokens = getattr(usage, "prompt_token_count", None) or 0
+        if model is None and tokens:
+            self.prompt_chars += len(prompt)
+            self.prompt_tokens += tokens
+
+    async def _attempts(self, prompt: str, trace=None, model=None) -> str:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    await self._bucket.acquire()
+                    self.requests += 1
+                    response = await asyncio.wait_for(
+                        (model or self.model).generate_content_async(prompt), self.timeout
+                    )
+                self._record_usage(prompt, getattr(response, "usage_metadata", None), trace, model)
+                return response.text.strip()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                self.retries += 1
+                delay = GEMINI_BACKOFF_BASE * (2 ** attempt)
+                await asyncio.sleep(delay + random.uniform(0, delay))
+
+    async def _generate(self, prompt: str, trace=None, model=None) -> str:
+        key = prompt if model is None else (id(model), prompt)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._attempts(prompt, trace, model))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def generate_async(self, prompt: str, model=None) -> str:
+        """Awaitable from any event loop; the request itself runs on the client's loop."""
+        # The request runs on the client's loop, so the caller's trace is passed along.
+        future = asyncio.run_coroutine_threadsafe(self._generate(prompt, current_trace(), model), self._loop)
+        return await asyncio.wrap_future(future)
+
+    def generate(self, prompt: str, model=None) -> str:
+        """Blocking call for synchronous code (Streamlit script thread, LangChain _call)."""
+        return self._run(self._generate(prompt, current_trace(), model))
+
+    async def _stream_into(self, prompt: str, out: queue.Queue, trace=None, model=None):
+        sent_any = False
+        usage = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with self._semaphore:
+                        await self._bucket.acquire()
+                        self.requests += 1
+                        response = await asyncio.wait_for(
+                            (model or self.model).generate_content_async(prompt, stream=True), self.timeout
+                        )
+                        async for chunk in response:
+                            # Token counts arrive with the last chunk.
+                            usage = getattr(chunk, "usage_metadata", None) or usage
+                            if chunk.text:
+                                sent_any = True
+                                out.put(chunk.text)
+                    self._record_usage(prompt, usage, trace, model)
+                    return
+                except Exception as e:
+                    # Once tokens have reached the caller a retry would duplicate them.
+                    if sent_any or attempt >= self.max_retries or not is_retryable(e):
+                        raise
+                    self.retries += 1
+                    delay = GEMINI_BACKOFF_BASE * (2 ** attempt)
+                    await asyncio.sleep(delay + random.uniform(0, delay))
+        except Exception as e:
+            out.put(e)
+        finally:
+            out.put(None)
+
+    def stream(self, prompt: str, model=None):
+        """Blocking generator of text chunks as Gemini produces them."""
+        out = queue.Queue()
+        asyncio.run_coroutine_threadsafe(self._stream_into(prompt, out, current_trace(), model), self._loop)
+        while True:
+            item = out.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight),
+            "prompt_chars": self.prompt_chars,
+            "prompt_tokens": self.prompt_tokens,
+        }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_gemini_client() -> GeminiClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GeminiClient()
+                get_metrics().register_collector("gemini", lambda: _client.stats())
+    return _client
+
+
+def configure_gemini_client(**kwargs) -> GeminiClient:
+    """Replace the shared client, e.g. with batch-specific limits or a fake model."""
+    global _client
+    with _client_lock:
+        _client = GeminiClient(**kwargs)
+    return _client
@@ -0,0 +1,133 @@
+import os
+from collections import OrderedDict, deque
+
+CHAT_MEMORY_TURNS = int(os.getenv("CHAT_MEMORY_TURNS", "4"))
+CHAT_MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", "1500"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "300"))
+CHAT_MEMORY_INVOICES = int(os.getenv("CHAT_MEMORY_INVOICES", "20"))
+CHAT_MEMORY_RELOAD_TURNS = int(os.getenv("CHAT_MEMORY_RELOAD_TURNS", "8"))
+CHAT_SUMMARY_MODE = os.getenv("CHAT_SUMMARY_MODE", "local").lower()  # local | llm
+
+SUMMARY_PROMPT = """Update the running summary of a conversation about invoices.
+Keep it under {max_words} words. Keep invoice numbers, customer names, dates and amounts exactly.
+
+Current summary:
+{summary}
+
+New exchange:
+User: {user}
+Bot: {bot}
+
+Updated summary:"""
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English/Gemini; close enough for budgeting.
+    return len(text) // 4 + 1
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def local_summarizer(summary: str, user: str, bot: str, max_tokens: int = CHAT_SUMMARY_TOKENS) -> str:
+    """Append a clipped line per evicted turn and drop the oldest lines past the budget."""
+    lines = [line for line in summary.split("\n") if line]
+    lines.append(f"- Q: {_clip(user, 100)} A: {_clip(bot, 160)}")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def llm_summarizer(summary: str, user: str, bot: str, max_tokens: int = CHAT_SUMMARY_TOKENS) -> str:
+    from llm.query_llm import GeminiLLM
+    prompt = SUMMARY_PROMPT.format(max_words=max_tokens * 3 // 4, summary=summary or "(empty)", user=user, bot=bot)
+    try:
+        return GeminiLLM()._call(prompt).strip() or local_summarizer(summary, user, bot, max_tokens)
+    except Exception as e:
+        print("Error updating chat summary:", e)
+        return local_summarizer(summary, user, bot, max_tokens)
+
+
+class ChatMemory:
+    """
+    Bounded conversation memory for the chat prompt.
+
+    The last `max_turns` exchanges are kept verbatim as long as they fit in
+    `token_budget`; older ones are folded into a rolling summary one turn at a
+    time, and the invoices referenced during the session are kept as a short
+    id -> label record. render() is what goes into the prompt, so its size
+    stays bounded however long the session runs.
+    """
+
+    def __init__(self, max_turns: int = CHAT_MEMORY_TURNS, token_budget: int = CHAT_MEMORY_TOKENS,
+                 summarizer=None):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summarizer = summarizer or (llm_summarizer if CHAT_SUMMARY_MODE == "llm" else local_summarizer)
+        self.turns = deque()
+        self.summary = ""
+        self.invoices = OrderedDict()
+
+    def add_turn(self, user: str, bot: str, invoices: list = None):
+        self.turns.append((user, bot))
+        for inv in invoices or []:
+            self.remember_invoice(inv)
+        # The latest turn always stays verbatim; follow-ups refer to it.
+        while len(self.turns) > 1 and (len(self.turns) > self.max_turns
+                                       or estimate_tokens(self.render()) > self.token_budget):
+            old_user, old_bot = self.turns.popleft()
+            self.summary = self.summarizer(self.summary, old_user, old_bot)
+
+    def remember_invoice(self, inv: dict):
+        customer_id = inv.get("customer_id")
+        if customer_id is None:
+            return
+        self.invoices[customer_id] = f"{inv.get('invoice_number')} ({inv.get('customer')})"
+        self.invoices.move_to_end(customer_id)
+        while len(self.invoices) > CHAT_MEMORY_INVOICES:
+            self.invoices.popitem(last=False)
+
+    def render(self) -> str:
+        parts = []
+        if self.summary:
+            parts.append("Summary of earlier conversation:\n" + self.summary)
+        if self.invoices:
+            parts.append("Invoices referenced earlier: " + "; ".join(
+                f"customer id {cid}: {label}" for cid, label in self.invoices.items()
+            ))
+        for user, bot in self.turns:
+            parts.append(f"User: {user}\nBot: {bot}")
+        return "\n".join(parts)
+
+    @classmethod
+    def from_messages(cls, messages: list, **kwargs) -> "ChatMemory":
+        """
+        Rebuild memory from stored (role, content) pairs, oldest first.
+        Turns beyond the verbatim window go straight into the summary.
+        """
+        memory = cls(**kwargs)
+        pending_user = None
+        for role, content in messages:
+            if role == "user":
+                pending_user = content
+            elif pending_user is not None:
+                memory.add_turn(pending_user, content)
+                pending_user = None
+        return memory
+
+
+def load_chat_memory(invoice_id: int = None, session_id: str = None, **kwargs):
+    """
+    Rebuild memory for a stored conversation (an invoice's or a chat
+    session's) from the chat_history table. Only the last few turns are
+    read: the verbatim window plus CHAT_MEMORY_RELOAD_TURNS older ones that
+    seed the summary. Returns (memory, messages) with messages as
+    (role, content) pairs, oldest first.
+    """
+    from db.chat_store import fetch_chat_page
+    max_turns = kwargs.get("max_turns", CHAT_MEMORY_TURNS)
+    page, _ = fetch_chat_page(invoice_id, session_id, limit=2 * (max_turns + CHAT_MEMORY_RELOAD_TURNS))
+    messages = [(message["role"], message["content"]) for message in page]
+    return ChatMemory.from_messages(messages, **kwargs), messages
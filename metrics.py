@@ -0,0 +1,320 @@
+"""
+Stage timers, counters and per-request traces.
+
+    from metrics import timer, inc, start_trace, use_trace
+
+    with timer("ocr"):
+        text = ocr_image(image)
+
+Every timer feeds a latency histogram for its stage and, when a trace is
+active (use_trace), a span on that trace. Traces are kept in a ring buffer
+of the last METRICS_TRACE_SIZE requests for the debug panel, and appended
+to METRICS_TRACE_LOG as JSON lines when that is set. prometheus_text()
+renders histograms, counters and registered collectors (cache and client
+stats) in the Prometheus text format; METRICS_PORT serves it over HTTP.
+
+Metrics are per process: the ingest workers keep their own, so point
+METRICS_TRACE_LOG at one file to collect traces from all of them.
+"""
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_TRACE_SIZE = int(os.getenv("METRICS_TRACE_SIZE", "50"))
+METRICS_TRACE_LOG = os.getenv("METRICS_TRACE_LOG", "")  # JSON lines file; empty = off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no HTTP endpoint
+METRICS_PREFIX = "invoicebot"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_trace = ContextVar("current_trace", default=None)
+
+
+class StageStats:
+    """Cumulative latency histogram for one stage."""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "seconds": round(self.total, 6),
+            "mean": round(self.total / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+        }
+
+
+class Trace:
+    """One request: its stage spans plus numeric attributes (tokens, prompt size, cache hits)."""
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.seconds = None
+        self.spans = []  # (stage, offset seconds, duration seconds)
+        self.attrs = dict(attrs)
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, seconds: float, started: float = None):
+        offset = (started if started is not None else time.perf_counter() - seconds) - self._start
+        with self._lock:
+            self.spans.append((stage, round(offset, 6), round(seconds, 6)))
+
+    def add(self, key: str, value=1):
+        with self._lock:
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self.attrs[key] = value
+
+    def stage_seconds(self) -> dict:
+        totals = {}
+        for stage, _, seconds in self.spans:
+            totals[stage] = round(totals.get(stage, 0.0) + seconds, 6)
+        return totals
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+            "stages": self.stage_seconds(),
+            "spans": list(self.spans),
+            **self.attrs,
+        }
+
+
+class Metrics:
+    def __init__(self, trace_size: int = METRICS_TRACE_SIZE, trace_log: str = METRICS_TRACE_LOG):
+        self.trace_log = trace_log
+        self.stages = {}
+        self.counters = {}
+        self.traces = deque(maxlen=trace_size)
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    def _observe_stage(self, stage: str, seconds: float):
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.observe(seconds)
+
+    def observe(self, stage: str, seconds: float, trace: Trace = None, started: float = None):
+        self._observe_stage(stage, seconds)
+        trace = trace if trace is not None else _current_trace.get()
+        if trace is not None:
+            trace.add_span(stage, seconds, started)
+
+    @contextmanager
+    def timer(self, stage: str, trace: Trace = None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, trace, started)
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_collector(self, name: str, collect):
+        """collect() -> dict of numbers (one level of nesting allowed), exported as gauges."""
+        self.collectors[name] = collect
+
+    # --- Traces ---
+    def finish_trace(self, trace: Trace):
+        if trace.seconds is not None:
+            return
+        trace.seconds = round(time.perf_counter() - trace._start, 6)
+        self._observe_stage(f"{trace.name}_total", trace.seconds)
+        with self._lock:
+            self.traces.append(trace)
+        if self.trace_log:
+            try:
+                with open(self.trace_log, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(trace.as_dict(), default=str) + "\n")
+            except Exception as e:
+                print("Error writing trace log:", e)
+
+    def recent_traces(self, n: int = None) -> list:
+        with self._lock:
+            traces = list(self.traces)
+        return [trace.as_dict() for trace in traces[-n if n else None:]]
+
+    # --- Export ---
+    def _collected(self) -> dict:
+        values = {}
+        for name, collect in list(self.collectors.items()):
+            try:
+                data = collect()
+            except Exception as e:
+                print(f"Error collecting {name} metrics:", e)
+                continue
+            for key, value in data.items():
+                if isinstance(value, dict):
+                    for sub, sub_value in value.items():
+                        values[(f"{name}_{key}", (("key", str(sub)),))] = sub_value
+                else:
+                    values[(f"{name}_{key}", ())] = value
+        return {key: value for key, value in values.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {stage: stats.as_dict() for stage, stats in self.stages.items()}
+            counters = {_series(name, labels): value for (name, labels), value in self.counters.items()}
+        gauges = {_series(name, labels): value for (name, labels), value in self._collected().items()}
+        return {"stages": stages, "counters": counters, "gauges": gauges}
+
+    def prometheus_text(self) -> str:
+        lines = [
+            f"# HELP {METRICS_PREFIX}_stage_seconds Wall time per pipeline stage.",
+            f"# TYPE {METRICS_PREFIX}_stage_seconds histogram",
+        ]
+        with self._lock:
+            stages = [(stage, stats.count, stats.total, list(stats.buckets)) for stage, stats in self.stages.items()]
+            counters = sorted(self.counters.items())
+        for stage, count, total, buckets in sorted(stages):
+            for bound, cumulative in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f'{METRICS_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{METRICS_PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+                typed.add(name)
+            lines.append(f"{METRICS_PREFIX}_{_series(name, labels)} {value}")
+        for (name, labels), value in sorted(self._collected().items()):
+            if name not in typed:
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+                typed.add(name)
+            lines.append(f"{METRICS_PREFIX}_{_series(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def json_lines(self, n: int = None) -> str:
+        return "".join(json.dumps(trace, default=str) + "\n" for trace in self.recent_traces(n))
+
+
+def _series(name: str, labels: tuple) -> str:
+    if not labels:
+        return name
+    rendered = ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in labels)
+    return f"{name}{{{rendered}}}"
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics()
+    return _metrics
+
+
+def timer(stage: str, trace: Trace = None):
+    return get_metrics().timer(stage, trace)
+
+
+def inc(name: str, value=1, **labels):
+    get_metrics().inc(name, value, **labels)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def trace_add(key: str, value=1):
+    """Add to a numeric attribute of the active trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(key, value)
+
+
+def start_trace(name: str, **attrs) -> Trace:
+    return Trace(name, **attrs)
+
+
+@contextmanager
+def use_trace(trace: Trace):
+    """Make `trace` the active trace for timers and counters in this context."""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # Reset from another context (an abandoned generator); just clear.
+            _current_trace.set(None)
+
+
+def record_usage(usage, trace: Trace = None):
+    """Token counts from a Gemini response's usage_metadata."""
+    if usage is None:
+        return
+    trace = trace if trace is not None else _current_trace.get()
+    for attr, name in (("prompt_token_count", "prompt_tokens"), ("candidates_token_count", "output_tokens"),
+                       ("cached_content_token_count", "cached_tokens")):
+        count = getattr(usage, attr, None) or 0
+        if count:
+            inc(f"gemini_{name}_total", count)
+            if trace is not None:
+                trace.add(name, count)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body, content_type = get_metrics().prometheus_text(), "text/plain; version=0.0.4"
+        elif self.path.startswith("/traces"):
+            body, content_type = get_metrics().json_lines(), "application/x-ndjson"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """Serve /metrics (Prometheus text) and /traces (JSON lines) from a daemon thread."""
+    if port <= 0:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
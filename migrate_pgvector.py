@@ -0,0 +1,84 @@
+"""
+Move invoice embeddings into the pgvector column.
+
+    python migrate_pgvector.py [--batch-size 500]
+
+Applies migrations/002_pgvector.sql, then converts every row whose embedding
+column is still NULL from its JSON/float8[] vector_embedding, in batches.
+Rows without a usable stored vector are re-embedded with the shared model.
+Safe to re-run; already migrated rows are skipped.
+"""
+import os
+import sys
+import argparse
+from db.db_handler import unit_of_work
+from db.pgvector_store import update_embeddings, EMBEDDING_DIM
+from llm.vector_index import parse_stored_embedding
+from llm.embeddings import get_embedding_service, invoice_embedding_text
+
+MIGRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations", "002_pgvector.sql")
+
+
+def apply_schema():
+    with open(MIGRATION_FILE, "r", encoding="utf-8") as f:
+        sql = f.read()
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(sql)
+
+
+def migrate_batch(batch_size: int, after_id: int):
+    """Convert one batch of rows above after_id. Returns (rows seen, last id)."""
+    with unit_of_work() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT customer_id, invoice_number, customer, supplier,
+                to_char(invoice_date, 'YYYY-MM-DD'), items, total_amount, vector_embedding
+            FROM data_of_invoices
+            WHERE embedding IS NULL AND customer_id > %s
+            ORDER BY customer_id
+            LIMIT %s;
+            """,
+            (after_id, batch_size)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return 0, after_id
+        pairs = []
+        reembed = []
+        for row in rows:
+            vector = parse_stored_embedding(row[7])
+            if vector is None or len(vector) != EMBEDDING_DIM:
+                reembed.append(row)
+            else:
+                pairs.append((row[0], vector))
+        if reembed:
+            keys = ("customer_id", "invoice_number", "customer", "supplier", "invoice_date", "items", "total_amount")
+            texts = [invoice_embedding_text(dict(zip(keys, row))) for row in reembed]
+            vectors = get_embedding_service().embed_batch(texts)
+            pairs += [(row[0], vector) for row, vector in zip(reembed, vectors)]
+        update_embeddings(cur, pairs)
+        return len(rows), rows[-1][0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--skip-schema", action="store_true", help="Don't apply migrations/002_pgvector.sql")
+    args = parser.parse_args(argv)
+
+    if not args.skip_schema:
+        apply_schema()
+    migrated = 0
+    last_id = 0
+    while True:
+        count, last_id = migrate_batch(args.batch_size, last_id)
+        if not count:
+            break
+        migrated += count
+        print(f"Migrated {migrated} rows (up to customer_id {last_id})", flush=True)
+    print(f"Done: {migrated} rows migrated.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
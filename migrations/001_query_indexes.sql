@@ -0,0 +1,7 @@
+-- Indexes behind the SQL fast path (intent_router.py) and the retrieval planner
+-- (retrieval.py). customer_id is already the primary key, so upload-position
+-- lookups (ORDER BY customer_id OFFSET n) use it directly.
+CREATE INDEX IF NOT EXISTS idx_invoices_invoice_number_lower ON data_of_invoices (lower(invoice_number));
+CREATE INDEX IF NOT EXISTS idx_invoices_invoice_date ON data_of_invoices (invoice_date);
+CREATE INDEX IF NOT EXISTS idx_invoices_total_amount ON data_of_invoices (total_amount);
+CREATE INDEX IF NOT EXISTS idx_invoices_customer ON data_of_invoices (customer);
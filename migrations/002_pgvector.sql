@@ -0,0 +1,6 @@
+-- Optional pgvector backend (VECTOR_BACKEND=pgvector). Run migrate_pgvector.py
+-- afterwards to copy the existing JSON vector_embedding values into the new column.
+CREATE EXTENSION IF NOT EXISTS vector;
+ALTER TABLE data_of_invoices ADD COLUMN IF NOT EXISTS embedding vector(384);
+CREATE INDEX IF NOT EXISTS idx_invoices_embedding_hnsw
+    ON data_of_invoices USING hnsw (embedding vector_l2_ops);
@@ -0,0 +1,9 @@
+-- Persistent tier for the LLM response/extraction cache (LLM_CACHE_BACKEND=postgres).
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_expires_at ON llm_cache (expires_at);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_created_at ON llm_cache (created_at);
@@ -0,0 +1,13 @@
+-- Upload queue consumed by ingest_worker.py (see db/jobs.py).
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id SERIAL PRIMARY KEY,
+    file_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',  -- queued | ocr | extracting | embedding | stored | failed
+    invoice_id INT,
+    error TEXT,
+    attempts INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_queued ON ingest_jobs (id) WHERE status = 'queued';
@@ -0,0 +1,9 @@
+-- Content hash and perceptual hash of stored uploads (see db/blob_store.py).
+-- bit_count needs PostgreSQL 14+.
+ALTER TABLE data_invoices_images ADD COLUMN IF NOT EXISTS content_sha256 TEXT;
+ALTER TABLE data_invoices_images ADD COLUMN IF NOT EXISTS phash BIGINT;
+CREATE INDEX IF NOT EXISTS idx_invoice_images_sha256 ON data_invoices_images (content_sha256);
+
+ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS content_sha256 TEXT;
+ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS phash BIGINT;
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_sha256 ON ingest_jobs (content_sha256) WHERE status NOT IN ('stored', 'failed');
@@ -0,0 +1,3 @@
+-- One data_invoices_images row per page for multi-page PDF uploads.
+ALTER TABLE data_invoices_images ADD COLUMN IF NOT EXISTS page_number INT NOT NULL DEFAULT 1;
+CREATE INDEX IF NOT EXISTS idx_invoice_images_invoice_page ON data_invoices_images (invoice_id, page_number);
@@ -0,0 +1,15 @@
+-- Line items, one row each, so item questions can be answered with SQL.
+-- Fill it for existing invoices with: python backfill_items.py
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE TABLE IF NOT EXISTS invoice_items (
+    id SERIAL PRIMARY KEY,
+    invoice_id INT NOT NULL REFERENCES data_of_invoices (customer_id) ON DELETE CASCADE,
+    line_no INT NOT NULL,
+    description TEXT NOT NULL,
+    quantity NUMERIC,
+    unit_price NUMERIC,
+    amount NUMERIC
+);
+CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice_id ON invoice_items (invoice_id);
+-- Serves ILIKE '%headphones%' lookups.
+CREATE INDEX IF NOT EXISTS idx_invoice_items_description_trgm ON invoice_items USING gin (description gin_trgm_ops);
@@ -0,0 +1,22 @@
+-- total_amount held the extracted text ("₹5,658.10"), so SUM/AVG/ORDER BY
+-- either failed or compared strings. Make it NUMERIC; the original text is
+-- kept in total_amount_raw, and values that don't clean up to a plain
+-- number (or use a decimal comma), or don't fit NUMERIC(12,2) (11 or more
+-- integer digits, e.g. an OCR'd phone number), become NULL instead of
+-- aborting the migration.
+ALTER TABLE data_of_invoices ADD COLUMN IF NOT EXISTS total_amount_raw TEXT;
+UPDATE data_of_invoices SET total_amount_raw = total_amount::text WHERE total_amount_raw IS NULL;
+ALTER TABLE data_of_invoices
+    ALTER COLUMN total_amount TYPE NUMERIC(12,2)
+    USING CASE
+        -- Drop the currency prefix ("Rs. "), then grouping commas and spaces.
+        WHEN regexp_replace(regexp_replace(total_amount::text, '^[^0-9-]*', ''), '[^0-9.-]', '', 'g')
+                ~ '^-?[0-9]+(\.[0-9]+)?$'
+            -- "1.234,56": a decimal comma would be read as grouping; leave NULL.
+            AND total_amount::text !~ ',[0-9]{1,2}[^0-9.,]*$'
+        -- Nested CASE: the range check only runs on strings that cast cleanly.
+        THEN CASE
+            WHEN abs(round(regexp_replace(regexp_replace(total_amount::text, '^[^0-9-]*', ''), '[^0-9.-]', '', 'g')::NUMERIC, 2)) < 1e10
+            THEN regexp_replace(regexp_replace(total_amount::text, '^[^0-9-]*', ''), '[^0-9.-]', '', 'g')::NUMERIC(12,2)
+        END
+    END;
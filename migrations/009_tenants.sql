@@ -0,0 +1,11 @@
+-- Tenant (workspace) isolation, see db/tenants.py. Every invoice and upload job
+-- belongs to one tenant; rows from before this migration go to 'default'
+-- (DEFAULT_TENANT). Images, line items and chat history hang off an invoice
+-- and inherit its tenant.
+ALTER TABLE data_of_invoices ADD COLUMN IF NOT EXISTS tenant_id TEXT NOT NULL DEFAULT 'default';
+ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS tenant_id TEXT NOT NULL DEFAULT 'default';
+-- Upload order, counts and high-water marks are per tenant.
+CREATE INDEX IF NOT EXISTS idx_invoices_tenant ON data_of_invoices (tenant_id, customer_id);
+CREATE INDEX IF NOT EXISTS idx_invoices_tenant_invoice_number ON data_of_invoices (tenant_id, lower(invoice_number));
+CREATE INDEX IF NOT EXISTS idx_invoices_tenant_invoice_date ON data_of_invoices (tenant_id, invoice_date);
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_tenant ON ingest_jobs (tenant_id, content_sha256);
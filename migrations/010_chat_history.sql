@@ -0,0 +1,11 @@
+-- Chat history restore and retention, see chat_store.py. Messages belong to
+-- an invoice and/or a chat session (the app's ?session= id, the service's
+-- session_id) and to the tenant that wrote them (009_tenants.sql).
+ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS session_id TEXT;
+ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS tenant_id TEXT NOT NULL DEFAULT 'default';
+-- Restore: newest messages of one conversation, paged by (timestamp, id).
+CREATE INDEX IF NOT EXISTS idx_chat_history_invoice_time ON chat_history (invoice_id, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_chat_history_session_time ON chat_history (session_id, timestamp, id)
+    WHERE session_id IS NOT NULL;
+-- Retention: messages older than CHAT_RETENTION_DAYS.
+CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history (timestamp);
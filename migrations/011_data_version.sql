@@ -0,0 +1,57 @@
+-- Invoice data version per tenant, see answer_cache.py. Every statement that
+-- inserts, updates or deletes invoices (insert_invoice, insert_invoices_bulk,
+-- manual edits) bumps the version of the tenants it touched, in the same
+-- transaction, and sends NOTIFY invoice_data_version '<tenant>:<version>'
+-- when it commits. Cached answers carry the version they were computed at.
+CREATE TABLE IF NOT EXISTS invoice_data_version (
+    tenant_id TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO invoice_data_version (tenant_id, version)
+SELECT DISTINCT tenant_id, 1 FROM data_of_invoices
+ON CONFLICT (tenant_id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_invoice_data_version(tenants TEXT[]) RETURNS void AS $$
+DECLARE
+    bumped RECORD;
+BEGIN
+    FOR bumped IN
+        INSERT INTO invoice_data_version AS v (tenant_id, version)
+        SELECT DISTINCT unnest(tenants), 1
+        ON CONFLICT (tenant_id) DO UPDATE SET version = v.version + 1, updated_at = now()
+        RETURNING tenant_id, version
+    LOOP
+        PERFORM pg_notify('invoice_data_version', bumped.tenant_id || ':' || bumped.version);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement-level, so a bulk insert of 1000 invoices bumps once.
+CREATE OR REPLACE FUNCTION invoice_data_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM bump_invoice_data_version(ARRAY(SELECT tenant_id FROM new_rows));
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM bump_invoice_data_version(ARRAY(
+            SELECT tenant_id FROM new_rows UNION SELECT tenant_id FROM old_rows
+        ));
+    ELSE
+        PERFORM bump_invoice_data_version(ARRAY(SELECT tenant_id FROM old_rows));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS invoice_data_version_insert ON data_of_invoices;
+CREATE TRIGGER invoice_data_version_insert AFTER INSERT ON data_of_invoices
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION invoice_data_changed();
+DROP TRIGGER IF EXISTS invoice_data_version_update ON data_of_invoices;
+CREATE TRIGGER invoice_data_version_update AFTER UPDATE ON data_of_invoices
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION invoice_data_changed();
+DROP TRIGGER IF EXISTS invoice_data_version_delete ON data_of_invoices;
+CREATE TRIGGER invoice_data_version_delete AFTER DELETE ON data_of_invoices
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION invoice_data_changed();
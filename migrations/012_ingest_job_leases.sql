@@ -0,0 +1,8 @@
+-- Job leases, see db/jobs.py. A worker claims a job by writing its id into
+-- locked_by and keeps heartbeat_at current while it works on it.
+-- requeue_stale_jobs only takes back jobs whose heartbeat has stopped, and a
+-- worker whose job was taken back can no longer change it.
+ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS locked_by TEXT;
+ALTER TABLE ingest_jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_active ON ingest_jobs (heartbeat_at)
+    WHERE status NOT IN ('queued', 'stored', 'failed');
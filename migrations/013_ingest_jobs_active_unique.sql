@@ -0,0 +1,18 @@
+-- At most one waiting or in-progress job per file and tenant, so two uploads
+-- of the same file at once share one job (enqueue_job in db/jobs.py uses
+-- this index as its ON CONFLICT arbiter). Duplicates queued before this
+-- migration are failed first, keeping the oldest.
+UPDATE ingest_jobs j
+SET status = 'failed', error = 'Duplicate of job ' || first.id, locked_by = NULL, updated_at = now()
+FROM (
+    SELECT tenant_id, content_sha256, min(id) AS id
+    FROM ingest_jobs
+    WHERE status NOT IN ('stored', 'failed') AND content_sha256 IS NOT NULL
+    GROUP BY tenant_id, content_sha256
+    HAVING count(*) > 1
+) first
+WHERE j.tenant_id = first.tenant_id AND j.content_sha256 = first.content_sha256
+  AND j.id > first.id AND j.status NOT IN ('stored', 'failed');
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ingest_jobs_active_content ON ingest_jobs (tenant_id, content_sha256)
+    WHERE status NOT IN ('stored', 'failed');
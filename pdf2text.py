@@ -0,0 +1,98 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pypdfium2 as pdfium
+from img2text.img2text import ocr_image
+from img2text.preprocess import OCR_TARGET_DPI
+
+# Pages with at least this many characters in their text layer skip OCR.
+PDF_TEXT_MIN_CHARS = int(os.getenv("PDF_TEXT_MIN_CHARS", "20"))
+PDF_OCR_WORKERS = int(os.getenv("PDF_OCR_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+def page_text_layer(page) -> str:
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+
+
+def render_page(page, dpi: int = OCR_TARGET_DPI):
+    """Rasterise one page; PDF user space is 72 units per inch."""
+    return page.render(scale=dpi / 72).to_pil()
+
+
+def _ocr_pdf_page(args) -> str:
+    # Runs in a pool process: open the file there and render only this page,
+    # so no page bitmaps cross process boundaries.
+    path, index, dpi = args
+    pdf = pdfium.PdfDocument(path)
+    try:
+        page = pdf[index]
+        try:
+            return ocr_image(render_page(page, dpi), tile_workers=0)
+        finally:
+            page.close()
+    finally:
+        pdf.close()
+
+
+def iter_pdf_pages(path: str, dpi: int = OCR_TARGET_DPI, workers: int = PDF_OCR_WORKERS):
+    """
+    Yield (page_number, text, source) in page order, source being "text" for
+    pages read from the embedded text layer and "ocr" for rendered pages.
+
+    Pages without a usable text layer are rendered and OCR'd in a pool of
+    `workers` processes, with at most 2 * workers pages in flight so memory
+    stays flat however long the document is. With workers <= 1, or when
+    called from a daemon process (which can't start children), pages are
+    OCR'd one at a time in this process.
+    """
+    pdf = pdfium.PdfDocument(path)
+    try:
+        page_count = len(pdf)
+        text_layers = []
+        for index in range(page_count):
+            page = pdf[index]
+            try:
+                text_layers.append(page_text_layer(page))
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+
+    parallel = workers > 1 and not multiprocessing.current_process().daemon
+    pool = ProcessPoolExecutor(max_workers=workers) if parallel else None
+    pending = deque()
+    try:
+        for index, text in enumerate(text_layers):
+            if len(text.strip()) >= PDF_TEXT_MIN_CHARS:
+                pending.append((index, text, "text"))
+            elif pool is not None:
+                pending.append((index, pool.submit(_ocr_pdf_page, (path, index, dpi)), "ocr"))
+            else:
+                pending.append((index, _ocr_pdf_page((path, index, dpi)), "ocr"))
+            while pending and (len(pending) > 2 * max(1, workers) or _ready(pending[0])):
+                yield _resolve(pending.popleft())
+        while pending:
+            yield _resolve(pending.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def _ready(item) -> bool:
+    return isinstance(item[1], str) or item[1].done()
+
+
+def _resolve(item):
+    index, text, source = item
+    if not isinstance(text, str):
+        try:
+            text = text.result()
+        except Exception as e:
+            print(f"Error during OCR of PDF page {index + 1}:", e)
+            text = ""
+    return index + 1, text, source
@@ -0,0 +1,93 @@
+import os
+import re
+from psycopg2.extras import execute_values
+from db.tenants import current_tenant
+from metrics import timer
+
+# "faiss" (default) keeps the in-process index; "pgvector" searches the
+# embedding vector(384) column inside PostgreSQL (see migrations/002_pgvector.sql).
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "faiss").lower()
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "384"))
+HNSW_EF_SEARCH = int(os.getenv("PGVECTOR_EF_SEARCH", "64"))
+# hnsw.iterative_scan mode (pgvector >= 0.8): keep scanning the graph until k
+# rows pass the filters. "off" to disable.
+HNSW_ITERATIVE_SCAN = os.getenv("PGVECTOR_ITERATIVE_SCAN", "strict_order")
+
+_iterative_scan = None  # whether the installed pgvector has hnsw.iterative_scan, checked once
+
+
+def use_pgvector() -> bool:
+    return VECTOR_BACKEND == "pgvector"
+
+
+def to_pgvector(vector) -> str:
+    """pgvector's text input format: '[0.1,0.2,...]'."""
+    return "[" + ",".join(repr(float(x)) for x in vector) + "]"
+
+
+def supports_iterative_scan(cur) -> bool:
+    global _iterative_scan
+    if _iterative_scan is None:
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';")
+        row = cur.fetchone()
+        version = tuple(int(part) for part in re.findall(r"\d+", row[0])[:2]) if row else ()
+        _iterative_scan = version >= (0, 8)
+    return _iterative_scan
+
+
+def search_similar(cur, query_vector, k: int, where: str = "", params=None) -> list:
+    """
+    Nearest invoices by L2 distance, computed in the database with the HNSW
+    index. `where` is an optional SQL condition on data_of_invoices (alias d)
+    so filters and the similarity search run as one query. Only the current
+    tenant's invoices are searched.
+    Returns (customer_id, distance) pairs, closest first.
+
+    The filters are applied to the rows the HNSW scan yields, so a plain
+    scan can return fewer than k rows when few of the ef_search nearest
+    match. Iterative scans keep going until k rows match; if fewer still
+    come back (older pgvector, or hnsw.max_scan_tuples reached), the query
+    is run again without the index, which is exact.
+    """
+    cur.execute("SET LOCAL hnsw.ef_search = %s;", (max(HNSW_EF_SEARCH, k),))
+    if HNSW_ITERATIVE_SCAN != "off" and supports_iterative_scan(cur):
+        cur.execute("SET LOCAL hnsw.iterative_scan = %s;", (HNSW_ITERATIVE_SCAN,))
+    condition = "d.embedding IS NOT NULL AND d.tenant_id = %s" + (f" AND ({where})" if where else "")
+    params = [current_tenant()] + list(params or [])
+    with timer("vector_search"):
+        rows = _search(cur, query_vector, k, condition, params)
+        if len(rows) < k:
+            # Either the filters match fewer than k rows (then this is cheap:
+            # they are selective) or the graph scan gave up early.
+            cur.execute("SET LOCAL enable_indexscan = off;")
+            rows = _search(cur, query_vector, k, condition, params)
+            cur.execute("SET LOCAL enable_indexscan = on;")
+    return rows
+
+
+def _search(cur, query_vector, k: int, condition: str, params) -> list:
+    cur.execute(
+        f"""
+        SELECT d.customer_id, d.embedding <-> %s::vector AS distance
+        FROM data_of_invoices d
+        WHERE {condition}
+        ORDER BY d.embedding <-> %s::vector
+        LIMIT %s;
+        """,
+        [to_pgvector(query_vector)] + list(params or []) + [to_pgvector(query_vector), k]
+    )
+    return cur.fetchall()
+
+
+def update_embeddings(cur, pairs: list):
+    """Write (customer_id, vector) pairs into the embedding column."""
+    execute_values(
+        cur,
+        """
+        UPDATE data_of_invoices AS d
+        SET embedding = v.embedding::vector
+        FROM (VALUES %s) AS v(customer_id, embedding)
+        WHERE d.customer_id = v.customer_id;
+        """,
+        [(customer_id, to_pgvector(vector)) for customer_id, vector in pairs]
+    )
@@ -0,0 +1,106 @@
+import os
+import numpy as np
+from PIL import Image, ImageOps
+
+OCR_TARGET_DPI = int(os.getenv("OCR_TARGET_DPI", "300"))
+# Assumed page width when the file carries no DPI (phone photos, screenshots): A4.
+OCR_PAGE_WIDTH_INCHES = float(os.getenv("OCR_PAGE_WIDTH_INCHES", "8.27"))
+OCR_MAX_SKEW = float(os.getenv("OCR_MAX_SKEW", "5"))  # degrees searched either way
+OCR_CROP_MARGIN = int(os.getenv("OCR_CROP_MARGIN", "20"))  # pixels kept around the text
+
+
+def scale_to_dpi(image: Image.Image, target_dpi: int = OCR_TARGET_DPI) -> Image.Image:
+    """
+    Resample so text lands at roughly `target_dpi`. Uses the file's DPI when
+    present, otherwise assumes the image spans one page width. Scaling is
+    clamped so tiny thumbnails aren't blown up past what OCR can use.
+    """
+    dpi = image.info.get("dpi")
+    if dpi and dpi[0] and dpi[0] > 1:
+        scale = target_dpi / float(dpi[0])
+    else:
+        scale = target_dpi * OCR_PAGE_WIDTH_INCHES / image.width
+    scale = min(max(scale, 0.2), 3.0)
+    if abs(scale - 1.0) < 0.05:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS if scale < 1 else Image.BICUBIC)
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """Threshold that maximises between-class variance of the grey-level histogram."""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = total - weight_bg
+    mean_bg = np.cumsum(hist * levels)
+    mean_total = mean_bg[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mean_total * weight_bg / total - mean_bg) ** 2 / (weight_bg * weight_fg)
+    between = np.nan_to_num(between)
+    return int(np.argmax(between))
+
+
+def binarize(gray: Image.Image) -> Image.Image:
+    pixels = np.asarray(gray, dtype=np.uint8)
+    threshold = otsu_threshold(pixels)
+    return Image.fromarray(np.where(pixels > threshold, 255, 0).astype(np.uint8))
+
+
+def estimate_skew(binary: Image.Image, max_angle: float = OCR_MAX_SKEW, step: float = 0.5) -> float:
+    """
+    Projection-profile deskew: rotate a small copy through candidate angles and
+    keep the one whose row ink sums vary the most (text lines line up).
+    """
+    small = ImageOps.invert(binary)
+    small.thumbnail((800, 800))
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        rows = np.asarray(small.rotate(float(angle), fillcolor=0), dtype=np.float64).sum(axis=1)
+        score = float(np.var(rows))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def crop_to_text(binary: Image.Image, margin: int = OCR_CROP_MARGIN) -> Image.Image:
+    box = ImageOps.invert(binary).getbbox()
+    if box is None:
+        return binary
+    left, top, right, bottom = box
+    return binary.crop((
+        max(0, left - margin), max(0, top - margin),
+        min(binary.width, right + margin), min(binary.height, bottom + margin),
+    ))
+
+
+def preprocess_image(image: Image.Image) -> Image.Image:
+    """Page image -> deskewed, cropped, black-on-white image at the target DPI."""
+    image = ImageOps.exif_transpose(image)
+    gray = scale_to_dpi(image.convert("L"))
+    binary = binarize(gray)
+    angle = estimate_skew(binary)
+    if angle:
+        binary = binary.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+        binary = binary.point(lambda p: 255 if p > 127 else 0)
+    return crop_to_text(binary)
+
+
+def split_tiles(binary: Image.Image, tile_height: int) -> list:
+    """
+    Cut a tall page into horizontal strips of about `tile_height` pixels.
+    Each cut is moved to the emptiest row near the boundary so it falls between
+    text lines rather than through one.
+    """
+    if binary.height <= tile_height * 1.5:
+        return [binary]
+    ink = (np.asarray(binary, dtype=np.uint8) < 128).sum(axis=1)
+    band = max(1, tile_height // 10)
+    cuts = [0]
+    while binary.height - cuts[-1] > tile_height * 1.5:
+        target = cuts[-1] + tile_height
+        window = ink[target - band:target + band]
+        cuts.append(target - band + int(np.argmin(window)))
+    cuts.append(binary.height)
+    return [binary.crop((0, top, binary.width, bottom)) for top, bottom in zip(cuts, cuts[1:])]
@@ -0,0 +1,370 @@
+"""
+Prompt assembly for the Gemini calls that answer from invoices.
+
+The rule blocks are built once per process (RuleBlock) and always come
+first, so every prompt of a kind starts with the same bytes: Gemini bills a
+repeated prefix at the cached rate, and when a block is big enough for
+explicit context caching (GEMINI_CONTEXT_CACHE) it is uploaded once as
+CachedContent and only the part after it is sent per call.
+
+Invoices go into the prompt as one table row each (invoice_row) instead of
+eight labelled lines; rows are memoized per row version. The invoice
+context is held to PROMPT_CONTEXT_TOKENS using the measured tokens per
+row, and every prompt reports the tokens it saved against the old layout
+(prompt_tokens_saved on the trace, prompt_tokens_saved_total counter).
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+import google.generativeai as genai
+from llm.retrieval import MAX_CONTEXT_INVOICES
+from llm.vector_index import format_invoice_document
+from llm.llm_client import get_gemini_client
+from metrics import get_metrics, inc, trace_add
+
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "2000"))  # invoice rows per prompt
+PROMPT_ROW_CACHE_SIZE = int(os.getenv("PROMPT_ROW_CACHE_SIZE", "50000"))
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "auto").lower()  # auto | off
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# Explicit caches below this size are rejected by the API; smaller blocks
+# still benefit from implicit prefix caching.
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "4096"))
+
+DEFAULT_CHARS_PER_TOKEN = 4.0
+DEFAULT_TOKENS_PER_INVOICE = 40
+# Prompt tokens seen before the measured chars/token ratio replaces the default.
+CALIBRATION_MIN_TOKENS = 2000
+
+DATE_INSTRUCTION = "Today's date is 06 May 2025. Use this as the current date in all time-based reasoning.\n\n"
+
+CONTEXT_LEGEND = """Invoices in the context are a table, one invoice per line:
+id | pos | invoice_number | date | customer | supplier | total | items
+- id is the Customer ID; pos is the Upload Order (1 = oldest, the highest pos = newest).
+- date is YYYY-MM-DD, total is the Total Amount in ₹, items are "description xquantity" separated by "; "."""
+
+QA_RULES = """You are InvoiceBot. Follow these rules for **every** question:
+
+1. **Pronoun Resolution**  
+   - Only if the user uses a pronoun (“it”, “this”, “that”) or asks “summarize it/this invoice”, assume they mean the **most recent** uploaded invoice.
+
+2. **ID vs. Position**  
+   - If the user specifies "customer id X", "id X", or "uid X", fetch the invoice where `customer_id = X`.  
+   - For "invoice N" (plain integer), use upload position (1 = oldest; LAST = newest).  
+   - "first"/"last" always refer to upload order, NOT customer_id.
+
+3. **Customer⇄Supplier Intents**  
+   - “Who bought from <Supplier>?” → list customer(s) for that supplier.  
+   - “From where did <Customer> buy?” → list supplier(s) for that customer.
+
+4. **Date Filtering & Relative Time**  
+   - Support absolute dates (YYYY-MM-DD), ranges (“from A to B”), and relative  
+     (“last week/month”, “past 30 days”, “2 months ago”).  
+
+5. **Amount & Items**  
+   - Highest/lowest/above/below thresholds.  
+   - Count or list items on specific invoices.  
+   - Contain-item queries (“contains ‘Headphones’”).
+
+6. **Aggregation & Comparison**  
+   - Sum, average, difference, total of N invoices, and “who spent the most.”
+
+7. **Complex Filters**  
+   - Odd/even positions, closest to a date, multi-criteria (customer + date range).
+
+8. **Answer Style**  
+   - Concise, direct. No apologies or “context doesn’t include.”  
+   - Always include minimally: Invoice Number, Customer, Date when detailing invoices.  
+   - For supplier/customer queries, single sentence:  
+     “<Customer> bought from <Supplier>.”  
+   - For aggregations, state the result directly.
+   - Do **not** repeat back or confirm user inputs. If they mention “Neha Joshi,” don’t say “Yes, Neha Joshi is a customer name.”  
+   - Simply answer the question directly.
+
+9. **Follow-Up Context**  
+   - If the user’s previous exchange named or summarized a particular invoice (by customer or invoice number), then any unqualified follow-up (“what is invoice number?”, “what date?”, etc.) refers to **that** invoice.
+
+10. **Metadata Suppression**  
+   - Only mention these six fields in your answers:  
+     **Invoice Number**, **Customer**, **Supplier**, **Date**, **Items**, **Total Amount**.  
+   - Do **not** output internal metadata (Customer ID, Upload Order, vector embeddings, etc.) unless the user explicitly asks for it.
+
+11. **Examples**  
+   - Q: “first invoice summary?”  
+     → “The oldest invoice is INV-2001 (K. Patel) on 2024-04-16. Total ₹5 658.10; Items: Shoes, Kurta, Headphones, Burger.”  
+   - Q: “invoice INV-2003 date?”  
+     → “Invoice INV-2003 was issued on 2024-04-27.”  
+   - Q: “who bought from Amazon?”  
+     → “N. Singh bought from Amazon.”  
+   - Q: “last week’s invoices?”  
+     → “Invoices from 2025-05-02 to 2025-05-08: INV-2006, INV-2007 (Totals ₹412.00, ₹440.00).”  
+   - Q: “difference between invoice 2 and 4?”  
+     → “Invoice 2 (₹1 884.46) vs. Invoice 4 (₹2 414.28): difference ₹529.82.”
+   - Q: “summarize customer id 2”  
+     → “Customer ID 2: Invoice INV-3004 (Ravi Kumar) bought from Amazon India on 2025-01-28. Total ₹590.00; Items: Burger.”
+"""
+
+CHAT_RULES = """You are InvoiceBot. Follow these rules for **every** question:
+
+1. **Pronoun Resolution**  
+   - Only if the user uses a pronoun (“it”, “this”, “that”) or asks “summarize it/this invoice”, assume they mean the **most recent** uploaded invoice.
+
+2. **ID vs. Position**  
+   - "customer id X" → exact `customer_id` lookup.  
+   - "invoice N" → upload position N.  
+   - Never mix customer_id with upload order.
+
+3. **Customer⇄Supplier Intents**  
+   - “Who bought from <Supplier>?” → customer(s) for that supplier.  
+   - “From where did <Customer> buy?” → supplier(s) for that customer.
+
+4. **Date & Relative Time**  
+   - Handle YYYY-MM-DD, ranges (A to B), and relative (“last week”, “30 days ago”, etc.).
+
+5. **Amount & Items**  
+   - Threshold, highest/lowest, item counts, contain-item queries.
+
+6. **Aggregation & Comparison**  
+   - Sum, average, difference, top spender.
+
+7. **Complex Filters**  
+   - Odd/even positions, closest to date, multi-criteria.
+
+8. **Answer Style**  
+   - Concise, direct; no apologies or context-missing statements.  
+   - Always include Invoice Number, Customer, Date for invoice details.  
+   - Do **not** repeat back or confirm user inputs. If they mention “Neha Joshi,” don’t say “Yes, Neha Joshi is a customer name.”  
+   - Simply answer the question directly.
+   - Supplier/customer queries in one sentence:  
+     “<Customer> bought from <Supplier>.”  
+   - Aggregations: state result directly.
+
+9. **Follow-Up Context**  
+   - If the user’s previous exchange named or summarized a particular invoice (by customer or invoice number), then any unqualified follow-up (“what is invoice number?”, “what date?”, etc.) refers to **that** invoice.
+
+10. **Metadata Suppression**  
+   - Only mention these six fields in your answers:  
+     **Invoice Number**, **Customer**, **Supplier**, **Date**, **Items**, **Total Amount**.  
+   - Do **not** output internal metadata (Customer ID, Upload Order, vector embeddings, etc.) unless the user explicitly asks for it.
+
+Now answer the user’s question based on chat history and document context."""
+
+QA_PROMPT = """Context:
+{context}
+
+Question: {question}
+Answer:"""
+
+CHAT_PROMPT = """Chat History:
+{chat_history}
+
+Context:
+{context}
+
+Question: {question}
+Answer:"""
+
+
+class TokenMeter:
+    """
+    Token estimates for budgeting. Characters per token is calibrated from
+    the prompt sizes and token counts GeminiClient has seen; tokens per
+    invoice is the running mean over rendered rows.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.row_tokens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def chars_per_token(self) -> float:
+        stats = get_gemini_client().stats()
+        if stats.get("prompt_tokens", 0) < CALIBRATION_MIN_TOKENS:
+            return DEFAULT_CHARS_PER_TOKEN
+        return stats["prompt_chars"] / stats["prompt_tokens"]
+
+    def count(self, text: str, chars_per_token: float = None) -> int:
+        return int(len(text) / (chars_per_token or self.chars_per_token)) + 1
+
+    def observe_row(self, tokens: int):
+        with self._lock:
+            self.rows += 1
+            self.row_tokens += tokens
+
+    @property
+    def tokens_per_invoice(self) -> float:
+        return self.row_tokens / self.rows if self.rows else DEFAULT_TOKENS_PER_INVOICE
+
+    def stats(self) -> dict:
+        return {
+            "chars_per_token": round(self.chars_per_token, 3),
+            "tokens_per_invoice": round(self.tokens_per_invoice, 1),
+            "rows_rendered": self.rows,
+            "row_cache_size": len(_row_cache),
+        }
+
+
+_meter = None
+_meter_lock = threading.Lock()
+
+
+def get_token_meter() -> TokenMeter:
+    global _meter
+    if _meter is None:
+        with _meter_lock:
+            if _meter is None:
+                _meter = TokenMeter()
+                get_metrics().register_collector("prompts", lambda: _meter.stats())
+    return _meter
+
+
+def report_savings(tokens: int):
+    """Count prompt tokens saved for the active trace and the process totals."""
+    if tokens > 0:
+        inc("prompt_tokens_saved_total", tokens)
+        trace_add("prompt_tokens_saved", tokens)
+
+
+class RuleBlock:
+    """
+    The fixed head of a prompt: date instruction, rules and the context
+    legend, built once. cached_model() returns a GenerativeModel bound to an
+    explicit Gemini context cache of the block, or None when caching is off,
+    the block is too small for it, or the API refused.
+    """
+
+    def __init__(self, name: str, rules: str):
+        self.name = name
+        self.text = DATE_INSTRUCTION + rules.strip() + "\n\n" + CONTEXT_LEGEND + "\n\n"
+        self._model = None
+        self._expires = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> int:
+        return get_token_meter().count(self.text)
+
+    def cached_model(self, model_name: str):
+        if GEMINI_CONTEXT_CACHE == "off" or self.tokens < GEMINI_CACHE_MIN_TOKENS:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self._model is not None and now < self._expires:
+                return self._model
+            if now < self._retry_at:
+                return None
+            try:
+                content = genai.caching.CachedContent.create(
+                    model=f"models/{model_name}",
+                    display_name=f"invoicebot-{self.name}-rules",
+                    system_instruction=self.text,
+                    ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL),
+                )
+                self._model = genai.GenerativeModel.from_cached_content(cached_content=content)
+                # Renew a minute before the server drops it.
+                self._expires = now + GEMINI_CONTEXT_CACHE_TTL - 60
+            except Exception as e:
+                print(f"Gemini context caching unavailable for the {self.name} rules:", e)
+                self._model = None
+                self._retry_at = now + GEMINI_CONTEXT_CACHE_TTL
+            return self._model
+
+
+QA_RULE_BLOCK = RuleBlock("qa", QA_RULES)
+CHAT_RULE_BLOCK = RuleBlock("chat", CHAT_RULES)
+
+
+# --- Invoice rows ---
+_row_cache = OrderedDict()
+_row_cache_lock = threading.Lock()
+
+
+def _cell(value) -> str:
+    if value is None:
+        return "N/A"
+    return " ".join(str(value).replace("|", "/").split()) or "N/A"
+
+
+def _total(value) -> str:
+    try:
+        return f"{float(value):.2f}"
+    except (TypeError, ValueError):
+        return _cell(value)
+
+
+def invoice_row(inv, position) -> str:
+    """
+    One invoice as a context table row (see CONTEXT_LEGEND). The part after
+    id and pos is memoized per row version, i.e. per customer_id and the
+    values of its columns, so an edited row renders afresh.
+    """
+    key = (inv["customer_id"], inv["invoice_number"], inv["customer"], inv["supplier"],
+           str(inv["invoice_date"]), inv["items"], str(inv["total_amount"]))
+    with _row_cache_lock:
+        body = _row_cache.get(key)
+        if body is not None:
+            _row_cache.move_to_end(key)
+    if body is None:
+        items = "; ".join(_cell(item) for item in str(inv["items"] or "N/A").split(" | "))
+        body = " | ".join([
+            _cell(inv["invoice_number"]), _cell(inv["invoice_date"]), _cell(inv["customer"]),
+            _cell(inv["supplier"]), _total(inv["total_amount"]), items,
+        ])
+        with _row_cache_lock:
+            _row_cache[key] = body
+            while len(_row_cache) > PROMPT_ROW_CACHE_SIZE:
+                _row_cache.popitem(last=False)
+    return f"{inv['customer_id']} | {position} | {body}"
+
+
+@dataclass
+class InvoiceContext:
+    text: str
+    invoices: list  # the rows that fit in the budget
+    tokens: int
+    verbose_tokens: int  # the same invoices in the old labelled layout
+    dropped: int
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(0, self.verbose_tokens - self.tokens)
+
+
+def render_invoice_context(invoices: list, total: int = None,
+                           budget: int = PROMPT_CONTEXT_TOKENS) -> InvoiceContext:
+    """
+    Table rows for `invoices` (retrieval rows with a "position") within
+    `budget` tokens; at least one row is always kept. Reports the tokens
+    saved against the labelled layout.
+    """
+    meter = get_token_meter()
+    chars_per_token = meter.chars_per_token
+    lines, kept = [], []
+    tokens = verbose_tokens = 0
+    for inv in invoices:
+        line = invoice_row(inv, inv.get("position", "?"))
+        line_tokens = meter.count(line, chars_per_token)
+        if kept and tokens + line_tokens > budget:
+            break
+        meter.observe_row(line_tokens)
+        lines.append(line)
+        kept.append(inv)
+        tokens += line_tokens
+        verbose_tokens += meter.count(
+            format_invoice_document(inv, inv.get("position", "?"), total) + "\n\n", chars_per_token
+        )
+    dropped = len(invoices) - len(kept)
+    if dropped:
+        lines.append(f"({dropped} more matching invoices not shown)")
+    context = InvoiceContext("\n".join(lines), kept, tokens, verbose_tokens, dropped)
+    report_savings(context.saved_tokens)
+    return context
+
+
+def context_invoice_limit(budget: int = PROMPT_CONTEXT_TOKENS) -> int:
+    """How many invoices to retrieve for a prompt, from the measured tokens per row."""
+    return max(1, min(MAX_CONTEXT_INVOICES, int(budget // get_token_meter().tokens_per_invoice)))
@@ -1,43 +1,130 @@
 import os
 import re
 import json
+import time
+import hashlib
 import faiss
 import google.generativeai as genai
 from dotenv import load_dotenv
 from langchain.docstore.document import Document
 from langchain.vectorstores import FAISS
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.chains import RetrievalQA, ConversationalRetrievalChain
 from langchain.llms.base import LLM
-from langchain.memory import ConversationBufferMemory
-from langchain.schema import HumanMessage, AIMessage, SystemMessage
+from langchain_core.outputs import GenerationChunk
+from langchain.schema import HumanMessage, AIMessage
+from typing import Any, Optional
 from db.db_handler import get_connection
-import datetime
-from datetime import datetime, timezone  # Add timezone awareness
-from langchain_core.prompts import PromptTemplate
+from img2text.img2text import extract_text_from_image
+from llm.embeddings import get_embedding_service
+from llm.retrieval import has_invoices, plan_retrieval
+from llm.intent_router import route_query
+from llm.llm_cache import get_llm_cache, make_key
+from llm.llm_client import get_gemini_client, GEMINI_MODEL
+from llm.answer_cache import get_answer_cache, current_data_version
+from llm.followup import new_session, resolve_followup, remember_invoices
+from llm.memory import ChatMemory
+from llm.prompts import (
+    DATE_INSTRUCTION, QA_RULE_BLOCK, CHAT_RULE_BLOCK, QA_PROMPT, CHAT_PROMPT,
+    invoice_row, render_invoice_context, context_invoice_limit, report_savings,
+)
+from db.invoice_items import normalize_line_items, items_summary
+from db.invoice_record import Invoice
+from db.tenants import current_tenant
+from metrics import get_metrics, timer, inc, trace_add, start_trace, use_trace
         
 load_dotenv()
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+EXTRACTION_CACHE_TTL = int(os.getenv("EXTRACTION_CACHE_TTL", str(30 * 24 * 3600)))
+# Page text sent to one extraction call when reading multi-page PDFs.
+PDF_CHUNK_CHARS = int(os.getenv("PDF_CHUNK_CHARS", "12000"))
+
 class GeminiLLM(LLM):
+    model_name: str = GEMINI_MODEL
+    # Tenant's invoice data version when the prompt was built; part of the cache
+    # key so a new invoice invalidates cached answers. None for data-independent prompts.
+    data_version: Optional[int] = None
+    use_cache: bool = True
+    # prompts.RuleBlock placed ahead of the prompt; None = date instruction only.
+    rules: Optional[Any] = None
+
     @property
     def _llm_type(self) -> str:
         return "gemini"
     
-    def _call(self, prompt: str, stop=None) -> str:
-        # Prepend the system instruction for today's date
-        date_instruction = "Today's date is 06 May 2025. Use this as the current date in all time-based reasoning.\n\n"
-        full_prompt = date_instruction + prompt
+    def _full_prompt(self, prompt: str) -> str:
+        # Prepend the system instruction for today's date (part of every rule block)
+        full_prompt = (self.rules.text if self.rules is not None else DATE_INSTRUCTION) + prompt
 
         # Adjust the prompt to interpret questions like "first entry" or "last entry"
         if "first entry" in prompt.lower() or "first invoice" in prompt.lower():
             full_prompt += "\nYou should consider the earliest uploaded invoice (entry 1 as the first)."
         elif "last entry" in prompt.lower() or "latest invoice" in prompt.lower():
             full_prompt += "\nYou should consider the most recent uploaded invoice (last entry as the latest)."
-        
-        # Call Gemini API to generate the response
-        response = genai.GenerativeModel("gemini-2.0-flash").generate_content(full_prompt)
-        return response.text.strip()
+        return full_prompt
+
+    def _request(self, full_prompt: str):
+        """(text to send, model override): with a context-cached rule block only the rest is sent."""
+        if self.rules is not None:
+            model = self.rules.cached_model(self.model_name)
+            if model is not None:
+                report_savings(self.rules.tokens)
+                return full_prompt[len(self.rules.text):], model
+        return full_prompt, None
+
+    def _lookup(self, full_prompt: str, cache):
+        """Cached response or None; counts prompt size and cache outcome for metrics."""
+        inc("llm_prompt_chars_total", len(full_prompt))
+        trace_add("prompt_chars", len(full_prompt))
+        cached = cache.get(make_key(full_prompt, self.model_name, self.data_version)) if cache is not None else None
+        outcome = "hit" if cached is not None else "miss"
+        inc("llm_cache_lookups_total", result=outcome)
+        trace_add("llm_cache_hits" if cached is not None else "llm_cache_misses")
+        return cached
+
+    def _call(self, prompt: str, stop=None) -> str:
+        full_prompt = self._full_prompt(prompt)
+        cache = get_llm_cache() if self.use_cache else None
+        key = make_key(full_prompt, self.model_name, self.data_version)
+        cached = self._lookup(full_prompt, cache)
+        if cached is not None:
+            return cached
+
+        # Shared client: one model handle, retries, rate limit, coalescing
+        text = get_gemini_client().generate(*self._request(full_prompt))
+        if cache is not None and text:
+            cache.put(key, text)
+        return text
+
+    def _stream(self, prompt: str, stop=None, run_manager=None, **kwargs):
+        """Token streaming for LLM.stream(); each chunk is reported via on_llm_new_token."""
+        full_prompt = self._full_prompt(prompt)
+        cache = get_llm_cache() if self.use_cache else None
+        key = make_key(full_prompt, self.model_name, self.data_version)
+        cached = self._lookup(full_prompt, cache)
+        tokens = [cached] if cached is not None else get_gemini_client().stream(*self._request(full_prompt))
+        parts = []
+        for token in tokens:
+            parts.append(token)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        text = "".join(parts).strip()
+        if cache is not None and cached is None and text:
+            cache.put(key, text)
+
+    async def _acall(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        full_prompt = self._full_prompt(prompt)
+        cache = get_llm_cache() if self.use_cache else None
+        key = make_key(full_prompt, self.model_name, self.data_version)
+        cached = self._lookup(full_prompt, cache)
+        if cached is not None:
+            return cached
+
+        text = await get_gemini_client().generate_async(*self._request(full_prompt))
+        if cache is not None and text:
+            cache.put(key, text)
+        return text
     
     @property
     def device(self) -> str:
@@ -45,17 +132,8 @@ class GeminiLLM(LLM):
 
 
 
-def llm_extract_invoice_fields(ocr_text: str) -> dict:
-    """
-    Use the Gemini LLM exclusively to extract invoice fields.
-    The prompt instructs the model to return a valid JSON object with
-    the following keys: invoice_number, invoice_date, total_amount, supplier, customer, items.
-    If a field cannot be extracted, output "N/A" for that field.
-    
-    This function preprocesses the response by extracting the part starting
-    at the first "{" so that any extra text (such as a leading "json") is removed.
-    """
-    prompt = f"""
+def _extraction_prompt(ocr_text: str) -> str:
+    return f"""
 You are an expert invoice extraction assistant. Given the OCR text below, extract the following details and ensure each field has a valid value (if not available, output "N/A"):
 IMPORTANT: Today's date is 06-05-2025 (6th May 2025). DO NOT use the current system date or your internal date. Always assume 06-05-2025 is today.
 - invoice_number
@@ -63,17 +141,19 @@ IMPORTANT: Today's date is 06-05-2025 (6th May 2025). DO NOT use the current sys
 - total_amount
 - supplier
 - customer
-- items (concatenate item descriptions separated by " | ")
+- items (every line item as an object with description, quantity, unit_price and amount; use null for numbers that are not printed)
 
 Return only a valid JSON object with exactly these keys in this format:
-{{"invoice_number": "<value>", "invoice_date": "<value>", "total_amount": "<value>", "supplier": "<value>", "customer": "<value>", "items": "<value>"}}
+{{"invoice_number": "<value>", "invoice_date": "<value>", "total_amount": "<value>", "supplier": "<value>", "customer": "<value>", "items": [{{"description": "<value>", "quantity": <number or null>, "unit_price": <number or null>, "amount": <number or null>}}]}}
 Do not output any additional commentary.
 
 OCR Text:
 {ocr_text}
 """
-    llm_model = GeminiLLM()
-    response = llm_model._call(prompt).strip()
+
+
+def _parse_extraction_response(response: str) -> dict:
+    response = response.strip()
     if not response:
         print("LLM returned an empty response.")
         return {}
@@ -92,83 +172,173 @@ OCR Text:
         data = {}
     return data
 
+
+def llm_extract_invoice_fields(ocr_text: str) -> dict:
+    """
+    Use the Gemini LLM exclusively to extract invoice fields.
+    The prompt instructs the model to return a valid JSON object with
+    the following keys: invoice_number, invoice_date, total_amount, supplier, customer, items
+    (items as a list of {description, quantity, unit_price, amount}).
+    If a field cannot be extracted, output "N/A" for that field.
+    
+    This function preprocesses the response by extracting the part starting
+    at the first "{" so that any extra text (such as a leading "json") is removed.
+    """
+    with timer("extract"):
+        return _parse_extraction_response(GeminiLLM()._call(_extraction_prompt(ocr_text)))
+
+
+async def allm_extract_invoice_fields(ocr_text: str) -> dict:
+    """Async variant of llm_extract_invoice_fields for batch extraction."""
+    with timer("extract"):
+        return _parse_extraction_response(await GeminiLLM()._acall(_extraction_prompt(ocr_text)))
+
+
+def extract_invoice_image(file_path: str, on_stage=None):
+    """
+    OCR + LLM extraction for one image, cached by a SHA-256 of the image bytes
+    so a duplicate upload skips both. Returns (ocr_text, extracted_fields).
+    on_stage("ocr") / on_stage("extracting") is called as each step starts.
+    """
+    with open(file_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    cache = get_llm_cache()
+    key = make_key(digest, GEMINI_MODEL, namespace="extract")
+    cached = cache.get_json(key)
+    if cached is not None:
+        return cached["ocr_text"], dict(cached["fields"])
+
+    if on_stage:
+        on_stage("ocr")
+    ocr_text = extract_text_from_image(file_path)
+    if on_stage:
+        on_stage("extracting")
+    extracted = llm_extract_invoice_fields(ocr_text)
+    if extracted:
+        cache.put_json(key, {"ocr_text": ocr_text, "fields": extracted}, ttl=EXTRACTION_CACHE_TTL)
+    return ocr_text, dict(extracted)
+
+
+def merge_extracted_fields(parts: list) -> dict:
+    """
+    Combine extractions from consecutive chunks of one document: header fields
+    from the first chunk that has them, the total from the last, items joined.
+    """
+    merged = {}
+    items = []
+    for part in parts:
+        for key in ("invoice_number", "invoice_date", "supplier", "customer"):
+            value = part.get(key)
+            if value and value != "N/A" and key not in merged:
+                merged[key] = value
+        if part.get("total_amount") and part["total_amount"] not in ("N/A", "0"):
+            merged["total_amount"] = part["total_amount"]
+        items += normalize_line_items(part.get("items"))
+    if items:
+        merged["items"] = items
+    return merged
+
+
+def extract_invoice_pdf(file_path: str, on_stage=None):
+    """
+    Text + LLM extraction for a (multi-page) PDF, cached like images.
+    Pages come from the text layer when there is one and are OCR'd in
+    parallel otherwise (img2text/pdf2text.py). Page text is sent to Gemini in
+    PDF_CHUNK_CHARS chunks as pages arrive, so extraction overlaps with OCR of
+    later pages. Returns ([(page_number, text), ...], extracted_fields).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from img2text.pdf2text import iter_pdf_pages
+
+    with open(file_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    cache = get_llm_cache()
+    key = make_key(digest, GEMINI_MODEL, namespace="extract-pdf")
+    cached = cache.get_json(key)
+    if cached is not None:
+        return [tuple(page) for page in cached["pages"]], dict(cached["fields"])
+
+    if on_stage:
+        on_stage("ocr")
+    pages = []
+    futures = []
+    chunk, chunk_chars = [], 0
+    with ThreadPoolExecutor(max_workers=2) as llm_pool:
+        for page_number, text, _ in iter_pdf_pages(file_path):
+            pages.append((page_number, text))
+            if text.strip():
+                chunk.append(f"--- Page {page_number} ---\n{text}")
+                chunk_chars += len(text)
+            if chunk_chars >= PDF_CHUNK_CHARS:
+                futures.append(llm_pool.submit(llm_extract_invoice_fields, "\n".join(chunk)))
+                chunk, chunk_chars = [], 0
+        if on_stage:
+            on_stage("extracting")
+        if chunk:
+            futures.append(llm_pool.submit(llm_extract_invoice_fields, "\n".join(chunk)))
+        extracted = merge_extracted_fields([future.result() for future in futures])
+    if extracted:
+        cache.put_json(key, {"pages": pages, "fields": extracted}, ttl=EXTRACTION_CACHE_TTL)
+    return pages, dict(extracted)
+
+
+def normalize_invoice_fields(extracted: dict) -> Invoice:
+    """
+    Extraction output -> Invoice: missing text fields become "N/A", the total
+    a number (None if there is none) and the date a date (None if it can't be
+    parsed, rather than today). Line items go to line_items; items becomes
+    the joined description string stored on the invoice row.
+    """
+    line_items = normalize_line_items(extracted.get("items"))
+    items = extracted.get("items")
+    return Invoice.from_extracted({
+        **extracted,
+        "line_items": line_items,
+        "items": items if isinstance(items, str) else items_summary(line_items),
+    })
+
 # --- Database Retrieval and Chat Functions ---
-def fetch_all_invoices():
+def fetch_all_invoices() -> list:
     invoices = []
     try:
-        conn = get_connection()
-        with conn.cursor() as cur:
+        with get_connection() as conn, conn.cursor() as cur:
             query = """
             SELECT customer_id, invoice_number, customer, supplier,
-                to_char(invoice_date, 'YYYY-MM-DD') as invoice_date,
-                items, total_amount, vector_embedding
+                invoice_date, items, total_amount, vector_embedding
             FROM data_of_invoices
+            WHERE tenant_id = %s
             ORDER BY customer_id ASC;  -- Sort by customer_id
             """
-            cur.execute(query)
-            rows = cur.fetchall()
-            for row in rows:
-                invoice = {
-                    "customer_id": row[0],  # Added as first column
-                    "invoice_number": row[1],  # Shifted from row[0] → row[1]
-                    "customer": row[2],       # Shifted from row[1] → row[2]
-                    "supplier": row[3],       # Shifted from row[2] → row[3]
-                    "invoice_date": row[4],   # Shifted from row[3] → row[4]
-                    "items": row[5],          # Shifted from row[4] → row[5]
-                    "total_amount": row[6],   # Shifted from row[5] → row[6]
-                    "vector_embedding": row[7] # Shifted from row[6] → row[7]
-                }
-                invoices.append(invoice)
-        conn.close()
+            with timer("db_fetch"):
+                cur.execute(query, (current_tenant(),))
+                invoices = [Invoice.from_row(row) for row in cur]
     except Exception as e:
         print("Error fetching all invoices:", e)
     return invoices
 
 def get_all_invoice_documents():
-    invoices = fetch_all_invoices()
-    docs = []
-    for idx, inv in enumerate(invoices, 1):  # Remove reversed() to keep DB order
-        content = (
-            f"Customer ID: {inv['customer_id']}\n" 
-            f"Upload Order: {idx} (1 = Oldest, {len(invoices)} = Newest)\n"
-            f"Invoice Number: {inv['invoice_number']}\n"
-            f"Customer: {inv['customer']}\n"
-            f"Supplier: {inv['supplier']}\n"
-            f"Date: {inv['invoice_date']}\n"
-            f"Items: {inv['items']}\n"
-            f"Total Amount: {inv['total_amount']}"
-        )
-        docs.append(Document(page_content=content))
-    return docs
-
-def fetch_latest_invoice():
+    # Compact table rows (prompts.CONTEXT_LEGEND), one per invoice in upload order
+    return [
+        Document(page_content=invoice_row(inv, idx), metadata={"customer_id": inv["customer_id"]})
+        for idx, inv in enumerate(fetch_all_invoices(), 1)
+    ]
+
+def fetch_latest_invoice() -> Optional[Invoice]:
     try:
-        conn = get_connection()
-        with conn.cursor() as cur:
+        with get_connection() as conn, conn.cursor() as cur:
             query = """
             SELECT customer_id, invoice_number, customer, supplier,
-                to_char(invoice_date, 'YYYY-MM-DD') as invoice_date,
-                items, total_amount, vector_embedding
+                invoice_date, items, total_amount, vector_embedding
             FROM data_of_invoices
+            WHERE tenant_id = %s
             ORDER BY customer_id DESC
             LIMIT 1;
             """
-            cur.execute(query)
-            row = cur.fetchone()
+            with timer("db_fetch"):
+                cur.execute(query, (current_tenant(),))
+                row = cur.fetchone()
             if row:
-                invoice = {
-                    "customer_id": row[0],  # Added as first column
-                    "invoice_number": row[1],  # Shifted from row[0] → row[1]
-                    "customer": row[2],       # Shifted from row[1] → row[2]
-                    "supplier": row[3],       # Shifted from row[2] → row[3]
-                    "invoice_date": row[4],   # Shifted from row[3] → row[4]
-                    "items": row[5],          # Shifted from row[4] → row[5]
-                    "total_amount": row[6],   # Shifted from row[5] → row[6]
-                    "vector_embedding": row[7] # Shifted from row[6] → row[7]
-                }
-                conn.close()
-                return invoice
-        conn.close()
+                return Invoice.from_row(row)
     except Exception as e:
         print("Error fetching latest invoice:", e)
     return None
@@ -176,235 +346,181 @@ def fetch_latest_invoice():
 def get_latest_invoice_document():
     invoice = fetch_latest_invoice()
     if invoice:
-        content = (
-            f"Invoice Number: {invoice['invoice_number']}\n"
-            f"Customer: {invoice['customer']}\n"
-            f"Supplier: {invoice['supplier']}\n"
-            f"Date: {invoice['invoice_date']}\n"
-            f"Items: {invoice['items']}\n"
-            f"Total Amount: {invoice['total_amount']}\n"
-            f"Customer ID: {invoice['customer_id']}"
-        )
-        return [Document(page_content=content)]
+        return [Document(page_content=invoice_row(invoice, "latest"),
+                         metadata={"customer_id": invoice["customer_id"]})]
     return []
 
 
 
 def create_vectorstore_from_docs(docs):
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    vectorstore = FAISS.from_documents(docs, embeddings)
+    with timer("vector_build"):
+        vectorstore = FAISS.from_documents(docs, get_embedding_service())
     return vectorstore
 
 
 def run_query(query: str) -> str:
-    # Load all invoice documents
-    docs = get_all_invoice_documents()
-    total_docs = len(docs)
-
-    # Vector similarity search
-    vectorstore = create_vectorstore_from_docs(docs)
-    retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": total_docs}
-    )
-
-    # Core prompt -- VERY explicit rules
-    qa_prompt = f"""You are InvoiceBot. Follow these rules for **every** question:
-
--0. **Pronoun Resolution**  
--   - If the user says “summarize it,” “summarize this invoice,” or uses “it”/“this”/“that” referring to an invoice, assume they mean the **most recent** invoice.
-+    memory.chat_memory.add_message(
-+        SystemMessage(
-+            content=You are InvoiceBot. Follow these rules for **every** question:
-+
-+0. **Explicit-Invoice Follow-Up**  
-+   - If the user’s previous query explicitly named an invoice (by invoice number or customer name), then any unqualified follow-up (“what is invoice number?”, “what date?”, etc.) refers to **that** invoice.
-+
-+1. **Pronoun Resolution**  
-+   - Only if the user uses a pronoun (“it”, “this”, “that”) or asks “summarize it/this invoice”, assume they mean the **most recent** uploaded invoice.
- 
-1. **ID vs. Position**  
-   - If the user specifies "customer id X", "id X", or "uid X", fetch the invoice where `customer_id = X`.  
-   - For "invoice N" (plain integer), use upload position (1 = oldest; LAST = newest).  
-   - "first"/"last" always refer to upload order, NOT customer_id.
-
-
-2. **Customer⇄Supplier Intents**  
-   - “Who bought from <Supplier>?” → list customer(s) for that supplier.  
-   - “From where did <Customer> buy?” → list supplier(s) for that customer.
-
-3. **Date Filtering & Relative Time**  
-   - Support absolute dates (YYYY-MM-DD), ranges (“from A to B”), and relative  
-     (“last week/month”, “past 30 days”, “2 months ago”).  
-
-4. **Amount & Items**  
-   - Highest/lowest/above/below thresholds.  
-   - Count or list items on specific invoices.  
-   - Contain-item queries (“contains ‘Headphones’”).
-
-5. **Aggregation & Comparison**  
-   - Sum, average, difference, total of N invoices, and “who spent the most.”
-
-6. **Complex Filters**  
-   - Odd/even positions, closest to a date, multi-criteria (customer + date range).
-
-7. **Answer Style**  
-   - Concise, direct. No apologies or “context doesn’t include.”  
-   - Always include minimally: Invoice Number, Customer, Date when detailing invoices.  
-   - For supplier/customer queries, single sentence:  
-     “<Customer> bought from <Supplier>.”  
-   - For aggregations, state the result directly.
-   - Do **not** repeat back or confirm user inputs. If they mention “Neha Joshi,” don’t say “Yes, Neha Joshi is a customer name.”  
-   - Simply answer the question directly.
-
-8. **Follow-Up Context**  
-   - If the user’s previous exchange named or summarized a particular invoice (by customer or invoice number), then any question without a qualifier (“what is invoice number?”) refers to that same invoice.
-
-9. **Metadata Suppression**  
-   - Only mention these six fields in your answers:  
-     **Invoice Number**, **Customer**, **Supplier**, **Date**, **Items**, **Total Amount**.  
-   - Do **not** output internal metadata (Customer ID, Upload Order, vector embeddings, etc.) unless the user explicitly asks for it.
-
-10. **Examples**  
-   - Q: “first invoice summary?”  
-     → “The oldest invoice is INV-2001 (K. Patel) on 2024-04-16. Total ₹5 658.10; Items: Shoes, Kurta, Headphones, Burger.”  
-   - Q: “invoice INV-2003 date?”  
-     → “Invoice INV-2003 was issued on 2024-04-27.”  
-   - Q: “who bought from Amazon?”  
-     → “N. Singh bought from Amazon.”  
-   - Q: “last week’s invoices?”  
-     → “Invoices from 2025-05-02 to 2025-05-08: INV-2006, INV-2007 (Totals ₹412.00, ₹440.00).”  
-   - Q: “difference between invoice 2 and 4?”  
-     → “Invoice 2 (₹1 884.46) vs. Invoice 4 (₹2 414.28): difference ₹529.82.”
-     - Q: "summarize customer id 2"  
-  → "Customer ID 2: Invoice INV-3004 (Ravi Kumar) bought from Amazon India on 2025-01-28. Total ₹590.00; Items: Burger."
-
-Context:  
-{{context}}
-
-Question: {{question}}  
-Answer:"""
-
-    llm = GeminiLLM()
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        chain_type_kwargs={"prompt": qa_prompt}
-    )
-
-    return qa_chain.run(query)
-
-
-
-def run_chat(query: str, chat_history: list) -> (str, list):
-    # Load all documents
-    docs = get_all_invoice_documents()
-    total_docs = len(docs)
-
-    # Build retriever
-    vectorstore = create_vectorstore_from_docs(docs)
-    retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": total_docs}
-    )
-
-    llm = GeminiLLM()
-    memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-    memory.chat_memory.messages += chat_history
-
-    # System-level instructions for chat
-    memory.chat_memory.add_message(
-        SystemMessage(
-            content=f"""You are InvoiceBot. Follow these rules for **every** question:
-
--0. **Pronoun Resolution**  
--   - If the user says “summarize it,” “summarize this invoice,” or uses “it”/“this”/“that” referring to an invoice, assume they mean the **most recent** invoice.
-+    memory.chat_memory.add_message(
-+        SystemMessage(
-+            content=You are InvoiceBot. Follow these rules for **every** question:
-+
-+0. **Explicit-Invoice Follow-Up**  
-+   - If the user’s previous query explicitly named an invoice (by invoice number or customer name), then any unqualified follow-up (“what is invoice number?”, “what date?”, etc.) refers to **that** invoice.
-+
-+1. **Pronoun Resolution**  
-+   - Only if the user uses a pronoun (“it”, “this”, “that”) or asks “summarize it/this invoice”, assume they mean the **most recent** uploaded invoice.
- 
-1. **ID vs. Position**  
-   - "customer id X" → exact `customer_id` lookup.  
-   - "invoice N" → upload position N.  
-   - Never mix customer_id with upload order.
-
-2. **Customer⇄Supplier Intents**  
-   - “Who bought from <Supplier>?” → customer(s) for that supplier.  
-   - “From where did <Customer> buy?” → supplier(s) for that customer.
-
-3. **Date & Relative Time**  
-   - Handle YYYY-MM-DD, ranges (A to B), and relative (“last week”, “30 days ago”, etc.).
-
-4. **Amount & Items**  
-   - Threshold, highest/lowest, item counts, contain-item queries.
-
-5. **Aggregation & Comparison**  
-   - Sum, average, difference, top spender.
-
-6. **Complex Filters**  
-   - Odd/even positions, closest to date, multi-criteria.
-
-7. **Answer Style**  
-   - Concise, direct; no apologies or context-missing statements.  
-   - Always include Invoice Number, Customer, Date for invoice details.  
-   - Do **not** repeat back or confirm user inputs. If they mention “Neha Joshi,” don’t say “Yes, Neha Joshi is a customer name.”  
-    - Simply answer the question directly.
-   - Supplier/customer queries in one sentence:  
-     “<Customer> bought from <Supplier>.”  
-   - Aggregations: state result directly.
-8. **Follow-Up Context**  
-+   - If the user’s previous exchange named or summarized a particular invoice (by customer or invoice number), then any question without a qualifier (“what is invoice number?”) refers to that same invoice.
-+
-9. **Metadata Suppression**  
-+   - Only mention these six fields in your answers:  
-+     **Invoice Number**, **Customer**, **Supplier**, **Date**, **Items**, **Total Amount**.  
-+   - Do **not** output internal metadata (Customer ID, Upload Order, vector embeddings, etc.) unless the user explicitly asks for it.
-+
-
-10. **Examples**  
-   - See `run_query` examples above.
-
-Now answer the user’s question based on chat history and document context."""
-        )
-
-
-    )
-
-    # Rephrase ambiguous queries to be clearer for the LLM
-    condense_prompt = PromptTemplate(
-        input_variables=["chat_history", "question"],
-        template=f"""Rephrase the question to decide:
+    # Aggregates and exact lookups are answered by SQL without calling Gemini.
+    routed = route_query(query)
+    if routed:
+        return routed.answer
+
+    if not has_invoices():
+        return "No invoices have been uploaded yet."
+
+    # The same (or a near-identical) question at the same data version was answered before.
+    data_version = current_data_version()
+    answers = get_answer_cache()
+    cached = answers.lookup(query, data_version) if answers is not None else None
+    if cached is not None:
+        return cached.answer
+
+    # SQL-filtered, bounded top-k context, sized to the prompt budget
+    plan = plan_retrieval(query, max_invoices=context_invoice_limit())
+    context = render_invoice_context(plan.invoices, plan.total_invoices)
+    llm = GeminiLLM(data_version=data_version, rules=QA_RULE_BLOCK)
+    answer = llm._call(QA_PROMPT.format(context=context.text, question=query))
+    if answers is not None:
+        answers.store(query, data_version, answer, context.invoices)
+    return answer
+
+
+CONDENSE_PROMPT = """Rephrase the question to decide:
 - Whether it's a direct invoice_number lookup or a position lookup.
 - Map "first"/"last"/numeric accordingly.
 - Keep invoice IDs (INV-*) intact.
 Chat History:
-{{chat_history}}
-Question: {{question}}
+{chat_history}
+Question: {question}
 Rephrased Question:"""
-    )
-
-    chat_chain = ConversationalRetrievalChain.from_llm(
-        llm=llm,
-        retriever=retriever,
-        memory=memory,
-        condense_question_prompt=condense_prompt,
-        condense_question_llm=llm
-    )
-
-    result = chat_chain({"question": query})
-    answer = result.get("answer", "").strip()
-
-    # Strip out the system messages before returning
-    updated_history = [
-        msg for msg in memory.chat_memory.messages
-        if not isinstance(msg, SystemMessage)
-    ]
 
-    return answer, updated_history
+class ChatTurn:
+    """
+    One chat turn. Follow-ups ("it", "that invoice", "the one before") are
+    resolved locally from `session` (see followup.py); the SQL fast path is
+    tried next; otherwise a single Gemini call answers from the planned
+    context. The condense/rephrase call is only made when a reference can't
+    be resolved locally. The prompt carries session["memory"] (see memory.py),
+    a bounded window plus rolling summary, not the full chat history.
+
+    Self-contained questions that reach the LLM path are first looked up in
+    the semantic answer cache (answer_cache.py; route "cache" on a hit), and
+    their answers are stored there.
+
+    Everything up to the answer call happens in the constructor; stream()
+    yields the answer as it is generated. Afterwards `answer` and `history`
+    are set and {route, llm_calls, condensed, ttft, seconds,
+    prompt_tokens_saved, stages} is appended to session["turn_timings"]. The
+    turn's trace (stage spans, tokens, prompt size, cache hits; see
+    metrics.py) is recorded as it ends. The prompt itself is assembled by
+    prompts.py: cached rule block, compact invoice rows, token budget.
+    """
+
+    def __init__(self, query: str, chat_history: list, session: dict = None):
+        self.query = query
+        self.chat_history = chat_history
+        self.session = session if session is not None else new_session()
+        self.started = time.perf_counter()
+        self.timing = {"question": query, "route": "llm", "llm_calls": 0, "condensed": False}
+        self.answer = None
+        self.history = None
+        self._ready_answer = None
+        self._invoices = []
+        self._llm = None
+        self._prompt = None
+        self._answer_version = None  # data version to store the answer under, if cacheable
+        # stream() may run in another context (a streamed HTTP response), so keep the tenant.
+        self.tenant_id = current_tenant()
+        self.trace = start_trace("chat")
+        with use_trace(self.trace):
+            self._prepare()
+
+    def _prepare(self):
+        question, needs_condense = resolve_followup(self.query, self.session)
+
+        # Aggregates and exact lookups are answered by SQL without calling Gemini.
+        if not needs_condense:
+            routed = route_query(question, allow_followup=question != self.query)
+            if routed:
+                self.timing["route"] = "sql"
+                self.trace.set("intent", routed.intent)
+                self._ready_answer, self._invoices = routed.answer, routed.invoices
+                return
+
+        if not has_invoices():
+            self._ready_answer = "No invoices have been uploaded yet."
+            return
+
+        data_version = current_data_version()
+        answers = get_answer_cache()
+        if answers is not None and not needs_condense and question == self.query:
+            cached = answers.lookup(question, data_version, self.tenant_id)
+            if cached is not None:
+                self.timing["route"] = "cache"
+                self._ready_answer, self._invoices = cached.answer, cached.invoices
+                return
+            self._answer_version = data_version
+
+        self._llm = GeminiLLM(data_version=data_version, rules=CHAT_RULE_BLOCK)
+        history_text = self.session.setdefault("memory", ChatMemory()).render()
+        if needs_condense:
+            # Fallback: rephrase with the LLM only when local resolution failed.
+            with timer("condense"):
+                condensed = GeminiLLM(data_version=data_version)._call(
+                    CONDENSE_PROMPT.format(chat_history=history_text, question=self.query)
+                )
+            question = condensed.strip() or self.query
+            self.timing["llm_calls"] += 1
+            self.timing["condensed"] = True
+
+        # SQL-filtered, bounded top-k context as table rows within the token budget
+        plan = plan_retrieval(question, max_invoices=context_invoice_limit())
+        context = render_invoice_context(plan.invoices, plan.total_invoices)
+        self._invoices = context.invoices
+        self._prompt = CHAT_PROMPT.format(chat_history=history_text, context=context.text, question=question)
+
+    def _first_token(self):
+        if "ttft" not in self.timing:
+            self.timing["ttft"] = round(time.perf_counter() - self.started, 3)
+
+    def stream(self):
+        if self._ready_answer is not None:
+            self._first_token()
+            yield self._ready_answer
+            self._finish(self._ready_answer)
+            return
+        parts = []
+        started = time.perf_counter()
+        with use_trace(self.trace):
+            for token in self._llm.stream(self._prompt):
+                self._first_token()
+                parts.append(token)
+                yield token
+        get_metrics().observe("answer", time.perf_counter() - started, self.trace, started)
+        self.timing["llm_calls"] += 1
+        answer = "".join(parts).strip()
+        answers = get_answer_cache()
+        if answers is not None and self._answer_version is not None:
+            answers.store(self.query, self._answer_version, answer, self._invoices, self.tenant_id)
+        self._finish(answer)
+
+    def _finish(self, answer: str):
+        remember_invoices(self.session, self._invoices)
+        self.session.setdefault("memory", ChatMemory()).add_turn(self.query, answer, self._invoices)
+        self.answer = answer
+        self.history = self.chat_history + [HumanMessage(content=self.query), AIMessage(content=answer)]
+        self.timing["seconds"] = round(time.perf_counter() - self.started, 3)
+        self.timing["prompt_tokens_saved"] = self.trace.attrs.get("prompt_tokens_saved", 0)
+        for key in ("route", "llm_calls", "condensed", "ttft"):
+            if key in self.timing:
+                self.trace.set(key, self.timing[key])
+        get_metrics().finish_trace(self.trace)
+        self.timing["stages"] = self.trace.stage_seconds()
+        self.session.setdefault("turn_timings", []).append(self.timing)
+
+
+def run_chat(query: str, chat_history: list, session: dict = None) -> (str, list):
+    """Non-streaming chat turn; see ChatTurn."""
+    turn = ChatTurn(query, chat_history, session)
+    for _ in turn.stream():
+        pass
+    return turn.answer, turn.history
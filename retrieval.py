@@ -0,0 +1,444 @@
+import os
+import re
+import calendar
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import List, Optional
+from langchain.docstore.document import Document
+from langchain_core.retrievers import BaseRetriever
+from db.db_handler import get_connection
+from db.pgvector_store import use_pgvector, search_similar
+from db.tenants import current_tenant
+from llm.vector_index import get_invoice_index, format_invoice_document
+from llm.embeddings import get_embedding_service
+from metrics import timer
+
+# Same "today" the prompts use (see GeminiLLM._call).
+REFERENCE_DATE = date(2025, 5, 6)
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+MAX_CONTEXT_INVOICES = int(os.getenv("MAX_CONTEXT_INVOICES", "20"))
+SQL_CANDIDATE_LIMIT = int(os.getenv("SQL_CANDIDATE_LIMIT", "50000"))  # newest in-range ids ranked by vector
+
+MONTHS = {name.lower(): i for i, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): i for i, name in enumerate(calendar.month_abbr) if name})
+MONTHS["sept"] = 9
+ORDINALS = {
+    "first": 1, "second": 2, "third": 3, "fourth": 4, "fifth": 5,
+    "sixth": 6, "seventh": 7, "eighth": 8, "ninth": 9, "tenth": 10,
+}
+MONTH_PATTERN = "|".join(sorted(MONTHS, key=len, reverse=True))
+
+INVOICE_NUMBER_RE = re.compile(r"\b(?=[A-Z0-9-]*\d)[A-Z][A-Z0-9]*-[A-Z0-9][A-Z0-9-]*\b", re.I)
+# Without one of these, a bare INV-like token ("COVID-19", "Wi-Fi6") is only a
+# candidate, used if such an invoice number exists (resolve_invoice_numbers).
+INVOICE_CUE_RE = re.compile(r"\b(?:invoice|inv|bill|receipt)s?\b|#|\bno\.", re.I)
+INVOICE_NUMBER_PHRASE_RE = re.compile(r"\binvoice\s*(?:number|no\.?|num|#)\s*[:#]?\s*([A-Z0-9][A-Z0-9/-]*)", re.I)
+CUSTOMER_ID_RE = re.compile(r"\b(?:customer[\s_]*id|uid|id)\s*(?:=|:|#|no\.?)?\s*(\d+)", re.I)
+POSITION_RE = re.compile(r"\binvoices?\s+(\d+(?:\s*(?:,|and|&|vs\.?|or)\s*\d+)*)(?![\d/-])", re.I)
+ORDINAL_POSITION_RE = re.compile(r"\b(\d+)(?:st|nd|rd|th)\s+(?:invoice|entry|upload)", re.I)
+ORDINAL_WORD_RE = re.compile(r"\b(" + "|".join(ORDINALS) + r")\s+(?:invoice|entry|upload|one)", re.I)
+LAST_RE = re.compile(r"\b(?:last|latest|newest|most recent)\s+(?:invoice|entry|upload|one)\b", re.I)
+OLDEST_RE = re.compile(r"\boldest\s+(?:invoice|entry|upload|one)\b", re.I)
+ISO_DATE_RE = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+DMY_DATE_RE = re.compile(r"\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b")
+MONTH_YEAR_RE = re.compile(r"\b(" + MONTH_PATTERN + r")\.?\s*,?\s*(\d{4})?\b", re.I)
+RELATIVE_RE = re.compile(
+    r"\b(?:(?:past|last|previous)\s+(\d+)\s+(day|week|month|year)s?"
+    r"|(\d+)\s+(day|week|month|year)s?\s+ago"
+    r"|(today|yesterday)"
+    r"|(this|last|previous)\s+(week|month|quarter|year))\b",
+    re.I
+)
+AMOUNT_RE = re.compile(
+    r"\b(above|over|more than|greater than|exceeding|at least|below|under|less than|at most|cheaper than)"
+    r"\s*(?:rs\.?|inr|usd|₹|\$)?\s*([\d,]+(?:\.\d+)?)",
+    re.I
+)
+MIN_AMOUNT_WORDS = ("above", "over", "more than", "greater than", "exceeding", "at least")
+
+
+@dataclass
+class QueryFilters:
+    """Structured constraints pulled out of a question."""
+    invoice_numbers: List[str] = field(default_factory=list)
+    candidate_numbers: List[str] = field(default_factory=list)  # see INVOICE_CUE_RE
+    customer_ids: List[int] = field(default_factory=list)
+    positions: List[int] = field(default_factory=list)  # 1 = oldest, -1 = newest
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+    # Customer and supplier names, matched against known labels by the intent router.
+    customers: List[str] = field(default_factory=list)
+    suppliers: List[str] = field(default_factory=list)
+
+    @property
+    def has_keys(self) -> bool:
+        """Exact lookups: the answer is exactly these invoices."""
+        return bool(self.invoice_numbers or self.customer_ids or self.positions)
+
+    @property
+    def has_ranges(self) -> bool:
+        return any(v is not None for v in (self.date_from, self.date_to, self.min_amount, self.max_amount))
+
+
+def _month_range(year: int, month: int):
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+
+def _shift_months(day: date, months: int) -> date:
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    return date(year, month + 1, min(day.day, calendar.monthrange(year, month + 1)[1]))
+
+
+def _relative_range(match, today: date):
+    count, unit, ago_count, ago_unit, day_word, which, period = match.groups()
+    if count:
+        n, unit = int(count), unit.lower()
+        if unit == "day":
+            return today - timedelta(days=n), today
+        if unit == "week":
+            return today - timedelta(weeks=n), today
+        if unit == "month":
+            return _shift_months(today, -n), today
+        return _shift_months(today, -12 * n), today
+    if ago_count:
+        n, unit = int(ago_count), ago_unit.lower()
+        if unit == "day":
+            day = today - timedelta(days=n)
+            return day, day
+        if unit == "week":
+            start = today - timedelta(weeks=n, days=today.weekday())
+            return start, start + timedelta(days=6)
+        if unit == "month":
+            shifted = _shift_months(today, -n)
+            return _month_range(shifted.year, shifted.month)
+        return date(today.year - n, 1, 1), date(today.year - n, 12, 31)
+    if day_word:
+        day = today if day_word.lower() == "today" else today - timedelta(days=1)
+        return day, day
+    back = 0 if which.lower() == "this" else 1
+    period = period.lower()
+    if period == "week":
+        start = today - timedelta(days=today.weekday(), weeks=back)
+        return start, start + timedelta(days=6)
+    if period == "month":
+        shifted = _shift_months(today.replace(day=1), -back)
+        return _month_range(shifted.year, shifted.month)
+    if period == "quarter":
+        first_month = 3 * ((today.month - 1) // 3) + 1
+        start = _shift_months(date(today.year, first_month, 1), -3 * back)
+        end = _shift_months(start, 3) - timedelta(days=1)
+        return start, end
+    return date(today.year - back, 1, 1), date(today.year - back, 12, 31)
+
+
+def _extract_dates(question: str, today: date):
+    """Return (date_from, date_to, text with the date phrases removed)."""
+    explicit = []
+    for match in ISO_DATE_RE.finditer(question):
+        try:
+            explicit.append((match.start(), date(int(match[1]), int(match[2]), int(match[3]))))
+        except ValueError:
+            pass
+    for match in DMY_DATE_RE.finditer(question):
+        try:
+            explicit.append((match.start(), date(int(match[3]), int(match[2]), int(match[1]))))
+        except ValueError:
+            pass
+    stripped = DMY_DATE_RE.sub(" ", ISO_DATE_RE.sub(" ", question))
+
+    if len(explicit) >= 2:
+        days = sorted(day for _, day in explicit)
+        return days[0], days[-1], stripped
+    if len(explicit) == 1:
+        start, day = explicit[0]
+        before = question[:start].lower().split()[-1:] or [""]
+        if before[0] in ("before", "until", "till", "upto"):
+            return None, day, stripped
+        if before[0] in ("after", "since", "from"):
+            return day, None, stripped
+        return day, day, stripped
+
+    match = RELATIVE_RE.search(question)
+    if match:
+        date_from, date_to = _relative_range(match, today)
+        return date_from, date_to, stripped.replace(match.group(0), " ")
+
+    month_matches = list(MONTH_YEAR_RE.finditer(question))
+    # Bare abbreviations like "mar" or "may" are only trusted with a year.
+    month_matches = [m for m in month_matches if m[2] or len(m[1]) > 3]
+    if month_matches:
+        ranges = []
+        for m in month_matches:
+            month = MONTHS[m[1].lower()]
+            year = int(m[2]) if m[2] else (today.year if month <= today.month else today.year - 1)
+            ranges.append(_month_range(year, month))
+        for m in month_matches:
+            stripped = stripped.replace(m.group(0), " ")
+        return min(r[0] for r in ranges), max(r[1] for r in ranges), stripped
+    return None, None, stripped
+
+
+def extract_filters(question: str, today: date = REFERENCE_DATE) -> QueryFilters:
+    """Pull invoice numbers, customer ids, positions, dates and amount bounds out of a question."""
+    filters = QueryFilters()
+    filters.date_from, filters.date_to, text = _extract_dates(question, today)
+
+    for match in INVOICE_NUMBER_PHRASE_RE.finditer(text):
+        filters.invoice_numbers.append(match[1])
+    bare_numbers = filters.invoice_numbers if INVOICE_CUE_RE.search(text) else filters.candidate_numbers
+    for match in INVOICE_NUMBER_RE.finditer(text):
+        if match[0] not in filters.invoice_numbers and match[0] not in bare_numbers:
+            bare_numbers.append(match[0])
+    text = INVOICE_NUMBER_PHRASE_RE.sub(" ", text)
+
+    for match in CUSTOMER_ID_RE.finditer(text):
+        filters.customer_ids.append(int(match[1]))
+    text = CUSTOMER_ID_RE.sub(" ", text)
+
+    for match in AMOUNT_RE.finditer(text):
+        amount = float(match[2].replace(",", ""))
+        if match[1].lower() in MIN_AMOUNT_WORDS:
+            filters.min_amount = amount
+        else:
+            filters.max_amount = amount
+    text = AMOUNT_RE.sub(" ", text)
+
+    for match in POSITION_RE.finditer(text):
+        filters.positions += [int(n) for n in re.findall(r"\d+", match[1])]
+    for match in ORDINAL_POSITION_RE.finditer(text):
+        filters.positions.append(int(match[1]))
+    for match in ORDINAL_WORD_RE.finditer(text):
+        filters.positions.append(ORDINALS[match[1].lower()])
+    if OLDEST_RE.search(text):
+        filters.positions.append(1)
+    if LAST_RE.search(text):
+        filters.positions.append(-1)
+    filters.positions = [p for p in dict.fromkeys(filters.positions) if p != 0]
+    return filters
+
+
+# --- SQL pushdown ---
+SELECT_COLUMNS = """
+    SELECT d.customer_id, d.invoice_number, d.customer, d.supplier,
+        to_char(d.invoice_date, 'YYYY-MM-DD') as invoice_date,
+        d.items, d.total_amount, d.vector_embedding
+    FROM data_of_invoices d
+    WHERE d.tenant_id = %s
+"""
+
+
+def _rows_to_dicts(rows):
+    return [
+        {
+            "customer_id": row[0],
+            "invoice_number": row[1],
+            "customer": row[2],
+            "supplier": row[3],
+            "invoice_date": row[4],
+            "items": row[5],
+            "total_amount": row[6],
+            "vector_embedding": row[7],
+            "position": None
+        }
+        for row in rows
+    ]
+
+
+def _add_positions(cur, rows: list) -> list:
+    """
+    Fill in the upload position (1 = oldest) of the rows about to be
+    returned: one numbered index-only scan up to the newest of them, rather
+    than a count per candidate row.
+    """
+    if not rows:
+        return rows
+    ids = [row["customer_id"] for row in rows]
+    cur.execute(
+        """
+        SELECT customer_id, position FROM (
+            SELECT customer_id, row_number() OVER (ORDER BY customer_id) AS position
+            FROM data_of_invoices
+            WHERE tenant_id = %s AND customer_id <= %s
+        ) numbered
+        WHERE customer_id = ANY(%s);
+        """,
+        (current_tenant(), max(ids), ids)
+    )
+    positions = dict(cur.fetchall())
+    for row in rows:
+        row["position"] = positions.get(row["customer_id"])
+    return rows
+
+
+def fetch_invoices_by_keys(cur, filters: QueryFilters) -> list:
+    """Exact lookups by customer_id, invoice_number and upload position (index scans)."""
+    tenant_id = current_tenant()
+    with timer("db_fetch"):
+        rows = []
+        if filters.customer_ids or filters.invoice_numbers:
+            cur.execute(
+                SELECT_COLUMNS + """
+                AND (d.customer_id = ANY(%s) OR lower(d.invoice_number) = ANY(%s))
+                ORDER BY d.customer_id
+                LIMIT %s;
+                """,
+                (tenant_id, filters.customer_ids, [n.lower() for n in filters.invoice_numbers], MAX_CONTEXT_INVOICES)
+            )
+            rows += _rows_to_dicts(cur.fetchall())
+        for position in filters.positions[:MAX_CONTEXT_INVOICES]:
+            order = "ASC" if position > 0 else "DESC"
+            cur.execute(
+                SELECT_COLUMNS + f"ORDER BY d.customer_id {order} OFFSET %s LIMIT 1;",
+                (tenant_id, abs(position) - 1)
+            )
+            rows += _rows_to_dicts(cur.fetchall())
+        unique = {}
+        for row in rows:
+            unique.setdefault(row["customer_id"], row)
+        return _add_positions(cur, list(unique.values()))
+
+
+def resolve_invoice_numbers(cur, filters: QueryFilters) -> QueryFilters:
+    """Keep the candidate numbers that are invoice numbers of the current tenant (one index lookup)."""
+    if filters.candidate_numbers:
+        cur.execute(
+            "SELECT DISTINCT lower(invoice_number) FROM data_of_invoices WHERE tenant_id = %s AND lower(invoice_number) = ANY(%s);",
+            (current_tenant(), [n.lower() for n in filters.candidate_numbers])
+        )
+        found = {row[0] for row in cur.fetchall()}
+        filters.invoice_numbers += [n for n in filters.candidate_numbers if n.lower() in found]
+        filters.candidate_numbers = []
+    return filters
+
+
+def range_condition(filters: QueryFilters):
+    """SQL condition (on alias d) and params for the date/amount filters."""
+    clauses = []
+    params = []
+    if filters.date_from is not None:
+        clauses.append("d.invoice_date >= %s")
+        params.append(filters.date_from)
+    if filters.date_to is not None:
+        clauses.append("d.invoice_date <= %s")
+        params.append(filters.date_to)
+    if filters.min_amount is not None:
+        clauses.append("d.total_amount >= %s")
+        params.append(filters.min_amount)
+    if filters.max_amount is not None:
+        clauses.append("d.total_amount <= %s")
+        params.append(filters.max_amount)
+    return " AND ".join(clauses), params
+
+
+def fetch_invoices_in_ranges(cur, filters: QueryFilters, limit: int) -> list:
+    """Date-range and amount-threshold filters pushed down to SQL."""
+    where, params = range_condition(filters)
+    with timer("db_fetch"):
+        cur.execute(
+            SELECT_COLUMNS + "AND " + where + " ORDER BY d.customer_id LIMIT %s;",
+            [current_tenant()] + params + [limit]
+        )
+        return _add_positions(cur, _rows_to_dicts(cur.fetchall()))
+
+
+def fetch_ids_in_ranges(cur, filters: QueryFilters, limit: int = SQL_CANDIDATE_LIMIT) -> list:
+    """Ids of the newest `limit` invoices matching the date/amount filters, for ranking by vector."""
+    where, params = range_condition(filters)
+    with timer("db_fetch"):
+        cur.execute(
+            "SELECT d.customer_id FROM data_of_invoices d WHERE d.tenant_id = %s AND " + where
+            + " ORDER BY d.customer_id DESC LIMIT %s;",
+            [current_tenant()] + params + [limit]
+        )
+        ids = [row[0] for row in cur.fetchall()]
+    if len(ids) >= limit:
+        print(f"Range filter matched more than {limit} invoices; only the newest {limit} are ranked "
+              "(raise SQL_CANDIDATE_LIMIT to consider more)")
+    return ids
+
+
+def fetch_invoices_by_ids(cur, customer_ids: list) -> list:
+    with timer("db_fetch"):
+        cur.execute(SELECT_COLUMNS + "AND d.customer_id = ANY(%s);", (current_tenant(), customer_ids))
+        by_id = {row["customer_id"]: row for row in _rows_to_dicts(cur.fetchall())}
+        invoices = [by_id[i] for i in customer_ids if i in by_id]
+        return _add_positions(cur, invoices)
+
+
+@dataclass
+class RetrievalPlan:
+    filters: QueryFilters
+    strategy: str  # "keys", "ranges", "ranges+vector" or "vector"
+    invoices: list
+    total_invoices: int
+
+
+def plan_retrieval(question: str, k: int = RETRIEVAL_TOP_K,
+                   max_invoices: int = MAX_CONTEXT_INVOICES) -> RetrievalPlan:
+    """
+    Decide which invoices a question needs. Exact keys (customer id, invoice
+    number, position) and ranges (dates, amounts) go to SQL; whatever is left
+    fuzzy is served by a bounded top-k vector search. The result never holds
+    more than max_invoices rows, however big the table is. Only the current
+    tenant's invoices are considered.
+    """
+    filters = extract_filters(question)
+    # Refreshing the index takes its own connection, so do it before taking ours.
+    index = get_invoice_index() if not use_pgvector() else None
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM data_of_invoices WHERE tenant_id = %s;", (current_tenant(),))
+        total = cur.fetchone()[0]
+        resolve_invoice_numbers(cur, filters)
+        if filters.has_keys:
+            rows = fetch_invoices_by_keys(cur, filters)[:max_invoices]
+            if rows:
+                return RetrievalPlan(filters, "keys", rows, total)
+            # No invoice has these keys (a mistyped number, a position past the end):
+            # retrieve from the rest of the question rather than send no context.
+        if filters.has_ranges:
+            rows = fetch_invoices_in_ranges(cur, filters, limit=max_invoices + 1)
+            if len(rows) <= max_invoices:
+                return RetrievalPlan(filters, "ranges", rows, total)
+            if use_pgvector():
+                where, params = range_condition(filters)
+                hits = search_similar(cur, get_embedding_service().embed_one(question), max_invoices, where, params)
+                return RetrievalPlan(filters, "ranges+vector", fetch_invoices_by_ids(cur, [h[0] for h in hits]), total)
+            # Rank the in-range rows with the FAISS index, restricted to their ids.
+            hits = index.search_within(question, fetch_ids_in_ranges(cur, filters), max_invoices)
+            ids = [metadata["customer_id"] for metadata, _ in hits]
+            return RetrievalPlan(filters, "ranges+vector", fetch_invoices_by_ids(cur, ids), total)
+
+        if use_pgvector():
+            hits = search_similar(cur, get_embedding_service().embed_one(question), min(k, max_invoices))
+            ids = [customer_id for customer_id, _ in hits]
+        else:
+            ids = [metadata["customer_id"] for metadata, _ in index.search(question, min(k, max_invoices))]
+        return RetrievalPlan(filters, "vector", fetch_invoices_by_ids(cur, ids), total)
+
+
+def has_invoices() -> bool:
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM data_of_invoices WHERE tenant_id = %s);", (current_tenant(),))
+        return cur.fetchone()[0]
+
+
+def plan_documents(plan: RetrievalPlan) -> list:
+    return [
+        Document(
+            page_content=format_invoice_document(inv, inv["position"], plan.total_invoices),
+            metadata={"customer_id": inv["customer_id"], "invoice_number": inv["invoice_number"]}
+        )
+        for inv in plan.invoices
+    ]
+
+
+class PlannedRetriever(BaseRetriever):
+    """LangChain retriever that returns the invoices chosen by plan_retrieval()."""
+    k: int = RETRIEVAL_TOP_K
+    max_invoices: int = MAX_CONTEXT_INVOICES
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return plan_documents(plan_retrieval(query, self.k, self.max_invoices))
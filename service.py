@@ -0,0 +1,355 @@
+"""
+Multi-user chat service.
+
+The Streamlit app keeps one conversation per browser session and everything
+heavy is already shared by the process: the embedding model, the Gemini
+client, the connection pool, and the FAISS index / analytics snapshot (one
+per tenant, see tenants.TenantCache). ChatService is the same chat path
+without Streamlit, so many users can be served from one process: each
+conversation is a small session (follow-up state, bounded chat memory, the
+last SERVICE_HISTORY_MESSAGES messages) in a SessionStore that is capped at
+SERVICE_MAX_SESSIONS and drops sessions idle for SERVICE_SESSION_TTL
+seconds, so memory stays flat however many sessions come and go. Turns are
+saved to chat_history (chat_store.py), so a dropped session, or one from
+before a restart, is restored from the database when its id comes back.
+
+Every call runs under use_tenant(tenant_id) (a streamed turn in a context
+with the tenant set, see stream_turn), so a tenant only ever sees its own
+invoices, uploads and jobs. create_app() exposes the service over HTTP
+(needs fastapi and uvicorn). The tenant in the path must be the one the
+caller authenticated as (tenants.authenticate_tenant: a signed
+"Authorization: Bearer" token or a trusted proxy header), else 403:
+
+    uvicorn service:app --host 0.0.0.0 --port 8000 --workers 1
+
+    POST /tenants/acme/chat         {"session_id": "...", "message": "Top 5 suppliers"}
+    POST /tenants/acme/chat/stream  same body, answer streamed as plain text
+    POST /tenants/acme/query        {"question": "..."}    (stateless run_query)
+    POST /tenants/acme/uploads?file_name=scan.png   raw file as the body
+    GET  /tenants/acme/sessions/<session_id>?limit=50&before=<cursor>   stored messages, paged
+    GET  /tenants/acme/jobs?ids=1,2
+    GET  /metrics, /health
+
+Use one worker per host and scale with INGEST_WORKERS / ingest_worker.py
+for uploads: each extra server process loads its own copy of the model and
+indexes, which is what this module exists to avoid.
+"""
+import os
+import time
+import uuid
+import threading
+import contextvars
+from collections import OrderedDict
+from langchain.schema import HumanMessage, AIMessage
+from llm.query_llm import ChatTurn, run_query
+from llm.followup import new_session
+from llm.memory import load_chat_memory
+from db.chat_store import get_chat_writer, fetch_chat_page, CHAT_PAGE_SIZE
+from db.jobs import enqueue_job, fetch_jobs
+from db.blob_store import content_sha256, store_blob, dhash
+from db.tenants import authenticate_tenant, set_current_tenant, use_tenant, validate_tenant_id
+from metrics import get_metrics, inc
+
+try:
+    from fastapi import Depends, FastAPI, HTTPException, Request
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import PlainTextResponse, StreamingResponse
+    from pydantic import BaseModel
+except ImportError:  # the service is optional; the Streamlit app doesn't need it
+    FastAPI = None
+
+SERVICE_MAX_SESSIONS = int(os.getenv("SERVICE_MAX_SESSIONS", "10000"))
+SERVICE_SESSION_TTL = int(os.getenv("SERVICE_SESSION_TTL", "1800"))  # seconds idle before a session is dropped
+SERVICE_HISTORY_MESSAGES = int(os.getenv("SERVICE_HISTORY_MESSAGES", "20"))
+SERVICE_MAX_UPLOAD_BYTES = int(os.getenv("SERVICE_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_EXTENSIONS = (".png", ".jpg", ".jpeg", ".pdf")
+
+
+class ChatSession:
+    """One conversation: follow-up state and memory (followup.new_session) plus recent messages."""
+
+    def __init__(self, session_id: str, tenant_id: str):
+        self.session_id = session_id
+        self.tenant_id = tenant_id
+        self.state = new_session()
+        self.history = []
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def record(self, turn: ChatTurn):
+        self.history = turn.history[-SERVICE_HISTORY_MESSAGES:] if SERVICE_HISTORY_MESSAGES > 0 else []
+        # turn_timings grows by one per turn; only the last few are ever shown.
+        del self.state["turn_timings"][:-10]
+        self.last_used = time.monotonic()
+
+
+class SessionStore:
+    """
+    Sessions by id, least recently used first. Sessions idle longer than
+    `ttl` are dropped on access, and at most `max_sessions` are kept.
+    A session belongs to the tenant that created it.
+    """
+
+    def __init__(self, max_sessions: int = SERVICE_MAX_SESSIONS, ttl: float = SERVICE_SESSION_TTL):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+        get_metrics().register_collector("sessions", self.stats)
+
+    def _expire(self, now: float):
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if self.ttl <= 0 or now - session.last_used < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, tenant_id: str, session_id: str = None, restore=None) -> ChatSession:
+        """
+        The session `session_id` of `tenant_id`. One that isn't held (dropped,
+        or another tenant's id) comes from restore(tenant_id, session_id) if
+        that returns a session, else a new session with a new id is started.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None and session.tenant_id == tenant_id:
+                self._sessions.move_to_end(session_id)
+                session.last_used = now
+                return session
+        # Restoring reads the database, so it runs outside the lock.
+        session = restore(tenant_id, session_id) if restore and session_id else None
+        with self._lock:
+            held = self._sessions.get(session.session_id) if session else None
+            if held is not None:
+                # Restored twice at once, or the id is taken by another tenant.
+                if held.tenant_id == tenant_id:
+                    return held
+                session = None
+            if session is None:
+                session = ChatSession(uuid.uuid4().hex, tenant_id)
+            self._sessions[session.session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+            session.last_used = now
+            return session
+
+    def drop(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self) -> dict:
+        return {"active": len(self._sessions), "evicted": self.evicted}
+
+
+class ChatService:
+    """The chat, query and upload paths of the app for many tenants and sessions in one process."""
+
+    def __init__(self, sessions: SessionStore = None):
+        self.sessions = sessions or SessionStore()
+
+    def open_session(self, tenant_id: str, session_id: str = None) -> ChatSession:
+        """The session to answer the next message on (held, restored or new); see SessionStore.get."""
+        return self.sessions.get(validate_tenant_id(tenant_id), session_id, restore=self.restore_session)
+
+    def stream_turn(self, session: ChatSession, message: str, done=None):
+        """
+        Answer `message` on `session`, yielding the answer tokens, then record
+        and save the turn and call done(turn). The session lock is taken when
+        the first token is requested and released when the generator ends or
+        is closed, so two messages on one session are answered in order and a
+        response that is never iterated holds nothing.
+
+        A streamed HTTP response calls next() from a fresh copy of the request
+        context each time, so every step runs in one context captured here,
+        with the session's tenant set.
+        """
+        context = contextvars.copy_context()
+        context.run(set_current_tenant, session.tenant_id)
+        with session.lock:
+            turn = context.run(ChatTurn, message, session.history, session.state)
+            inc("service_chat_turns_total", tenant=session.tenant_id)
+            tokens = context.run(turn.stream)
+            try:
+                while True:
+                    try:
+                        token = context.run(next, tokens)
+                    except StopIteration:
+                        break
+                    yield token
+            finally:
+                context.run(tokens.close)
+            session.record(turn)
+            get_chat_writer().append_turn(turn.query, turn.answer, session_id=session.session_id,
+                                          tenant_id=session.tenant_id)
+        if done is not None:
+            done(turn)
+
+    def chat(self, tenant_id: str, message: str, session_id: str = None) -> dict:
+        session = self.open_session(tenant_id, session_id)
+        turns = []
+        for _ in self.stream_turn(session, message, turns.append):
+            pass
+        turn = turns[0]
+        return {"session_id": session.session_id, "answer": turn.answer, "timing": turn.timing}
+
+    def restore_session(self, tenant_id: str, session_id: str):
+        """A session rebuilt from its stored messages, or None if it has none."""
+        try:
+            with use_tenant(tenant_id):
+                memory, messages = load_chat_memory(session_id=session_id)
+        except Exception as e:
+            print("Error restoring chat session:", e)
+            return None
+        if not messages:
+            return None
+        session = ChatSession(session_id, tenant_id)
+        session.state["memory"] = memory
+        session.history = [
+            HumanMessage(content=content) if role == "user" else AIMessage(content=content)
+            for role, content in messages
+        ][-SERVICE_HISTORY_MESSAGES:] if SERVICE_HISTORY_MESSAGES > 0 else []
+        inc("service_sessions_restored_total")
+        return session
+
+    def history(self, tenant_id: str, session_id: str, limit: int = CHAT_PAGE_SIZE, before: int = None) -> dict:
+        """Stored messages of a session, newest page first; pass `next` back as `before` for older ones."""
+        with use_tenant(validate_tenant_id(tenant_id)):
+            messages, cursor = fetch_chat_page(session_id=session_id, limit=limit, before=before)
+        return {
+            "session_id": session_id,
+            "messages": [
+                {"id": m["id"], "role": m["role"], "content": m["content"], "timestamp": m["timestamp"]}
+                for m in messages
+            ],
+            "next": cursor,
+        }
+
+    def query(self, tenant_id: str, question: str) -> str:
+        with use_tenant(validate_tenant_id(tenant_id)):
+            return run_query(question)
+
+    def upload(self, tenant_id: str, data: bytes, file_name: str) -> int:
+        """Store the file by content hash and queue it for the ingest workers; returns the job id."""
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension not in UPLOAD_EXTENSIONS:
+            raise ValueError(f"Unsupported file type {extension!r}")
+        digest = content_sha256(data)
+        _, file_path = store_blob(data, extension, digest=digest)
+        phash = None
+        if extension != ".pdf":
+            try:
+                phash = dhash(file_path)
+            except Exception as e:
+                print("Error computing image hash:", e)
+        with use_tenant(validate_tenant_id(tenant_id)):
+            return enqueue_job(file_path, file_name, digest, phash)
+
+    def jobs(self, tenant_id: str, job_ids: list) -> list:
+        with use_tenant(validate_tenant_id(tenant_id)):
+            return fetch_jobs(job_ids)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_chat_service() -> ChatService:
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = ChatService()
+    return _service
+
+
+def create_app(service: ChatService = None):
+    """FastAPI app over `service` (the process-wide ChatService by default)."""
+    if FastAPI is None:
+        raise RuntimeError("fastapi is not installed: pip install fastapi uvicorn")
+    service = service or get_chat_service()
+    app = FastAPI(title="Invoice chatbot")
+
+    class ChatRequest(BaseModel):
+        message: str
+        session_id: str = None
+
+    class QueryRequest(BaseModel):
+        question: str
+
+    def checked_tenant(tenant_id: str, request: Request) -> str:
+        """Dependency: the path's tenant, if the request is authenticated for it."""
+        try:
+            tenant_id = validate_tenant_id(tenant_id)
+            return authenticate_tenant(request.headers, requested=tenant_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except PermissionError as e:
+            raise HTTPException(status_code=403, detail=str(e))
+
+    # Plain (non-async) endpoints: FastAPI runs them on its thread pool, which
+    # suits the blocking database and Gemini calls underneath.
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "sessions": len(service.sessions)}
+
+    @app.post("/tenants/{tenant_id}/chat")
+    def chat(request: ChatRequest, tenant: str = Depends(checked_tenant)):
+        return service.chat(tenant, request.message, request.session_id)
+
+    @app.post("/tenants/{tenant_id}/chat/stream")
+    def chat_stream(request: ChatRequest, tenant: str = Depends(checked_tenant)):
+        session = service.open_session(tenant, request.session_id)
+        return StreamingResponse(
+            service.stream_turn(session, request.message), media_type="text/plain; charset=utf-8",
+            headers={"X-Session-Id": session.session_id},
+        )
+
+    @app.get("/tenants/{tenant_id}/sessions/{session_id}")
+    def session_history(session_id: str, limit: int = CHAT_PAGE_SIZE, before: int = None,
+                        tenant: str = Depends(checked_tenant)):
+        history = service.history(tenant, session_id, max(1, min(limit, 500)), before)
+        if not history["messages"] and before is None:
+            raise HTTPException(status_code=404, detail="Unknown session")
+        return history
+
+    @app.post("/tenants/{tenant_id}/query")
+    def query(request: QueryRequest, tenant: str = Depends(checked_tenant)):
+        return {"answer": service.query(tenant, request.question)}
+
+    @app.post("/tenants/{tenant_id}/uploads")
+    async def upload(file_name: str, request: Request, tenant: str = Depends(checked_tenant)):
+        data = await request.body()
+        if not data:
+            raise HTTPException(status_code=400, detail="Empty upload")
+        if len(data) > SERVICE_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Upload too large")
+        try:
+            job_id = await run_in_threadpool(service.upload, tenant, data, file_name)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"job_id": job_id}
+
+    @app.get("/tenants/{tenant_id}/jobs")
+    def jobs(ids: str = "", tenant: str = Depends(checked_tenant)):
+        try:
+            job_ids = [int(job_id) for job_id in ids.split(",") if job_id.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+        return {"jobs": service.jobs(tenant, job_ids)}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return get_metrics().prometheus_text()
+
+    return app
+
+
+app = create_app() if FastAPI is not None else None
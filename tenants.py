@@ -0,0 +1,188 @@
+"""
+Tenant (workspace) scoping.
+
+Every invoice, upload job and the indexes built from them belong to one
+tenant (migrations/009_tenants.sql). The active tenant is a context
+variable, like the active trace in metrics.py, so the query functions keep
+their signatures and pick it up themselves:
+
+    with use_tenant("acme"):
+        answer = run_query("How many invoices are there?")
+
+Code that runs without a tenant (the single-user app, scripts) works on
+DEFAULT_TENANT, which is where rows from before the migration live.
+
+Callers over HTTP (app.py, service.py) never pick their tenant directly;
+authenticate_tenant() derives it from a credential:
+
+  - a token signed with TENANT_SIGNING_KEY (sign_tenant_token, or
+    `python tenants.py sign acme`), sent as "Authorization: Bearer <token>"
+    or ?token=, or
+  - the TENANT_PROXY_HEADER header, set by a trusted reverse proxy that
+    authenticates users and strips the header from client requests.
+
+With neither configured only DEFAULT_TENANT can be used.
+
+    python tenants.py sign acme [--ttl 86400]
+"""
+import os
+import re
+import sys
+import hmac
+import time
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+TENANT_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+TENANT_SIGNING_KEY = os.getenv("TENANT_SIGNING_KEY", "")
+TENANT_PROXY_HEADER = os.getenv("TENANT_PROXY_HEADER", "")  # e.g. X-Tenant-Id; empty = trust no header
+TENANT_TOKEN_TTL = int(os.getenv("TENANT_TOKEN_TTL", str(30 * 24 * 3600)))
+
+_current_tenant = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+
+def validate_tenant_id(tenant_id: str) -> str:
+    """Tenant ids end up in file paths and metric labels; keep them to [A-Za-z0-9_-]."""
+    tenant_id = (tenant_id or "").strip()
+    if not TENANT_ID_RE.match(tenant_id):
+        raise ValueError(f"Invalid tenant id {tenant_id!r}")
+    return tenant_id
+
+
+def current_tenant() -> str:
+    return _current_tenant.get()
+
+
+def set_current_tenant(tenant_id: str):
+    """Set the tenant for the rest of this context (e.g. one Streamlit script run)."""
+    return _current_tenant.set(validate_tenant_id(tenant_id))
+
+
+@contextmanager
+def use_tenant(tenant_id: str):
+    token = _current_tenant.set(validate_tenant_id(tenant_id))
+    try:
+        yield tenant_id
+    finally:
+        _current_tenant.reset(token)
+
+
+def _token_signature(payload: str, key: str) -> str:
+    return hmac.new(key.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def sign_tenant_token(tenant_id: str, ttl: int = TENANT_TOKEN_TTL, key: str = None) -> str:
+    """A "<tenant>.<expires>.<hmac>" token granting access to one tenant for `ttl` seconds."""
+    key = key or TENANT_SIGNING_KEY
+    if not key:
+        raise ValueError("TENANT_SIGNING_KEY is not set")
+    payload = f"{validate_tenant_id(tenant_id)}.{int(time.time()) + ttl}"
+    return f"{payload}.{_token_signature(payload, key)}"
+
+
+def verify_tenant_token(token: str, key: str = None) -> str:
+    """The tenant of a token from sign_tenant_token; PermissionError if it is forged or expired."""
+    key = key or TENANT_SIGNING_KEY
+    try:
+        tenant_id, expires, signature = (token or "").split(".")
+        expires = int(expires)
+    except ValueError:
+        raise PermissionError("Malformed tenant token")
+    if not key or not hmac.compare_digest(signature, _token_signature(f"{tenant_id}.{expires}", key)):
+        raise PermissionError("Invalid tenant token")
+    if expires < time.time():
+        raise PermissionError("Tenant token has expired")
+    return validate_tenant_id(tenant_id)
+
+
+def authenticate_tenant(headers=None, token: str = None, requested: str = None) -> str:
+    """
+    The tenant a caller may act as, from a signed token (`token`, or an
+    Authorization: Bearer header) or the trusted proxy header. `requested`
+    (e.g. the tenant in a URL) must match it. Raises PermissionError.
+    """
+    headers = {name.lower(): value for name, value in (headers or {}).items()}
+    authorization = headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    proxied = headers.get(TENANT_PROXY_HEADER.lower()) if TENANT_PROXY_HEADER else None
+    if TENANT_SIGNING_KEY and token:
+        tenant_id = verify_tenant_token(token)
+    elif proxied:
+        tenant_id = validate_tenant_id(proxied)
+    elif not TENANT_SIGNING_KEY and not TENANT_PROXY_HEADER:
+        tenant_id = DEFAULT_TENANT  # single-workspace install, nothing to authenticate against
+    else:
+        raise PermissionError("No tenant credentials")
+    if requested and requested != tenant_id:
+        raise PermissionError(f"Not allowed to access tenant {requested!r}")
+    return tenant_id
+
+
+def tenant_path(path: str, tenant_id: str = None) -> str:
+    """
+    On-disk location of a per-tenant file or directory. The default tenant
+    keeps `path` itself, so indexes written before tenants existed still load.
+    """
+    tenant_id = tenant_id or current_tenant()
+    if not path or tenant_id == DEFAULT_TENANT:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{tenant_id}{extension}"
+
+
+class TenantCache:
+    """
+    One lazily built object per tenant (index, snapshot), with at most
+    `max_size` kept in memory; the least recently used is dropped first
+    and simply rebuilt (or reloaded from disk) when that tenant comes back.
+    """
+
+    def __init__(self, factory, max_size: int):
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id: str = None):
+        tenant_id = tenant_id or current_tenant()
+        with self._lock:
+            item = self._items.get(tenant_id)
+            if item is not None:
+                self._items.move_to_end(tenant_id)
+                return item
+            item = self._items[tenant_id] = self.factory(tenant_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return item
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Issue a signed tenant token (TENANT_SIGNING_KEY).")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    sign = subcommands.add_parser("sign")
+    sign.add_argument("tenant")
+    sign.add_argument("--ttl", type=int, default=TENANT_TOKEN_TTL, help="Seconds the token is valid")
+    args = parser.parse_args(argv)
+    try:
+        print(sign_tenant_token(args.tenant, args.ttl))
+    except ValueError as e:
+        print("Error:", e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,18 @@
+"""
+The modules sit side by side in the repository root but import each other
+as db.*, llm.* and img2text.* (the deployed layout). Map those package
+names onto the root so the tests run from a plain checkout.
+"""
+import os
+import sys
+import types
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+for package in ("db", "llm", "img2text"):
+    if importlib.util.find_spec(package) is None:
+        module = types.ModuleType(package)
+        module.__path__ = [ROOT]
+        sys.modules[package] = module
@@ -0,0 +1,130 @@
+"""
+The SQL fast path must either apply every qualifier in a question (customer,
+supplier, item, dates) or leave the question to the LLM, never answer it for
+the whole table. Runs against a fake cursor and an in-memory snapshot.
+"""
+import datetime
+from contextlib import contextmanager
+import pytest
+from db.analytics import AnalyticsSnapshot
+from llm import intent_router
+from llm.intent_router import route_query
+
+ROWS = [
+    (1, "INV-001", "Neha Joshi", "Amazon", datetime.date(2025, 4, 2), 1000),
+    (2, "INV-002", "Ravi Kumar", "Flipkart", datetime.date(2025, 4, 20), 2500),
+    (3, "INV-003", "Neha Joshi", "Flipkart", datetime.date(2025, 3, 5), 400),
+    (4, "INV-004", "Ravi Kumar", "Amazon", datetime.date(2025, 5, 1), 700),
+]
+
+
+class FakeCursor:
+    def __init__(self):
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, list(params or [])))
+
+    def fetchone(self):
+        sql = self.executed[-1][0]
+        if "information_schema" in sql:
+            return ("numeric",)
+        if "GROUP BY customer" in sql:
+            return ("Ravi Kumar", 3200)
+        if "AVG(" in sql or "SUM(" in sql:
+            return (1700, 2)
+        if "COUNT(*)" in sql:
+            return (2,)
+        return None
+
+    def fetchall(self):
+        return []
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self, **kwargs):
+        return self._cursor
+
+
+@pytest.fixture
+def cursor(monkeypatch, tmp_path):
+    cur = FakeCursor()
+    snapshot = AnalyticsSnapshot(str(tmp_path / "snapshot.npz"))
+    snapshot.append_rows(ROWS)
+
+    @contextmanager
+    def get_connection():
+        yield FakeConnection(cur)
+
+    monkeypatch.setattr(intent_router, "get_connection", get_connection)
+    monkeypatch.setattr(intent_router, "get_analytics_snapshot", lambda: snapshot)
+    return cur
+
+
+def params_of(cur):
+    return [param for _, params in cur.executed for param in params]
+
+
+def test_count_from_supplier_filters_on_supplier(cursor):
+    routed = route_query("How many invoices from Amazon?")
+    assert routed.intent == "count"
+    assert "from Amazon" in routed.answer
+    sql, params = cursor.executed[-1]
+    assert "lower(supplier) = ANY(%s)" in sql
+    assert ["amazon"] in params
+
+
+def test_average_for_customer_filters_on_customer(cursor):
+    routed = route_query("average invoice total for Neha Joshi")
+    assert routed.intent == "average"
+    sql, params = cursor.executed[-1]
+    assert "lower(customer) = ANY(%s)" in sql
+    assert ["neha joshi"] in params
+
+
+def test_sum_of_possessive_customer_filters_on_customer(cursor):
+    routed = route_query("what is the sum of Ravi Kumar's invoices?")
+    assert routed.intent == "sum"
+    assert ["ravi kumar"] in params_of(cursor)
+
+
+def test_top_spender_on_an_item_goes_to_the_llm(cursor):
+    assert route_query("who spent the most on headphones?") is None
+    assert not any("data_of_invoices" in sql for sql, _ in cursor.executed)
+
+
+def test_top_spender_at_supplier_last_month_applies_supplier_and_dates(cursor):
+    routed = route_query("who spent the most at Flipkart last month?")
+    assert routed.intent == "top_spender"
+    sql, params = cursor.executed[-1]
+    assert "lower(supplier) = ANY(%s)" in sql and "invoice_date >= %s" in sql
+    assert ["flipkart"] in params
+
+
+def test_unknown_name_goes_to_the_llm(cursor):
+    assert route_query("How many invoices from Zeta Traders?") is None
+    assert route_query("what is the sum of Arjun's invoices?") is None
+
+
+def test_unqualified_aggregate_is_still_answered(cursor):
+    routed = route_query("How many invoices are there?")
+    assert routed.intent == "count"
+    sql, params = cursor.executed[-1]
+    assert "customer" not in sql and "supplier" not in sql
+
+
+def test_grouped_answer_is_limited_to_the_named_supplier(cursor):
+    routed = route_query("total spend per month for Amazon")
+    assert routed.intent == "group_by"
+    assert "2025-04: ₹1,000.00 (1 invoice)" in routed.answer  # not the ₹3,500.00 of all April invoices
+    assert "2025-05: ₹700.00" in routed.answer
+    assert "2025-03" not in routed.answer  # only Flipkart sold in March
@@ -0,0 +1,219 @@
+"""
+GeminiClient against a local fake of GenerativeModel.generate_content_async:
+coalescing, retries with backoff, the concurrency and rate limits, timeouts
+and streaming through the queue. No network or API key needed.
+"""
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+import pytest
+from llm import llm_client
+from llm.llm_client import GeminiClient, TokenBucket, is_retryable
+
+
+class FakeApiError(Exception):
+    """Stands in for google.api_core errors, which carry the HTTP status as .code."""
+
+    def __init__(self, code: int):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class FakeStream:
+    def __init__(self, chunks, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        for i, text in enumerate(self.chunks):
+            if self.fail_after is not None and i == self.fail_after:
+                raise FakeApiError(503)
+            usage = SimpleNamespace(prompt_token_count=7) if i == len(self.chunks) - 1 else None
+            yield SimpleNamespace(text=text, usage_metadata=usage)
+
+
+class FakeGemini:
+    """
+    Answers every prompt with `text` (or streams `chunks`) after `delay`
+    seconds. The first calls raise the errors in `failures`, in order.
+    Records how many calls were made, when, and how many ran at once.
+    """
+
+    def __init__(self, text="answer", chunks=("Hel", "lo", "!"), delay=0.0, failures=(), fail_after=None):
+        self.text = text
+        self.chunks = list(chunks)
+        self.delay = delay
+        self.failures = list(failures)
+        self.fail_after = fail_after
+        self.calls = 0
+        self.call_times = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    async def generate_content_async(self, prompt, stream=False):
+        with self._lock:
+            self.calls += 1
+            self.call_times.append(time.monotonic())
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            failure = self.failures.pop(0) if self.failures else None
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            with self._lock:
+                self.active -= 1
+        if failure is not None:
+            raise failure
+        if stream:
+            return FakeStream(self.chunks, self.fail_after)
+        return SimpleNamespace(text=f" {self.text} ", usage_metadata=SimpleNamespace(prompt_token_count=5))
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_client, "GEMINI_BACKOFF_BASE", 0.02)
+
+
+def make_client(model, **kwargs):
+    kwargs.setdefault("rate", 0)
+    kwargs.setdefault("max_retries", 3)
+    kwargs.setdefault("timeout", 5)
+    return GeminiClient(model=model, **kwargs)
+
+
+def gather(client, prompts):
+    async def run():
+        return await asyncio.gather(*[client.generate_async(prompt) for prompt in prompts])
+    return asyncio.run(run())
+
+
+def test_generate_returns_stripped_text_and_counts_prompt_tokens():
+    client = make_client(FakeGemini(text="42 invoices"))
+    assert client.generate("How many invoices?") == "42 invoices"
+    stats = client.stats()
+    assert stats["requests"] == 1
+    assert stats["prompt_tokens"] == 5
+    assert stats["prompt_chars"] == len("How many invoices?")
+
+
+def test_identical_prompts_in_flight_are_coalesced():
+    model = FakeGemini(delay=0.2)
+    client = make_client(model)
+    answers = gather(client, ["same prompt"] * 5)
+    assert answers == ["answer"] * 5
+    assert model.calls == 1
+    assert client.coalesced == 4
+    assert client.stats()["in_flight"] == 0
+
+
+def test_different_prompts_and_finished_prompts_are_not_coalesced():
+    model = FakeGemini(delay=0.05)
+    client = make_client(model)
+    gather(client, ["first", "second"])
+    client.generate("first")
+    assert model.calls == 3
+    assert client.coalesced == 0
+
+
+def test_retryable_errors_are_retried_with_exponential_backoff():
+    model = FakeGemini(failures=[FakeApiError(429), FakeApiError(503)])
+    client = make_client(model)
+    assert client.generate("prompt") == "answer"
+    assert model.calls == 3
+    assert client.retries == 2
+    first_gap = model.call_times[1] - model.call_times[0]
+    second_gap = model.call_times[2] - model.call_times[1]
+    # base * 2 ** attempt, plus up to as much jitter
+    assert first_gap >= 0.02
+    assert second_gap >= 0.04
+
+
+def test_non_retryable_error_is_raised_at_once():
+    model = FakeGemini(failures=[FakeApiError(400)])
+    client = make_client(model)
+    with pytest.raises(FakeApiError):
+        client.generate("prompt")
+    assert model.calls == 1
+    assert client.retries == 0
+
+
+def test_gives_up_after_max_retries():
+    model = FakeGemini(failures=[FakeApiError(500)] * 10)
+    client = make_client(model, max_retries=2)
+    with pytest.raises(FakeApiError):
+        client.generate("prompt")
+    assert model.calls == 3
+
+
+def test_timeouts_are_retried_then_raised():
+    model = FakeGemini(delay=0.5)
+    client = make_client(model, timeout=0.05, max_retries=1)
+    started = time.monotonic()
+    with pytest.raises((asyncio.TimeoutError, TimeoutError)):
+        client.generate("slow prompt")
+    assert model.calls == 2
+    assert time.monotonic() - started < 0.5
+
+
+def test_is_retryable():
+    assert is_retryable(FakeApiError(429))
+    assert is_retryable(FakeApiError(503))
+    assert is_retryable(asyncio.TimeoutError())
+    assert not is_retryable(FakeApiError(400))
+    assert not is_retryable(ValueError("bad prompt"))
+
+
+def test_in_flight_requests_are_bounded_by_max_concurrency():
+    model = FakeGemini(delay=0.1)
+    client = make_client(model, max_concurrency=2)
+    gather(client, [f"prompt {i}" for i in range(6)])
+    assert model.calls == 6
+    assert model.max_active == 2
+
+
+def test_rate_limit_spaces_requests():
+    model = FakeGemini()
+    client = make_client(model, rate=20, max_concurrency=1)
+    gather(client, [f"prompt {i}" for i in range(5)])
+    # One burst token, then one request every 1/20 s.
+    assert model.call_times[-1] - model.call_times[0] >= 4 / 20 * 0.9
+
+
+def test_token_bucket_allows_a_burst_then_waits():
+    async def run():
+        bucket = TokenBucket(rate=10, capacity=3)
+        started = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        await bucket.acquire()
+        return burst, time.monotonic() - started
+    burst, total = asyncio.run(run())
+    assert burst < 0.05
+    assert total >= 0.09
+
+
+def test_stream_yields_chunks_in_order_and_records_usage():
+    client = make_client(FakeGemini(chunks=["Hel", "lo", "!"]))
+    assert list(client.stream("prompt")) == ["Hel", "lo", "!"]
+    assert client.prompt_tokens == 7
+
+
+def test_stream_retries_errors_before_the_first_chunk():
+    model = FakeGemini(failures=[FakeApiError(503)])
+    client = make_client(model)
+    assert "".join(client.stream("prompt")) == "Hello!"
+    assert model.calls == 2
+
+
+def test_stream_does_not_retry_after_chunks_were_sent():
+    model = FakeGemini(chunks=["a", "b", "c"], fail_after=2)
+    client = make_client(model)
+    received = []
+    with pytest.raises(FakeApiError):
+        for chunk in client.stream("prompt"):
+            received.append(chunk)
+    assert received == ["a", "b"]
+    assert model.calls == 1
@@ -0,0 +1,89 @@
+"""
+Invoice-number detection and the keys path of plan_retrieval, against a
+fake cursor and a fake FAISS index.
+"""
+from contextlib import contextmanager
+import pytest
+from llm import retrieval
+from llm.retrieval import extract_filters, plan_retrieval
+
+
+def test_bare_dashed_tokens_are_only_candidates():
+    filters = extract_filters("How many COVID-19 masks did we buy?")
+    assert filters.invoice_numbers == []
+    assert filters.candidate_numbers == ["COVID-19"]
+    assert not filters.has_keys
+
+
+def test_invoice_cue_makes_a_number():
+    assert extract_filters("Summarize invoice AMD-2024-559").invoice_numbers == ["AMD-2024-559"]
+    assert extract_filters("What is the total of INV-2003?").invoice_numbers == ["INV-2003"]
+
+
+class FakeCursor:
+    """Knows one invoice, INV-7; the vector index returns it for anything."""
+
+    def __init__(self):
+        self.executed = []
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        params = list(params or [])
+        if "SELECT DISTINCT lower(invoice_number)" in sql:
+            self._rows = [("inv-7",)] if "inv-7" in params[1] else []
+        elif "COUNT(*)" in sql:
+            self._rows = [(1,)]
+        elif "row_number()" in sql:
+            self._rows = [(7, 1)]
+        elif "d.customer_id = ANY(%s);" in sql:
+            self._rows = [(7, "INV-7", "Neha", "Amazon", "2025-04-02", "pens", 10, None)] if 7 in params[1] else []
+        else:
+            # Keys lookups by number or position.
+            self._rows = []
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class FakeIndex:
+    def search(self, question, k):
+        return [({"customer_id": 7}, 0.1)]
+
+
+@pytest.fixture
+def cursor(monkeypatch):
+    cur = FakeCursor()
+
+    @contextmanager
+    def get_connection():
+        class Connection:
+            def cursor(self, **kwargs):
+                return cur
+        yield Connection()
+
+    monkeypatch.setattr(retrieval, "get_connection", get_connection)
+    monkeypatch.setattr(retrieval, "use_pgvector", lambda: False)
+    monkeypatch.setattr(retrieval, "get_invoice_index", lambda: FakeIndex())
+    return cur
+
+
+def test_unknown_candidate_number_falls_back_to_vector_search(cursor):
+    plan = plan_retrieval("How many COVID-19 masks did we buy?")
+    assert plan.strategy == "vector"
+    assert [inv["invoice_number"] for inv in plan.invoices] == ["INV-7"]
+
+
+def test_keys_that_match_nothing_fall_back_instead_of_empty_context(cursor):
+    plan = plan_retrieval("Summarize invoice INV-999")
+    assert plan.strategy == "vector"
+    assert plan.invoices
@@ -0,0 +1,65 @@
+"""
+Signed tenant tokens and authenticate_tenant: a caller only ever gets the
+tenant its credential names, whatever it asks for in the URL.
+"""
+import pytest
+from db import tenants
+from db.tenants import DEFAULT_TENANT, authenticate_tenant, sign_tenant_token, verify_tenant_token
+
+KEY = "test-signing-key"
+
+
+@pytest.fixture
+def signing_key(monkeypatch):
+    monkeypatch.setattr(tenants, "TENANT_SIGNING_KEY", KEY)
+    monkeypatch.setattr(tenants, "TENANT_PROXY_HEADER", "")
+
+
+def test_token_round_trip(signing_key):
+    assert verify_tenant_token(sign_tenant_token("acme")) == "acme"
+
+
+def test_tampered_or_expired_tokens_are_rejected(signing_key):
+    token = sign_tenant_token("acme")
+    _, expires, signature = token.split(".")
+    with pytest.raises(PermissionError):
+        verify_tenant_token(f"globex.{expires}.{signature}")
+    with pytest.raises(PermissionError):
+        verify_tenant_token(sign_tenant_token("acme", key="another-key"))
+    with pytest.raises(PermissionError):
+        verify_tenant_token(sign_tenant_token("acme", ttl=-1))
+    with pytest.raises(PermissionError):
+        verify_tenant_token("acme")
+
+
+def test_bearer_token_must_match_the_requested_tenant(signing_key):
+    headers = {"Authorization": f"Bearer {sign_tenant_token('acme')}"}
+    assert authenticate_tenant(headers, requested="acme") == "acme"
+    assert authenticate_tenant(headers) == "acme"
+    with pytest.raises(PermissionError):
+        authenticate_tenant(headers, requested="globex")
+
+
+def test_no_credentials_are_rejected_when_a_key_is_set(signing_key):
+    with pytest.raises(PermissionError):
+        authenticate_tenant({}, requested="acme")
+
+
+def test_proxy_header_is_only_trusted_when_configured(monkeypatch):
+    monkeypatch.setattr(tenants, "TENANT_SIGNING_KEY", "")
+    monkeypatch.setattr(tenants, "TENANT_PROXY_HEADER", "X-Tenant-Id")
+    assert authenticate_tenant({"x-tenant-id": "acme"}, requested="acme") == "acme"
+    with pytest.raises(PermissionError):
+        authenticate_tenant({}, requested="acme")
+
+    monkeypatch.setattr(tenants, "TENANT_PROXY_HEADER", "")
+    with pytest.raises(PermissionError):
+        authenticate_tenant({"x-tenant-id": "acme"}, requested="acme")
+
+
+def test_unconfigured_install_only_serves_the_default_tenant(monkeypatch):
+    monkeypatch.setattr(tenants, "TENANT_SIGNING_KEY", "")
+    monkeypatch.setattr(tenants, "TENANT_PROXY_HEADER", "")
+    assert authenticate_tenant({}) == DEFAULT_TENANT
+    with pytest.raises(PermissionError):
+        authenticate_tenant({}, requested="acme")
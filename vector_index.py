@@ -0,0 +1,325 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores import FAISS
+from db.db_handler import get_connection
+from llm.embeddings import get_embedding_service
+from db.tenants import DEFAULT_TENANT, TenantCache, tenant_path
+from metrics import timer
+
+try:
+    import fcntl
+except ImportError:  # Windows: saves stay atomic per file, without the cross-process lock
+    fcntl = None
+
+INDEX_DIR = os.getenv("INVOICE_INDEX_DIR", "faiss_index")
+VECTOR_INDEX_MAX_TENANTS = int(os.getenv("VECTOR_INDEX_MAX_TENANTS", "32"))  # indexes kept in memory
+
+
+def format_invoice_document(inv: dict, position: int, total: int = None) -> str:
+    """Render one invoice row as the text stored in the vector index."""
+    order = f"{position} (1 = Oldest, {total} = Newest)" if total else f"{position} (1 = Oldest)"
+    return (
+        f"Customer ID: {inv['customer_id']}\n"
+        f"Upload Order: {order}\n"
+        f"Invoice Number: {inv['invoice_number']}\n"
+        f"Customer: {inv['customer']}\n"
+        f"Supplier: {inv['supplier']}\n"
+        f"Date: {inv['invoice_date']}\n"
+        f"Items: {inv['items']}\n"
+        f"Total Amount: {inv['total_amount']}"
+    )
+
+
+def parse_stored_embedding(value):
+    """
+    vector_embedding is written by app.py as a JSON string, but a float8[]
+    column comes back as a Python list. Returns None if it can't be used.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except Exception:
+            return None
+    try:
+        return [float(x) for x in value]
+    except Exception:
+        return None
+
+
+class InvoiceIndex:
+    """
+    Process-wide FAISS index over data_of_invoices.
+
+    The index is built from the vector_embedding already stored for each row,
+    persisted to INDEX_DIR, and kept current by only loading rows whose
+    customer_id is above the high-water mark. Chat turns call refresh() (one
+    cheap COUNT/MAX query when nothing changed) and then search. Each
+    tenant has its own index (get_invoice_index).
+
+    _lock serialises refreshes, which spend most of their time in the
+    database and the embedding model. _store_lock is only held while the
+    FAISS index and its id maps are read or changed, so searches wait for an
+    add, never for a whole refresh. A rebuild is done off to the side and
+    swapped in.
+    """
+
+    def __init__(self, index_dir: str = INDEX_DIR, embeddings=None, tenant_id: str = DEFAULT_TENANT):
+        self.index_dir = index_dir
+        self.tenant_id = tenant_id
+        self.high_water_mark = 0
+        self.store = None
+        self._positions = None  # customer_id -> FAISS row, built on first search_within
+        self._embeddings = embeddings
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()
+        self._load()
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = get_embedding_service()
+        return self._embeddings
+
+    def __len__(self):
+        store = self.store
+        return store.index.ntotal if store is not None else 0
+
+    # --- Persistence ---
+    def _paths(self):
+        return (
+            os.path.join(self.index_dir, "index.faiss"),
+            os.path.join(self.index_dir, "index_meta.json"),
+        )
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """
+        Lock on the index directory shared by the app and the ingest worker
+        processes, so a reader never sees index.faiss from one save and
+        index_meta.json from another.
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(os.path.join(self.index_dir, ".lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        index_path, meta_path = self._paths()
+        if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+            return
+        try:
+            with self._file_lock(exclusive=False):
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                index = faiss.read_index(index_path)
+            if index.ntotal != len(meta["docs"]):
+                raise ValueError(f"index has {index.ntotal} vectors, metadata {len(meta['docs'])}")
+            docs = {}
+            index_to_id = {}
+            for i, entry in enumerate(meta["docs"]):
+                doc_id = str(entry["metadata"]["customer_id"])
+                docs[doc_id] = Document(page_content=entry["text"], metadata=entry["metadata"])
+                index_to_id[i] = doc_id
+            self.store = FAISS(self.embeddings, index, InMemoryDocstore(docs), index_to_id)
+            self._positions = None
+            self.high_water_mark = meta["high_water_mark"]
+        except Exception as e:
+            print("Error loading invoice index, it will be rebuilt:", e)
+            self.store = None
+            self.high_water_mark = 0
+
+    def _save(self):
+        if self.store is None:
+            return
+        os.makedirs(self.index_dir, exist_ok=True)
+        index_path, meta_path = self._paths()
+        docs = []
+        for i in range(self.store.index.ntotal):
+            doc = self.store.docstore.search(self.store.index_to_docstore_id[i])
+            docs.append({"text": doc.page_content, "metadata": doc.metadata})
+        # Written to temp files, then both swapped in under the lock.
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        faiss.write_index(self.store.index, index_path + suffix)
+        with open(meta_path + suffix, "w", encoding="utf-8") as f:
+            json.dump({"high_water_mark": self.high_water_mark, "docs": docs}, f)
+        with self._file_lock(exclusive=True):
+            os.replace(index_path + suffix, index_path)
+            os.replace(meta_path + suffix, meta_path)
+
+    # --- Sync with the database ---
+    def _fetch_rows_after(self, customer_id: int):
+        rows = []
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT customer_id, invoice_number, customer, supplier,
+                    to_char(invoice_date, 'YYYY-MM-DD') as invoice_date,
+                    items, total_amount, vector_embedding
+                FROM data_of_invoices
+                WHERE tenant_id = %s AND customer_id > %s
+                ORDER BY customer_id ASC;
+                """,
+                (self.tenant_id, customer_id)
+            )
+            for row in cur.fetchall():
+                rows.append({
+                    "customer_id": row[0],
+                    "invoice_number": row[1],
+                    "customer": row[2],
+                    "supplier": row[3],
+                    "invoice_date": row[4],
+                    "items": row[5],
+                    "total_amount": row[6],
+                    "vector_embedding": row[7]
+                })
+        return rows
+
+    def _table_stats(self):
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT COUNT(*), COALESCE(MAX(customer_id), 0) FROM data_of_invoices WHERE tenant_id = %s;",
+                (self.tenant_id,)
+            )
+            count, max_id = cur.fetchone()
+        return count, max_id
+
+    def _add_rows(self, rows, rebuild: bool = False):
+        """Add rows to the index, or replace its contents with them when `rebuild`. Call under _lock."""
+        if not rows:
+            if rebuild:
+                with self._store_lock:
+                    self.store = None
+                    self._positions = None
+                    self.high_water_mark = 0
+            return
+        position = 0 if rebuild else len(self)
+        text_embeddings = []
+        metadatas = []
+        missing = []
+        for inv in rows:
+            position += 1
+            text = format_invoice_document(inv, position)
+            vector = parse_stored_embedding(inv.get("vector_embedding"))
+            if vector is None:
+                missing.append(len(text_embeddings))
+            text_embeddings.append([text, vector])
+            metadatas.append({
+                "customer_id": inv["customer_id"],
+                "invoice_number": inv["invoice_number"],
+                "position": position
+            })
+        # Rows inserted without an embedding (or with a bad one) are embedded here once.
+        if missing:
+            vectors = self.embeddings.embed_documents([text_embeddings[i][0] for i in missing])
+            for i, vector in zip(missing, vectors):
+                text_embeddings[i][1] = vector
+        pairs = [(text, vector) for text, vector in text_embeddings]
+        ids = [str(m["customer_id"]) for m in metadatas]
+        with timer("vector_build"):
+            if rebuild or self.store is None:
+                store = FAISS.from_embeddings(pairs, self.embeddings, metadatas=metadatas, ids=ids)
+                with self._store_lock:
+                    self.store = store
+                    self._positions = None
+            else:
+                with self._store_lock:
+                    self.store.add_embeddings(pairs, metadatas=metadatas, ids=ids)
+                    self._positions = None
+        self.high_water_mark = rows[-1]["customer_id"]
+
+    def rebuild(self):
+        with self._lock:
+            self._add_rows(self._fetch_rows_after(0), rebuild=True)
+            self._save()
+
+    def refresh(self):
+        """Add rows inserted since the last refresh; rebuild if rows were deleted."""
+        with self._lock:
+            try:
+                count, max_id = self._table_stats()
+            except Exception as e:
+                print("Error checking invoice table for index refresh:", e)
+                return
+            if max_id == self.high_water_mark and count == len(self):
+                return
+            new_rows = self._fetch_rows_after(self.high_water_mark) if max_id > self.high_water_mark else []
+            rebuild = max_id < self.high_water_mark or count != len(self) + len(new_rows)
+            if rebuild:
+                # Rows were deleted or rewritten below the mark; start over.
+                new_rows = self._fetch_rows_after(0)
+            self._add_rows(new_rows, rebuild=rebuild)
+            self._save()
+
+    def search(self, query: str, k: int) -> list:
+        """Top-k nearest invoices as (metadata, distance) pairs."""
+        if self.store is None or k <= 0:
+            return []
+        # Embedded before taking the lock; the query may go to a remote model.
+        vector = self.embeddings.embed_query(query)
+        with self._store_lock, timer("vector_search"):
+            if self.store is None:
+                return []
+            hits = self.store.similarity_search_with_score_by_vector(vector, k=min(k, len(self)))
+        return [(doc.metadata, score) for doc, score in hits]
+
+    def search_within(self, query: str, customer_ids: list, k: int) -> list:
+        """
+        Top-k nearest invoices among `customer_ids` (e.g. the rows of a date
+        range) as (metadata, distance) pairs. Only those rows are scanned, and
+        their vectors never leave the index.
+        """
+        if self.store is None or k <= 0 or not customer_ids:
+            return []
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype="float32")
+        with self._store_lock:
+            store = self.store
+            if store is None:
+                return []
+            positions = self._positions
+            if positions is None:
+                positions = self._positions = {
+                    int(doc_id): i for i, doc_id in store.index_to_docstore_id.items()
+                }
+            rows = [positions[i] for i in customer_ids if i in positions]
+            if not rows:
+                return []
+            selector = faiss.IDSelectorBatch(np.asarray(rows, dtype="int64"))
+            with timer("vector_search"):
+                distances, found = store.index.search(vector, min(k, len(rows)), params=faiss.SearchParameters(sel=selector))
+            hits = []
+            for distance, i in zip(distances[0], found[0]):
+                if i >= 0:
+                    doc = store.docstore.search(store.index_to_docstore_id[int(i)])
+                    hits.append((doc.metadata, float(distance)))
+        return hits
+
+    def as_retriever(self, **kwargs):
+        if self.store is None:
+            return None
+        return self.store.as_retriever(**kwargs)
+
+
+_indexes = TenantCache(
+    lambda tenant_id: InvoiceIndex(tenant_path(INDEX_DIR, tenant_id), tenant_id=tenant_id),
+    VECTOR_INDEX_MAX_TENANTS,
+)
+
+
+def get_invoice_index(tenant_id: str = None) -> InvoiceIndex:
+    """Return the shared index of the (current) tenant, refreshed against the database."""
+    index = _indexes.get(tenant_id)
+    index.refresh()
+    return index